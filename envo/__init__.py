@@ -25,11 +25,8 @@ from envo import venv_utils
 from envium import (
     env_var,
     ctx_var,
-    computed_env_var,
-    computed_secret,
     computed_ctx_var,
     EnvGroup,
     CtxGroup,
     SecretsGroup,
-    secret,
 )
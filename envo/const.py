@@ -2,7 +2,7 @@ import inspect
 import re
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import Dict, Optional
+from typing import Dict
 
 __all__ = ["STAGES", "emojis"]
 
@@ -45,7 +45,7 @@ class STAGES:
         return ret
 
     @classmethod
-    def filename_to_stage(cls, filename: str) -> Optional[Stage]:
+    def filename_to_stage(cls, filename: str) -> Stage:
         stages = cls.get_all_stages()
         matches_groups = re.search(r"env_(.*)\.py", filename)
         if not matches_groups:
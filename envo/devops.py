@@ -1,14 +1,41 @@
+import atexit
+import codecs
 import os
 import re
+import selectors
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BufferedReader
+from queue import Empty, Queue
 from subprocess import Popen
+from threading import Condition, Event, Lock, Thread
+from uuid import uuid4
 
-__all__ = ["CommandError", "run", "inject", "run_get"]
+__all__ = [
+    "CommandError",
+    "Resources",
+    "run",
+    "inject",
+    "run_get",
+    "run_get_stream",
+    "run_capture",
+    "OutputStream",
+    "BashPool",
+    "bash_pool",
+    "JobRegistry",
+    "background_jobs",
+]
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from pathlib import Path
 from textwrap import dedent
-from typing import List, Optional, Union
+from typing import IO, Any, Deque, Dict, Iterator, List, Optional, Tuple, Union, cast
 
 from colorama import Fore, Style
 
@@ -20,7 +47,105 @@ class CommandError(RuntimeError):
     pass
 
 
-def _get_popen_cmd(command: str) -> List[str]:
+@dataclass
+class Resources:
+    """
+    Resources available to commands (ignored on windows).
+
+    Resources are applied by wrapping the command with nice, taskset, ionice and shell ulimit instead of
+    Popen's preexec_fn, which isn't safe when threads are running (parallel runs, background jobs).
+
+    :param nice: niceness increment
+    :param cpu_affinity: cpus the command is allowed to run on (linux only)
+    :param max_memory: address space limit in bytes (RLIMIT_AS)
+    :param max_cpu_time: cpu time limit in seconds (RLIMIT_CPU)
+    :param io_class: I/O scheduling class, "realtime", "best-effort" or "idle" (linux only)
+    :param io_level: priority within the I/O scheduling class (0 - highest, 7 - lowest)
+    """
+
+    io_classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+    nice: Optional[int] = None
+    cpu_affinity: Optional[List[int]] = None
+    max_memory: Optional[int] = None
+    max_cpu_time: Optional[int] = None
+    io_class: Optional[str] = None
+    io_level: int = 4
+
+    def __post_init__(self) -> None:
+        if self.io_class is not None and self.io_class not in self.io_classes:
+            raise CommandError(f'Unknown I/O class "{self.io_class}" (choose from {", ".join(self.io_classes)})')
+
+        if not isinstance(self.io_level, int) or not 0 <= self.io_level <= 7:
+            raise CommandError(f"I/O level has to be between 0 and 7 (got {self.io_level})")
+
+    def _get_tool(self, name: str) -> str:
+        path = shutil.which(name)
+        if not path:
+            raise CommandError(f'"{name}" is required to apply command resources but it\'s not installed')
+        return path
+
+    def _get_ulimit_script(self) -> Optional[str]:
+        import resource
+
+        limits = []
+        # ulimit -v takes kilobytes
+        for option, limit, value in [
+            ("-t", resource.RLIMIT_CPU, self.max_cpu_time),
+            ("-v", resource.RLIMIT_AS, None if self.max_memory is None else self.max_memory // 1024),
+        ]:
+            if value is None:
+                continue
+            _, hard = resource.getrlimit(limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard // 1024 if option == "-v" else hard)
+            limits.append(f"ulimit {option} {value}")
+
+        if not limits:
+            return None
+
+        return " && ".join(limits + ['exec "$@"'])
+
+    def wrap(self, popen_cmd: List[str]) -> List[str]:
+        """
+        Return popen_cmd prefixed with commands applying resources.
+        """
+        if is_windows() or self == Resources():
+            return popen_cmd
+
+        prefix = []
+        if self.nice:
+            prefix += [self._get_tool("nice"), "-n", str(self.nice)]
+        if self.cpu_affinity is not None and is_linux():
+            prefix += [self._get_tool("taskset"), "-c", ",".join(str(c) for c in self.cpu_affinity)]
+        if self.io_class is not None and is_linux():
+            prefix += [self._get_tool("ionice"), "-c", str(self.io_classes[self.io_class])]
+            # idle class has no levels
+            if self.io_class != "idle":
+                prefix += ["-n", str(self.io_level)]
+
+        ulimit_script = self._get_ulimit_script()
+        if ulimit_script:
+            prefix += ["/bin/sh", "-c", ulimit_script, "sh"]
+
+        return prefix + popen_cmd
+
+
+# used when resources are not passed explicitly, set from Env.Meta.run_resources
+default_resources: Optional[Resources] = None
+
+
+def _get_resources(resources: Optional[Resources]) -> Optional[Resources]:
+    """
+    Return resources to apply (default ones if not given), None if there is nothing to apply.
+    """
+    resources = resources or default_resources
+    if not resources or is_windows() or resources == Resources():
+        return None
+    return resources
+
+
+def _get_popen_cmd(command: str, resources: Optional[Resources] = None) -> List[str]:
     command_extra = re.sub(r"\\(?:\t| )*\n(?:\t| )*", "", command)
 
     if is_windows():
@@ -39,6 +164,10 @@ def _get_popen_cmd(command: str) -> List[str]:
     else:
         raise NotImplementedError()
 
+    resources = _get_resources(resources)
+    if resources:
+        popen_cmd = resources.wrap(popen_cmd)
+
     return popen_cmd
 
 
@@ -46,34 +175,285 @@ def _get_popen_cmd(command: str) -> List[str]:
 class Output:
     stdout: str
     stderr: str
+    return_code: Optional[int] = None
 
 
-def run_get(command: str) -> Output:
-    popen_cmds = _get_popen_cmd(command=command)
+def _get_process_group_kwargs() -> Dict[str, Any]:
+    """
+    Return Popen arguments starting the process in its own process group, so the whole process tree can be
+    killed. Process in its own group is in the background so it's stopped when it reads from the terminal.
+    """
+    if is_windows():
+        return {}
+    if sys.version_info >= (3, 11):
+        return {"process_group": 0}
+    return {"start_new_session": True}
 
-    proc = Popen(popen_cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=os.environ)
-    outs, errs = proc.communicate()
 
-    output = Output(stdout=outs.decode("utf-8"), stderr=errs.decode("utf-8"))
-    return output
+def _kill_tree(proc: Popen, sig: int = signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM) -> None:
+    """
+    Kill process and its children (children only if it was started in its own process group or session).
+    """
+    if proc.poll() is not None:
+        return
 
+    if is_windows():
+        subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)], capture_output=True)
+        return
 
-def _run(
+    try:
+        if os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, sig)
+        else:
+            # shares the process group with us, only the process itself can be killed
+            proc.send_signal(sig)
+    except ProcessLookupError:
+        pass
+
+
+def _read_pipes(proc: Popen, deadline: Optional[float]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yield (stream name, data) from stdout and stderr of proc as data arrives.
+    Both pipes are read at the same time so the process never blocks on a full pipe.
+    """
+    pipes: Dict[int, str] = {p.fileno(): n for p, n in ((proc.stdout, "stdout"), (proc.stderr, "stderr")) if p}
+
+    with selectors.DefaultSelector() as selector:
+        for fd in pipes.keys():
+            selector.register(fd, selectors.EVENT_READ)
+
+        while selector.get_map():
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            ready = selector.select(timeout)
+            if not ready and deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError
+
+            for key, _ in ready:
+                data = os.read(key.fd, 64 * 1024)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                yield pipes[key.fd], data
+
+
+def _close_pipes(proc: Popen) -> None:
+    for p in (proc.stdout, proc.stderr):
+        if p:
+            p.close()
+
+
+def _read_pipes_threaded(proc: Popen, deadline: Optional[float]) -> Iterator[Tuple[str, bytes]]:
+    # pipes can't be selected on windows
+    chunks: "Queue[Tuple[str, bytes]]" = Queue(maxsize=64)
+
+    def reader(pipe: BufferedReader, name: str) -> None:
+        for data in iter(lambda: pipe.read1(64 * 1024), b""):
+            chunks.put((name, data))
+        chunks.put((name, b""))
+
+    pipes = {n: p for n, p in {"stdout": proc.stdout, "stderr": proc.stderr}.items() if p}
+    for n, p in pipes.items():
+        Thread(target=reader, args=(p, n), daemon=True).start()
+
+    open_pipes = len(pipes)
+    while open_pipes:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            name, data = chunks.get(timeout=timeout)
+        except Empty:
+            raise TimeoutError
+        if not data:
+            open_pipes -= 1
+            continue
+        yield name, data
+
+
+class OutputStream:
+    """
+    Output of a running command.
+
+    Iterating yields (stream name, text) tuples ("stdout" or "stderr") as the output arrives,
+    one line at a time or in chunks as read from the pipes. Output is decoded incrementally so it's never
+    buffered as a whole.
+    """
+
+    return_code: Optional[int]
+    tail: Deque[str]
+
+    def __init__(
+        self,
+        command: str,
+        timeout: Optional[float] = None,
+        lines: bool = True,
+        tail: int = 0,
+        raise_on_error: bool = False,
+        errors: str = "strict",
+        resources: Optional[Resources] = None,
+    ) -> None:
+        """
+        :param timeout: seconds after which the command (with its children) is killed and CommandError raised
+        :param lines: yield whole lines instead of chunks
+        :param tail: number of the last lines (or chunks) kept in self.tail, used in error messages
+        :param raise_on_error: raise CommandError when the command fails
+        :param errors: decoding errors handling (as in bytes.decode)
+        :param resources: resources available to the command (defaults to Env.Meta.run_resources)
+        """
+        self.command = command
+        self.timeout = timeout
+        self.lines = lines
+        self.raise_on_error = raise_on_error
+        self.errors = errors
+        self.resources = resources
+
+        self.return_code = None
+        self.tail = deque(maxlen=tail)
+
+    def _get_error_msg(self, reason: str) -> str:
+        msg = f'Command "{dedent(self.command).strip()}" {reason}'
+        if self.tail:
+            msg += "\n" + "".join(self.tail)
+        return msg
+
+    def _decoded(self, chunks: Iterator[Tuple[str, bytes]]) -> Iterator[Tuple[str, str]]:
+        decoders = {n: codecs.getincrementaldecoder("utf-8")(errors=self.errors) for n in ["stdout", "stderr"]}
+        partial_lines = {"stdout": "", "stderr": ""}
+
+        for name, data in chunks:
+            text = decoders[name].decode(data)
+            if not self.lines:
+                if text:
+                    yield name, text
+                continue
+
+            text = partial_lines[name] + text
+            lines = text.splitlines(keepends=True)
+            partial_lines[name] = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+            for line in lines:
+                yield name, line
+
+        for name, decoder in decoders.items():
+            rest = partial_lines[name] + decoder.decode(b"", final=True)
+            if rest:
+                yield name, rest
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        proc = Popen(
+            _get_popen_cmd(self.command, self.resources),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=os.environ,
+            # isolated only when it might have to be killed, otherwise it stays in the foreground so it can
+            # read from the terminal (e.g. password prompts)
+            **(_get_process_group_kwargs() if self.timeout is not None else {}),
+        )
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        read_pipes = _read_pipes_threaded if is_windows() else _read_pipes
+
+        finished = False
+        try:
+            for name, text in self._decoded(read_pipes(proc, deadline)):
+                self.tail.append(text)
+                yield name, text
+            finished = True
+        except TimeoutError:
+            _kill_tree(proc)
+            self.return_code = proc.wait()
+            raise CommandError(self._get_error_msg(f"timed out after {self.timeout}s"))
+        finally:
+            # iteration stopped early or failed
+            if not finished:
+                _kill_tree(proc)
+            _close_pipes(proc)
+
+        try:
+            self.return_code = proc.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            _kill_tree(proc)
+            self.return_code = proc.wait()
+            raise CommandError(self._get_error_msg(f"timed out after {self.timeout}s"))
+
+        if self.return_code != 0 and self.raise_on_error:
+            raise CommandError(self._get_error_msg(f"failed with return code {self.return_code}"))
+
+
+def run_get_stream(
     command: str,
-    raise_on_error=True,
-    print_output=True,
-    print_errors=True,
-    verbose: Optional[bool] = None,
-    background=False,
-) -> Optional[str]:
+    timeout: Optional[float] = None,
+    lines: bool = True,
+    tail: int = 0,
+    raise_on_error: bool = False,
+    errors: str = "strict",
+    resources: Optional[Resources] = None,
+) -> OutputStream:
+    """
+    Run command and stream its output. See OutputStream.
+    """
+    return OutputStream(
+        command=command,
+        timeout=timeout,
+        lines=lines,
+        tail=tail,
+        raise_on_error=raise_on_error,
+        errors=errors,
+        resources=resources,
+    )
+
+
+def run_get(command: str, timeout: Optional[float] = None, resources: Optional[Resources] = None) -> Output:
+    stdout = []
+    stderr = []
+    stream = run_get_stream(command, timeout=timeout, lines=False, resources=resources)
+    for name, text in stream:
+        if name == "stdout":
+            stdout.append(text)
+        else:
+            stderr.append(text)
+
+    output = Output(stdout="".join(stdout), stderr="".join(stderr), return_code=stream.return_code)
+    return output
+
+
+class _BoundedBuffer:
+    """
+    Keeps the last max_bytes of written data.
+    """
+
+    def __init__(self, max_bytes: Optional[int]) -> None:
+        self.max_bytes = max_bytes
+        self.truncated = False
 
+        self._chunks: Deque[bytes] = deque()
+        self._size = 0
+
+    def write(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._size += len(data)
+
+        if self.max_bytes is None:
+            return
+
+        while self._size > self.max_bytes:
+            self.truncated = True
+            excess = self._size - self.max_bytes
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                self._size -= len(first)
+            else:
+                self._chunks[0] = first[excess:]
+                self._size -= excess
+
+    def getvalue(self) -> str:
+        # truncation can cut a multibyte character
+        return b"".join(self._chunks).decode("utf-8", errors="replace")
+
+
+def _print_command(command: str, verbose: Optional[bool] = None) -> None:
     debug = os.environ.get("ENVO_DEBUG", "False") == "True"
 
     if verbose is None:
         verbose = os.environ.get("ENVO_VERBOSE_RUN", False)
 
-    popen_cmd = _get_popen_cmd(command)
-
     dedent_cmd = dedent(command.strip())
     if verbose:
         console.rule(f"[bold rgb(225,221,0)]{dedent_cmd}", align="center", style="rgb(255,0,255)")
@@ -81,60 +461,723 @@ def _run(
     if debug:
         print(f"Run: {Fore.BLUE}{Style.BRIGHT}{dedent_cmd}{Style.RESET_ALL}")
 
-    kwargs = {}
-    if not print_output:
-        kwargs["stdout"] = subprocess.PIPE
 
-    if not print_errors:
-        kwargs["stderr"] = subprocess.PIPE
+class BashWorker:
+    """
+    Long-lived bash process running commands one by one.
 
-    proc = Popen(popen_cmd, env=os.environ, **kwargs)
+    Every command is run in its own subshell (with the same options as non pooled commands and stdin
+    redirected from /dev/null) so it can't affect the worker. Ends of stdout and stderr of a command are marked
+    with sentinel lines, stdout one carries the return code. Environment variables and the working directory are
+    synchronised with the current process before each command.
+    """
+
+    # can't be exported in bash
+    readonly_vars = {"BASHOPTS", "BASH_VERSINFO", "EUID", "PPID", "SHELLOPTS", "UID"}
+
+    def __init__(self) -> None:
+        self._token = f"__envo_worker_{uuid4().hex}"
+        self._environ = os.environ.copy()
+        self._cwd = os.getcwd()
+
+        self.proc = Popen(
+            ["/bin/bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self._environ,
+            cwd=self._cwd,
+            start_new_session=True,
+        )
+        # always set, all of them are pipes
+        self.stdin = cast(IO[bytes], self.proc.stdin)
+        self.stdout = cast(IO[bytes], self.proc.stdout)
+        self.stderr = cast(IO[bytes], self.proc.stderr)
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def _get_sync_script(self) -> str:
+        lines = []
+        environ = os.environ.copy()
+
+        for k, v in environ.items():
+            if k in self.readonly_vars or not k.isidentifier():
+                continue
+            if self._environ.get(k) != v:
+                lines.append(f"export {k}={shlex.quote(v)}")
+
+        for k in self._environ.keys() - environ.keys():
+            if k.isidentifier():
+                lines.append(f"unset {k}")
+
+        cwd = os.getcwd()
+        if cwd != self._cwd:
+            lines.append(f"cd {shlex.quote(cwd)}")
+
+        self._environ = environ
+        self._cwd = cwd
+
+        if not lines:
+            return ""
+
+        return "{ " + "\n".join(lines) + "\n} 2>/dev/null\n"
+
+    def _get_script(self, command: str) -> str:
+        command_extra = re.sub(r"\\(?:\t| )*\n(?:\t| )*", "", command)
+        options = "set -uoe pipefail; shopt -s globstar"
+
+        return (
+            self._get_sync_script()
+            + f"( {options}\neval {shlex.quote(command_extra)}\n) < /dev/null\n"
+            + f"printf '\\n{self._token}_%d\\n' $?\n"
+            + f"printf '\\n{self._token}\\n' 1>&2\n"
+        )
+
+    def run(self, command: str, stdout: Optional[IO[str]] = None, stderr: Optional[IO[str]] = None) -> int:
+        """
+        Run command and forward its output to stdout and stderr (discarded if None).
+        """
+        self.stdin.write(self._get_script(command).encode("utf-8"))
+        self.stdin.flush()
+
+        marker = f"\n{self._token}".encode("utf-8")
+        outputs = {self.stdout.fileno(): stdout, self.stderr.fileno(): stderr}
+        buffers = {fd: b"" for fd in outputs.keys()}
+        decoders = {fd: codecs.getincrementaldecoder("utf-8")(errors="replace") for fd in outputs.keys()}
+        ret_code = None
+
+        def forward(fd: int, data: bytes, final: bool = False) -> None:
+            text = decoders[fd].decode(data, final=final)
+            out = outputs[fd]
+            if out and text:
+                out.write(text)
+                out.flush()
+
+        with selectors.DefaultSelector() as selector:
+            for fd in outputs.keys():
+                selector.register(fd, selectors.EVENT_READ)
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    fd = key.fd
+                    data = os.read(fd, 64 * 1024)
+                    if not data:
+                        # worker died
+                        selector.unregister(fd)
+                        forward(fd, buffers[fd], final=True)
+                        continue
+
+                    buffer = buffers[fd] + data
+                    index = buffer.find(marker)
+                    end = buffer.find(b"\n", index + len(marker)) if index != -1 else -1
+                    if end != -1:
+                        forward(fd, buffer[:index], final=True)
+                        if fd == self.stdout.fileno():
+                            ret_code = int(buffer[index + len(marker) + 1 : end])
+                        buffers[fd] = b""
+                        selector.unregister(fd)
+                        continue
+
+                    # keep the marker or what might be its beginning
+                    split = index if index != -1 else max(len(buffer) - len(marker) + 1, 0)
+                    forward(fd, buffer[:split])
+                    buffers[fd] = buffer[split:]
+
+        if ret_code is None:
+            raise CommandError(f"Bash worker died while running {command}")
+
+        return ret_code
+
+    def close(self) -> None:
+        _kill_tree(self.proc)
+        self.proc.wait()
+
+
+class BashPool:
+    """
+    Pool of bash workers (see BashWorker) used by run(..., pooled=True).
+    Saves spawning a new shell for each of many small commands.
+    """
+
+    def __init__(self, size: int = 4) -> None:
+        self.size = size
+        self._idle: List[BashWorker] = []
+        self._count = 0
+        self._condition = Condition()
+
+    def _acquire(self) -> BashWorker:
+        with self._condition:
+            while True:
+                while self._idle:
+                    worker = self._idle.pop()
+                    if worker.alive:
+                        return worker
+                    self._count -= 1
+
+                if self._count < self.size:
+                    self._count += 1
+                    break
 
+                self._condition.wait()
+
+        try:
+            return BashWorker()
+        except BaseException:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, worker: BashWorker) -> None:
+        with self._condition:
+            if worker.alive:
+                self._idle.append(worker)
+            else:
+                self._count -= 1
+            self._condition.notify()
+
+    def run(self, command: str, stdout: Optional[IO[str]] = None, stderr: Optional[IO[str]] = None) -> int:
+        worker = self._acquire()
+        try:
+            return worker.run(command, stdout=stdout, stderr=stderr)
+        except BaseException:
+            # worker state is unknown (e.g. interrupted in the middle of a command)
+            worker.close()
+            raise
+        finally:
+            self._release(worker)
+
+    def close(self) -> None:
+        with self._condition:
+            for w in self._idle:
+                w.close()
+            self._count -= len(self._idle)
+            self._idle = []
+
+
+bash_pool = BashPool()
+atexit.register(bash_pool.close)
+
+
+class _RotatingFile:
+    """
+    Log file rotated (file -> file.1 -> file.2 ...) when it exceeds max_bytes.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, backups: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.path.open("ab")
+        self._lock = Lock()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for i in reversed(range(1, self.backups)):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                src.replace(self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups:
+            self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+        self._file = self.path.open("wb")
+
+    def write(self, data: bytes) -> None:
+        with self._lock:
+            if self._file.tell() + len(data) > self.max_bytes and self._file.tell():
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+@dataclass
+class Job:
+    id: int
+    command: str
+    proc: Popen
+    log_file: Path
+    started: float = field(default_factory=time.time)
+
+    @property
+    def running(self) -> bool:
+        return self.proc.poll() is None
+
+    @property
+    def return_code(self) -> Optional[int]:
+        return self.proc.poll()
+
+    def __str__(self) -> str:
+        status = "running" if self.running else f"exited ({self.return_code})"
+        command = " ".join(dedent(self.command).strip().split())
+        return f"[{self.id}] {self.proc.pid:<7} {status:<12} {command}  ({self.log_file})"
+
+
+class JobRegistry:
+    """
+    Background jobs started with run(..., background=True).
+
+    Output of every job is written (by a reader thread, so the shell is never blocked) to a rotating log file
+    and additionally printed if print_output/print_errors were requested. Finished jobs are reaped by their
+    reader threads so they don't become zombies.
+    """
+
+    jobs: Dict[int, Job]
+
+    def __init__(self, logs_dir: Optional[Path] = None, max_log_bytes: int = 1024 * 1024, log_backups: int = 2):
+        """
+        :param logs_dir: directory for job logs of this session (removed on cleanup)
+        """
+        self.logs_dir = logs_dir or Path.home() / f".envo/jobs/{os.getpid()}"
+        self.max_log_bytes = max_log_bytes
+        self.log_backups = log_backups
+
+        self.jobs = OrderedDict()
+        self._next_id = 1
+        self._lock = Lock()
+        # logs of sessions that didn't clean up (e.g. killed) are pruned when the first job starts
+        self._prune_stale = logs_dir is None and not is_windows()
+
+    def _prune_stale_logs(self) -> None:
+        for d in self.logs_dir.parent.glob("*"):
+            if not d.name.isdigit() or d == self.logs_dir:
+                continue
+            try:
+                os.kill(int(d.name), 0)
+            except ProcessLookupError:
+                shutil.rmtree(d, ignore_errors=True)
+            except OSError:
+                # exists but belongs to someone else
+                pass
+
+    def _read_output(self, pipe: BufferedReader, log: _RotatingFile, out: Optional[IO[str]]) -> None:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for data in iter(lambda: pipe.read1(64 * 1024), b""):
+            log.write(data)
+            if out:
+                out.write(decoder.decode(data))
+                out.flush()
+        pipe.close()
+
+    def _reap(self, job: Job, readers: List[Thread], log: _RotatingFile) -> None:
+        for r in readers:
+            r.join()
+        job.proc.wait()
+        log.close()
+        logger.debug(f"Job {job.id} finished", {"return_code": job.proc.returncode})
+
+    def start(
+        self,
+        command: str,
+        print_output: bool = True,
+        print_errors: bool = True,
+        resources: Optional[Resources] = None,
+    ) -> Job:
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            prune_stale, self._prune_stale = self._prune_stale, False
+
+        if prune_stale:
+            self._prune_stale_logs()
+
+        proc = Popen(
+            _get_popen_cmd(command, resources),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=os.environ,
+            start_new_session=not is_windows(),
+        )
+        job = Job(id=job_id, command=command, proc=proc, log_file=self.logs_dir / f"job_{job_id}.log")
+        log = _RotatingFile(job.log_file, max_bytes=self.max_log_bytes, backups=self.log_backups)
+
+        readers = [
+            Thread(target=self._read_output, args=(proc.stdout, log, sys.stdout if print_output else None)),
+            Thread(target=self._read_output, args=(proc.stderr, log, sys.stderr if print_errors else None)),
+        ]
+        for r in readers:
+            r.daemon = True
+            r.start()
+        Thread(target=self._reap, args=(job, readers, log), daemon=True).start()
+
+        with self._lock:
+            self.jobs[job_id] = job
+
+        logger.debug(f"Started job {job_id}", {"command": command, "pid": proc.pid})
+        return job
+
+    def get(self, job_id: Optional[int] = None) -> List[Job]:
+        """
+        Return job with given id or all jobs.
+        """
+        with self._lock:
+            if job_id is None:
+                return list(self.jobs.values())
+
+            if job_id not in self.jobs:
+                raise CommandError(f"There is no job {job_id}")
+
+            return [self.jobs[job_id]]
+
+    def wait(self, job_id: Optional[int] = None, timeout: Optional[float] = None) -> Dict[int, Optional[int]]:
+        """
+        Wait for job (or all jobs) to finish. Return return codes (None if still running after timeout).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ret: Dict[int, Optional[int]] = {}
+        for j in self.get(job_id):
+            try:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                ret[j.id] = j.proc.wait(remaining)
+            except subprocess.TimeoutExpired:
+                ret[j.id] = None
+        return ret
+
+    def kill(self, job_id: Optional[int] = None, sig: int = signal.SIGTERM, timeout: float = 5.0) -> None:
+        """
+        Kill job (or all jobs) with its children. Jobs that don't exit in time are killed with SIGKILL.
+        """
+        jobs = [j for j in self.get(job_id) if j.running]
+        for j in jobs:
+            _kill_tree(j.proc, sig)
+
+        for j in jobs:
+            try:
+                j.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                _kill_tree(j.proc)
+                j.proc.wait()
+
+    def forget_finished(self) -> None:
+        with self._lock:
+            self.jobs = OrderedDict((i, j) for i, j in self.jobs.items() if j.running)
+
+    def cleanup(self) -> None:
+        self.kill()
+        self.forget_finished()
+        shutil.rmtree(self.logs_dir, ignore_errors=True)
+
+    def print(self) -> None:
+        for j in self.get():
+            print(j)
+
+
+background_jobs = JobRegistry()
+
+
+def _run(
+    command: str,
+    raise_on_error: bool = True,
+    print_output: bool = True,
+    print_errors: bool = True,
+    verbose: Optional[bool] = None,
+    background: bool = False,
+    pooled: bool = False,
+    resources: Optional[Resources] = None,
+) -> Optional[int]:
     if background:
+        _print_command(command, verbose)
+        background_jobs.start(command, print_output=print_output, print_errors=print_errors, resources=resources)
         return None
 
+    # pool workers are already running so resources can't be applied to them
+    if pooled and is_linux() and not _get_resources(resources):
+        _print_command(command, verbose)
+
+        ret_code = bash_pool.run(
+            command, stdout=sys.stdout if print_output else None, stderr=sys.stderr if print_errors else None
+        )
+        if ret_code != 0 and raise_on_error:
+            sys.exit(ret_code)
+
+        return ret_code
+
+    popen_cmd = _get_popen_cmd(command, resources)
+
+    _print_command(command, verbose)
+
+    kwargs: Dict[str, Any] = {}
+    # nothing reads unwanted output so it can't go to a pipe (full pipe blocks the command forever)
+    if not print_output:
+        kwargs["stdout"] = subprocess.DEVNULL
+
+    if not print_errors:
+        kwargs["stderr"] = subprocess.DEVNULL
+
+    proc = Popen(popen_cmd, env=os.environ, **kwargs)
+
     ret_code = proc.wait()
 
     if ret_code != 0 and raise_on_error:
         sys.exit(ret_code)
 
+    return ret_code
+
+
+def run_capture(
+    command: str,
+    raise_on_error: bool = True,
+    print_output: bool = False,
+    print_errors: bool = False,
+    verbose: Optional[bool] = None,
+    max_bytes: Optional[int] = 1024 * 1024,
+    resources: Optional[Resources] = None,
+) -> Output:
+    """
+    Run command and capture its output.
+
+    Both pipes are drained at the same time so commands with big output never block.
+    Output is also printed as it arrives if print_output/print_errors are set.
+
+    :param max_bytes: only the last max_bytes of each stream are kept (None for no limit)
+    :param resources: resources available to the command (defaults to Env.Meta.run_resources)
+    :return: captured output with the return code
+    """
+    _print_command(command, verbose)
+
+    proc = Popen(
+        _get_popen_cmd(command, resources),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=os.environ,
+    )
+    read_pipes = _read_pipes_threaded if is_windows() else _read_pipes
+
+    buffers = {"stdout": _BoundedBuffer(max_bytes), "stderr": _BoundedBuffer(max_bytes)}
+    printed = {"stdout": sys.stdout if print_output else None, "stderr": sys.stderr if print_errors else None}
+    decoders = {n: codecs.getincrementaldecoder("utf-8")(errors="replace") for n in buffers.keys()}
+
+    try:
+        for name, data in read_pipes(proc, None):
+            buffers[name].write(data)
+            stream = printed[name]
+            if stream:
+                stream.write(decoders[name].decode(data))
+                stream.flush()
+    finally:
+        _close_pipes(proc)
+
+    ret_code = proc.wait()
+    if ret_code != 0 and raise_on_error:
+        sys.exit(ret_code)
+
+    return Output(stdout=buffers["stdout"].getvalue(), stderr=buffers["stderr"].getvalue(), return_code=ret_code)
+
+
+class _ParallelRunner:
+    """
+    Runs commands concurrently.
+
+    Output is printed live line by line, each line prefixed with the command number. Whole lines are written
+    under a lock so lines of different commands never get mixed.
+    """
+
+    def __init__(
+        self,
+        commands: List[str],
+        workers: int,
+        fail_fast: bool,
+        print_output: bool,
+        print_errors: bool,
+        verbose: Optional[bool],
+        progress_bar: Optional[str],
+        resources: Optional[Resources],
+    ) -> None:
+        self.commands = commands
+        self.workers = workers
+        self.fail_fast = fail_fast
+        self.print_output = print_output
+        self.print_errors = print_errors
+        self.verbose = verbose
+        self.progress_bar = progress_bar
+        self.resources = resources
+
+        self._procs: List[Popen] = []
+        self._stop = Event()
+        self._lock = Lock()
+        self._ret_codes: List[Optional[int]] = [None] * len(commands)
+        self._terminated: List[Popen] = []
+
+    def _get_prefix(self, index: int) -> str:
+        return f"[{index + 1}/{len(self.commands)}] "
+
+    def _print_lines(self, lines: List[str], index: int, stream: IO[str]) -> None:
+        if not lines:
+            return
+
+        prefix = self._get_prefix(index)
+        with self._lock:
+            stream.write("".join(prefix + line for line in lines))
+            stream.flush()
+
+    def _forward_output(self, proc: Popen, index: int) -> None:
+        streams = {"stdout": sys.stdout, "stderr": sys.stderr}
+        decoders = {n: codecs.getincrementaldecoder("utf-8")(errors="replace") for n in streams.keys()}
+        # unfinished last line of each stream
+        pending = {n: "" for n in streams.keys()}
+        read_pipes = _read_pipes_threaded if is_windows() else _read_pipes
+
+        try:
+            for name, data in read_pipes(proc, None):
+                lines = (pending[name] + decoders[name].decode(data)).splitlines(keepends=True)
+                pending[name] = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+                self._print_lines(lines, index, streams[name])
+        finally:
+            _close_pipes(proc)
+
+        for name, stream in streams.items():
+            rest = pending[name] + decoders[name].decode(b"", final=True)
+            if rest:
+                self._print_lines([rest + "\n"], index, stream)
+
+    def _run_one(self, index: int) -> Optional[int]:
+        if self._stop.is_set():
+            return None
+
+        command = self.commands[index]
+        with self._lock:
+            # _stop_all sets the flag before taking the lock so a process started here is always stopped by it
+            if self._stop.is_set():
+                return None
+            proc = Popen(
+                _get_popen_cmd(command, self.resources),
+                stdout=subprocess.PIPE if self.print_output else subprocess.DEVNULL,
+                stderr=subprocess.PIPE if self.print_errors else subprocess.DEVNULL,
+                env=os.environ,
+                # own process group so the whole process tree can be stopped
+                start_new_session=not is_windows(),
+            )
+            self._procs.append(proc)
+            _print_command(f"{self._get_prefix(index)}{command}", self.verbose)
+
+        self._forward_output(proc, index)
+        proc.wait()
+
+        with self._lock:
+            if proc not in self._terminated:
+                self._ret_codes[index] = proc.returncode
+
+        if proc.returncode != 0 and self.fail_fast:
+            self._stop_all()
+
+        return proc.returncode
+
+    def _stop_all(self) -> None:
+        self._stop.set()
+        with self._lock:
+            for p in self._procs:
+                if p.poll() is None:
+                    _kill_tree(p, signal.SIGTERM)
+                    self._terminated.append(p)
+
+    def run(self) -> int:
+        """
+        Return aggregated return code (return code of the first failed command or 0).
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._run_one, i) for i in range(len(self.commands))]
+
+            if self.progress_bar is not None:
+                from rich.progress import Progress
+
+                with Progress(console=console) as progress:
+                    task = progress.add_task(self.progress_bar, total=len(self.commands))
+                    for f in as_completed(futures):
+                        f.result()
+                        progress.advance(task)
+            else:
+                for f in futures:
+                    f.result()
+
+        failed = [c for c in self._ret_codes if c]
+        return failed[0] if failed else 0
+
 
 def run(
     command: Union[str, List[str]],
-    raise_on_error=True,
-    print_output=True,
-    print_errors=True,
+    raise_on_error: bool = True,
+    print_output: bool = True,
+    print_errors: bool = True,
     verbose: Optional[bool] = None,
-    background=False,
+    background: bool = False,
     progress_bar: Optional[str] = None,
-) -> None:
+    parallel: int = 1,
+    fail_fast: bool = True,
+    pooled: bool = False,
+    resources: Optional[Resources] = None,
+) -> int:
+    """
+    Run command (or list of commands).
+
+    :param parallel: number of commands run concurrently
+    :param fail_fast: stop remaining commands on first failure (parallel mode only)
+    :param pooled: run in a long-lived bash worker (see BashPool), much faster for many small commands (linux only)
+        Commands with resources set are not pooled.
+    :param resources: resources available to commands (defaults to Env.Meta.run_resources)
+    :return: aggregated return code (return code of the first failed command or 0)
+    """
     # join multilines
     if not isinstance(command, list):
         command = [command]
 
+    if parallel > 1 and len(command) > 1 and not background:
+        runner = _ParallelRunner(
+            commands=command,
+            workers=parallel,
+            fail_fast=fail_fast,
+            print_output=print_output,
+            print_errors=print_errors,
+            verbose=verbose,
+            progress_bar=progress_bar,
+            resources=resources,
+        )
+        ret_code = runner.run()
+        if ret_code != 0 and raise_on_error:
+            sys.exit(ret_code)
+        return ret_code
+
+    ret_codes = []
     if progress_bar is not None:
         from rich.progress import track
 
         for c in track(command, description=progress_bar):
-            _run(
-                command=c,
-                raise_on_error=raise_on_error,
-                print_output=print_output,
-                print_errors=print_errors,
-                verbose=verbose,
-                background=background,
+            ret_codes.append(
+                _run(
+                    command=c,
+                    raise_on_error=raise_on_error,
+                    print_output=print_output,
+                    print_errors=print_errors,
+                    verbose=verbose,
+                    background=background,
+                    pooled=pooled,
+                    resources=resources,
+                )
             )
     else:
         for c in command:
-            _run(
-                command=c,
-                raise_on_error=raise_on_error,
-                print_output=print_output,
-                print_errors=print_errors,
-                verbose=verbose,
-                background=background,
+            ret_codes.append(
+                _run(
+                    command=c,
+                    raise_on_error=raise_on_error,
+                    print_output=print_output,
+                    print_errors=print_errors,
+                    verbose=verbose,
+                    background=background,
+                    pooled=pooled,
+                    resources=resources,
+                )
             )
 
+    failed = [c for c in ret_codes if c]
+    return failed[0] if failed else 0
+
 
 def inject(command: str) -> None:
     __xonsh__.shell.run_code(command)
@@ -1,5 +1,7 @@
 import builtins
+import hashlib
 import inspect
+import json
 import os
 import re
 import sys
@@ -8,23 +10,28 @@ import sys
 import typing
 from abc import ABC, abstractmethod
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from copy import copy, deepcopy
+from copy import deepcopy
 from dataclasses import dataclass, field, is_dataclass
 from functools import wraps
+from getpass import getpass
 from itertools import product
 from pathlib import Path
-from threading import Lock, Thread
-from time import sleep
-from types import FrameType, MethodType, ModuleType
+from threading import Lock, Thread, local
+from time import monotonic, sleep
+from types import CodeType, FrameType, MappingProxyType, MethodType, ModuleType
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     ClassVar,
     Dict,
+    FrozenSet,
     Generic,
+    Iterator,
     List,
+    Mapping,
     Optional,
     Tuple,
     Type,
@@ -34,21 +41,26 @@ from typing import (
 )
 
 import envium
-from envium import computed_env_var, env_var
+from envium import comp, env_var
+from envium.exceptions import EnviumError, RedefinedVarError, ValidationErrors
+from envium.vars import ComputedMixin, FinalVar
 from rhei import Stopwatch
 from watchdog import events
 from watchdog.events import FileModifiedEvent
 
-from envo import logger, misc
+from envo import console, devops, logger, misc
+from envo.index import get_env_index
 from envo.logs import Logger
 from envo.misc import (
     Callback,
     EnvoError,
     FilesWatcher,
+    PathList,
     event_dispatcher,
-    import_env_from_file,
     import_from_file,
 )
+from envo.secrets_cache import SecretsCache
+from envo.stats import command_stats
 from envo.status import Status
 
 __all__ = [
@@ -66,6 +78,17 @@ __all__ = [
     "boot_code",
     "Namespace",
     "Source",
+    "ComputedEnvVar",
+    "computed_env_var",
+    "PathVar",
+    "path_var",
+    "SecretVar",
+    "ComputedSecretVar",
+    "secret",
+    "computed_secret",
+    "TaskGraph",
+    "MagicFunctionsRegistry",
+    "magic_functions_registry",
 ]
 
 T = TypeVar("T")
@@ -91,6 +114,8 @@ class MagicFunction:
     type: str
     namespace: str = ""
     expected_fun_args = None
+    # record invocations in command stats
+    record_stats = True
 
     def __new__(cls, *args, **kwargs) -> Callable:
         if callable(args[0]):
@@ -116,15 +141,29 @@ class MagicFunction:
             return decor
 
     @classmethod
-    def _call(cls, fun: Callable, fun_args, fun_kwargs, args, kwargs):
+    def _get_fun_args(cls, fun_args: Tuple[Any, ...]) -> Tuple[Any, ...]:
         if not fun_args or not isinstance(fun_args[0], Env):
             if fun_args and fun_args[0] == "__env__":
                 fun_args = (builtins.__env__, *fun_args[1:])
             else:
                 fun_args = (builtins.__env__, *fun_args)
+        return fun_args
+
+    @classmethod
+    def _get_name(cls, fun: Callable) -> str:
+        return f"{cls.namespace}.{fun.__name__}" if cls.namespace else fun.__name__
+
+    @classmethod
+    def _call(cls, fun: Callable, fun_args, fun_kwargs, args, kwargs):
+        fun_args = cls._get_fun_args(fun_args)
         try:
-            with cls._context(fun_args[0], *args, **kwargs):
-                ret = fun(*fun_args, **fun_kwargs)
+            if not cls.record_stats:
+                with cls._context(fun_args[0], *args, **kwargs):
+                    return fun(*fun_args, **fun_kwargs)
+
+            with command_stats.measure(cls.type, cls._get_name(fun), (fun_args[1:], fun_kwargs)):
+                with cls._context(fun_args[0], *args, **kwargs):
+                    ret = fun(*fun_args, **fun_kwargs)
             return ret
         except BaseException as e:
             sys.stderr.write("\n")
@@ -140,21 +179,337 @@ class MagicFunction:
         wrapped.mfd.expected_fun_args = cls.expected_fun_args
 
     @contextmanager
-    def _context(self, *args, **kwargs) -> None:
+    def _context(self, *args: Any, **kwargs: Any) -> Iterator[None]:
         yield
 
 
+class CommandCache:
+    """
+    Make-like cache of command results.
+
+    Command is up to date if its inputs, arguments and env variables didn't change since the last successful run
+    and outputs are still there untouched.
+    """
+
+    def __init__(self, env: "Env", name: str, inputs: List[str], outputs: List[str]) -> None:
+        self.env = env
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+
+        self.record_file = env.get_cache_dir() / "commands" / f"{name}.json"
+
+    def _get_files_state(self, globs: List[str]) -> Optional[List[Tuple[str, int, int]]]:
+        ret = []
+        for g in globs:
+            paths = sorted(p for p in self.env.meta.root.glob(g) if p.is_file())
+            if not paths:
+                return None
+
+            for p in paths:
+                stat = p.stat()
+                ret.append((str(p), stat.st_mtime_ns, stat.st_size))
+
+        return ret
+
+    def get_fingerprint(self, arguments: Dict[str, Any]) -> str:
+        # arguments are bound to their names so positional and keyword calls match, default=str keeps
+        # paths and other simple objects stable across runs
+        content = json.dumps(
+            [
+                self.name,
+                arguments,
+                self._get_files_state(self.inputs),
+                self.env.get_env_vars(),
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+    def _load_record(self) -> Optional[Dict[str, Any]]:
+        try:
+            record: Dict[str, Any] = json.loads(self.record_file.read_text("utf-8"))
+        except (OSError, ValueError):
+            return None
+
+        return record
+
+    def is_up_to_date(self, fingerprint: str) -> bool:
+        record = self._load_record()
+        if not record or record["fingerprint"] != fingerprint:
+            return False
+
+        outputs_state = self._get_files_state(self.outputs)
+        if outputs_state is None:
+            return False
+
+        return bool([list(s) for s in outputs_state] == record["outputs"])
+
+    def save(self, fingerprint: str) -> None:
+        outputs_state = self._get_files_state(self.outputs) or []
+        record = {"fingerprint": fingerprint, "outputs": [list(s) for s in outputs_state]}
+
+        self.record_file.parent.mkdir(parents=True, exist_ok=True)
+        self.record_file.write_text(json.dumps(record), "utf-8")
+
+    def clear(self) -> None:
+        if self.record_file.exists():
+            self.record_file.unlink()
+
+
+class TaskGraph:
+    """
+    Runs dependencies of a command (declared with command(depends=[...])).
+
+    Independent commands are run concurrently and every command is run only once per graph run
+    even if many commands depend on it. Timings and the critical path are printed at the end.
+    """
+
+    @dataclass
+    class Node:
+        name: str
+        fun: Optional[Callable]
+        depends: List[str]
+        start: Optional[float] = None
+        end: Optional[float] = None
+
+        @property
+        def duration(self) -> float:
+            return (self.end or 0.0) - (self.start or 0.0)
+
+    _local = local()
+
+    def __init__(self, env: "Env", name: str, depends: List[str], workers: Optional[int] = None) -> None:
+        self.env = env
+        self.workers = workers
+
+        self._commands = magic_functions_registry.collect(env.__class__)["command"]
+
+        self.root = self.Node(name=name, fun=None, depends=list(depends))
+        self.nodes: Dict[str, TaskGraph.Node] = OrderedDict()
+        self._add_dependencies(self.root, stack=[name])
+
+        self._sw = Stopwatch()
+
+    @classmethod
+    def is_running(cls) -> bool:
+        """
+        Return True if called from a command run by a graph.
+        """
+        return getattr(cls._local, "running", False)
+
+    def _add_dependencies(self, node: Node, stack: List[str]) -> None:
+        for d in node.depends:
+            if d in stack:
+                raise EnvoError(f"Circular command dependency ({' -> '.join(stack + [d])})")
+
+            if d in self.nodes:
+                continue
+
+            fun = self._commands.get(d)
+            if not fun:
+                raise EnvoError(f'Command "{node.name}" depends on unknown command "{d}"')
+
+            dependency = self.Node(name=d, fun=fun, depends=list(getattr(fun, mfd_field).depends))
+            self.nodes[d] = dependency
+            self._add_dependencies(dependency, stack + [d])
+
+    def _run_node(self, node: Node) -> None:
+        logger.debug(lambda: f'Running "{node.name}" task')
+        self._local.running = True
+        node.start = self._sw.value
+        try:
+            cast(Callable, node.fun)(self.env)
+        finally:
+            node.end = self._sw.value
+            self._local.running = False
+
+    def _run_dependencies(self) -> None:
+        done: List[str] = []
+        futures: Dict[Future, TaskGraph.Node] = {}
+        error: Optional[BaseException] = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def submit_ready() -> None:
+                running = [n.name for n in futures.values()]
+                for n in self.nodes.values():
+                    if n.name in done or n.name in running:
+                        continue
+                    if all(d in done for d in n.depends):
+                        futures[executor.submit(self._run_node, n)] = n
+
+            submit_ready()
+            while futures:
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    node = futures.pop(f)
+                    if f.exception():
+                        error = error or f.exception()
+                    else:
+                        done.append(node.name)
+
+                if not error:
+                    submit_ready()
+
+        if error:
+            raise error
+
+    def get_critical_path(self) -> List[Node]:
+        ret = [self.root]
+        node = self.root
+        while node.depends:
+            node = max((self.nodes[d] for d in node.depends), key=lambda n: n.end or 0.0)
+            ret.insert(0, node)
+
+        return ret
+
+    def print_report(self) -> None:
+        name_width = max(len(n.name) for n in [*self.nodes.values(), self.root])
+        lines = [f"{n.name:<{name_width}} {n.duration:.2f}s" for n in [*self.nodes.values(), self.root]]
+
+        critical_path = self.get_critical_path()
+        critical_path_duration = (critical_path[-1].end or 0.0) - (critical_path[0].start or 0.0)
+        lines.append(f"Critical path: {' -> '.join(n.name for n in critical_path)} ({critical_path_duration:.2f}s)")
+        console.print("\n".join(lines), highlight=False)
+
+    def run(self, fun: Callable[[], T]) -> T:
+        """
+        Run dependencies and then fun (body of the root command).
+        """
+        cwd = Path(".").absolute()
+        # commands share the working directory so concurrent ones have to agree on it
+        os.chdir(str(self.env.meta.root))
+
+        self._sw.start()
+        try:
+            self._run_dependencies()
+
+            self.root.start = self._sw.value
+            try:
+                ret = fun()
+            finally:
+                self.root.end = self._sw.value
+        finally:
+            os.chdir(str(cwd))
+
+        self.print_report()
+        return ret
+
+
 @dataclass
 class command(MagicFunction):
+    """
+    Command callable from the shell.
+
+    :param inputs: globs (relative to env root) of files the command depends on
+    :param outputs: globs (relative to env root) of files the command produces
+    :param cache: skip the command if nothing changed since the last successful run, pass force=True (--force) to
+    run anyway
+    :param depends: commands (namespaced names, e.g. "p.flake") run before this one, independent ones concurrently
+    """
+
     type = "command"
 
-    def __new__(cls, in_root: Optional[bool] = True, cd_back: Optional[bool] = True) -> Callable:
-        ret = super().__new__(cls, in_root, cd_back)
+    def __new__(
+        cls,
+        in_root: Optional[bool] = True,
+        cd_back: Optional[bool] = True,
+        inputs: Optional[List[str]] = None,
+        outputs: Optional[List[str]] = None,
+        cache: bool = False,
+        depends: Optional[List[str]] = None,
+    ) -> Callable:
+        ret = super().__new__(cls, in_root, cd_back, inputs=inputs, outputs=outputs, cache=cache, depends=depends)
+        return ret
+
+    @classmethod
+    def _inject_data(cls, wrapped: Callable, *args: Any, **kwargs: Any) -> None:
+        super()._inject_data(wrapped, *args, **kwargs)
+        mfd = getattr(wrapped, mfd_field)
+        mfd.inputs = kwargs.get("inputs") or []
+        mfd.outputs = kwargs.get("outputs") or []
+        mfd.cache = kwargs.get("cache", False)
+        mfd.depends = kwargs.get("depends") or []
+
+        if mfd.cache:
+            # let fire know about the extra flag
+            signature = inspect.signature(wrapped)
+            if "force" in signature.parameters:
+                raise EnvoError(
+                    f'Cached command "{wrapped.__name__}" can\'t define "force" argument, it\'s added by the cache'
+                )
+
+            parameters = list(signature.parameters.values())
+            force = inspect.Parameter("force", inspect.Parameter.KEYWORD_ONLY, default=False, annotation=bool)
+            if parameters and parameters[-1].kind == inspect.Parameter.VAR_KEYWORD:
+                parameters.insert(len(parameters) - 1, force)
+            else:
+                parameters.append(force)
+            setattr(wrapped, "__signature__", signature.replace(parameters=parameters))
+
+    @classmethod
+    def _call(
+        cls,
+        fun: Callable,
+        fun_args: Tuple[Any, ...],
+        fun_kwargs: Dict[str, Any],
+        args: Tuple[Any, ...],
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        if kwargs.get("depends") and not TaskGraph.is_running():
+            fun_args = cls._get_fun_args(fun_args)
+            graph = TaskGraph(env=fun_args[0], name=cls._get_name(fun), depends=kwargs["depends"])
+            return graph.run(lambda: cls._call_cached(fun, fun_args, fun_kwargs, args, kwargs))
+
+        return cls._call_cached(fun, fun_args, fun_kwargs, args, kwargs)
+
+    @classmethod
+    def _get_arguments(cls, fun: Callable, fun_args: Tuple[Any, ...], fun_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        signature = inspect.signature(fun)
+        bound = signature.bind(*fun_args, **fun_kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        # skip env
+        arguments.pop(next(iter(signature.parameters)))
+        return arguments
+
+    @classmethod
+    def _call_cached(
+        cls,
+        fun: Callable,
+        fun_args: Tuple[Any, ...],
+        fun_kwargs: Dict[str, Any],
+        args: Tuple[Any, ...],
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        if not kwargs.get("cache"):
+            return super()._call(fun, fun_args, fun_kwargs, args, kwargs)
+
+        fun_args = cls._get_fun_args(fun_args)
+        force = fun_kwargs.pop("force", False)
+
+        name = cls._get_name(fun)
+        cache = CommandCache(
+            env=fun_args[0], name=name, inputs=kwargs.get("inputs") or [], outputs=kwargs.get("outputs") or []
+        )
+        fingerprint = cache.get_fingerprint(cls._get_arguments(fun, fun_args, fun_kwargs))
+
+        if not force and cache.is_up_to_date(fingerprint):
+            logger.info(f"{name} is up to date")
+            return None
+
+        cache.clear()
+        ret = super()._call(fun, fun_args, fun_kwargs, args, kwargs)
+        cache.save(fingerprint)
         return ret
 
     @classmethod
     @contextmanager
-    def _context(cls, env: "Env", in_root: Optional[bool] = True, cd_back: Optional[bool] = True) -> None:
+    def _context(
+        cls, env: "Env", in_root: Optional[bool] = True, cd_back: Optional[bool] = True, **kwargs: Any
+    ) -> Iterator[None]:
         cwd = Path(".").absolute()
 
         if in_root:
@@ -166,6 +521,35 @@ class command(MagicFunction):
             os.chdir(str(cwd))
 
 
+@command(in_root=False, cd_back=False)  # type: ignore
+def bg_jobs(env: "Env") -> None:
+    """
+    List background jobs.
+    """
+    devops.background_jobs.print()
+
+
+@command(in_root=False, cd_back=False)  # type: ignore
+def bg_wait(env: "Env", job_id: Optional[int] = None, timeout: Optional[float] = None) -> None:
+    """
+    Wait for background job (all jobs by default).
+    """
+    for i, ret_code in devops.background_jobs.wait(job_id, timeout=timeout).items():
+        print(f"[{i}] {'still running' if ret_code is None else f'exited ({ret_code})'}")
+
+
+@command(in_root=False, cd_back=False)  # type: ignore
+def bg_kill(env: "Env", job_id: Optional[int] = None) -> None:
+    """
+    Kill background job (all jobs by default).
+    """
+    devops.background_jobs.kill(job_id)
+
+
+# Shell commands (not named jobs/wait/kill so they don't shadow the shell builtins)
+builtin_commands = {"bg_jobs": bg_jobs, "bg_wait": bg_wait, "bg_kill": bg_kill}
+
+
 class boot_code(MagicFunction):  # noqa: N801
     type: str = "boot_code"
 
@@ -209,11 +593,14 @@ class precmd(cmd_hook):  # noqa: N801
 class onstdout(cmd_hook):  # noqa: N801
     type: str = "onstdout"
     expected_fun_args = ["command", "out"]
+    # called on every write
+    record_stats = False
 
 
 class onstderr(cmd_hook):  # noqa: N801
     type: str = "onstderr"
     expected_fun_args = ["command", "out"]
+    record_stats = False
 
 
 class postcmd(cmd_hook):  # noqa: N801
@@ -275,6 +662,136 @@ class Source:
         self.root = self.root.resolve()
 
 
+MagicFunctionsTable = Mapping[str, Mapping[str, Callable]]
+
+
+class MagicFunctionsRegistry:
+    """
+    Magic functions declared on env classes.
+
+    Scanning a class is expensive (dir() + static attribute lookups for every attribute) so results are cached
+    per class and invalidated when source file of any class in its mro changes.
+    """
+
+    types: ClassVar[List[str]] = [
+        "shell_context",
+        "precmd",
+        "onstdout",
+        "onstderr",
+        "postcmd",
+        "onload",
+        "oncreate",
+        "ondestroy",
+        "onunload",
+        "boot_code",
+        "command",
+    ]
+
+    # class id -> (fingerprint, [(attribute name, magic function type, namespaced name)])
+    _scans: Dict[str, Tuple[Tuple, List[Tuple[str, str, str]]]]
+    _excluded_names: Optional[FrozenSet[str]]
+
+    def __init__(self) -> None:
+        self._scans = {}
+        self._excluded_names = None
+        self._lock = Lock()
+
+    @staticmethod
+    def _get_class_id(cls: type) -> str:
+        return f"{cls.__module__}:{cls.__qualname__}"
+
+    @staticmethod
+    def _get_file_fingerprint(cls: type) -> Optional[Tuple[str, int, int]]:
+        module = sys.modules.get(cls.__module__)
+        # modules imported with import_from_file are not in sys.modules but are named after their path
+        file = getattr(module, "__file__", None) or cls.__module__
+
+        try:
+            stat = os.stat(file)
+        except (OSError, ValueError):
+            return None
+
+        return file, stat.st_mtime_ns, stat.st_size
+
+    def _get_fingerprint(self, cls: type) -> Optional[Tuple]:
+        # classes defined outside of files (exec, interactive etc.) can't be tracked
+        if cls.__module__ != "builtins" and self._get_file_fingerprint(cls) is None:
+            return None
+
+        return tuple((self._get_class_id(c), self._get_file_fingerprint(c)) for c in cls.__mro__)
+
+    def _get_excluded_names(self) -> FrozenSet[str]:
+        if self._excluded_names is None:
+            self._excluded_names = frozenset(
+                f for f in dir(ShellEnv) if inspect.isdatadescriptor(inspect.getattr_static(ShellEnv, f))
+            )
+        return self._excluded_names
+
+    def _scan(self, cls: type) -> List[Tuple[str, str, str]]:
+        excluded_names = self._get_excluded_names()
+
+        ret = []
+        for f in dir(cls):
+            if f in excluded_names:
+                continue
+
+            attr = inspect.getattr_static(cls, f)
+
+            if hasattr(attr, mfd_field):
+                namespaced_name = f"{attr.mfd.namespace}.{f}" if attr.mfd.namespace else f
+                ret.append((f, attr.mfd.type, namespaced_name))
+
+        return ret
+
+    def _get_scan(self, cls: type) -> List[Tuple[str, str, str]]:
+        fingerprint = self._get_fingerprint(cls)
+        if fingerprint is None:
+            return self._scan(cls)
+
+        class_id = self._get_class_id(cls)
+
+        with self._lock:
+            cached = self._scans.get(class_id)
+            if cached and cached[0] == fingerprint:
+                return cached[1]
+
+        scan = self._scan(cls)
+
+        with self._lock:
+            self._scans[class_id] = (fingerprint, scan)
+
+        return scan
+
+    def collect(self, env_class: Type["Env"]) -> Dict[str, Dict[str, Callable]]:
+        """
+        Return magic functions of env_class grouped by type and keyed by namespaced name.
+        """
+        ret: Dict[str, Dict[str, Callable]] = {t: {} for t in self.types}
+
+        for c in reversed(env_class.__mro__):
+            for f, type_, namespaced_name in self._get_scan(c):
+                # Scans are shared between reloads so objects are always taken from the current class
+                ret[type_][namespaced_name] = inspect.getattr_static(c, f)
+
+        return ret
+
+    def get(self, env_class: Type["Env"]) -> MagicFunctionsTable:
+        """
+        Return read-only view of magic functions of env_class.
+        """
+        return MappingProxyType({t: MappingProxyType(fs) for t, fs in self.collect(env_class).items()})
+
+    def invalidate(self, cls: Optional[type] = None) -> None:
+        with self._lock:
+            if cls:
+                self._scans.pop(self._get_class_id(cls), None)
+            else:
+                self._scans.clear()
+
+
+magic_functions_registry = MagicFunctionsRegistry()
+
+
 class EnvReloader:
     @dataclass
     class Callbacks:
@@ -315,13 +832,26 @@ class EnvReloader:
             w.calls = FilesWatcher.Callbacks(on_event=self.calls.on_env_edit)
             self.env_watchers.append(w)
 
+        # resolved root -> (root, name)
+        roots: Dict[Path, Tuple[Path, str]] = OrderedDict()
         for p in self.li.shell_env.env.get_user_envs():
+            roots.setdefault(p.Meta.root.resolve(), (p.Meta.root, p.__name__))
+
+        # parents imported in a way that's not visible in the class hierarchy
+        env = self.li.shell_env.env
+        index = get_env_index(env.meta.root)
+        if index:
+            for n in index.get_chain(env.get_env_path().resolve()):
+                root = Path(n.path).parent
+                roots.setdefault(root, (root, root.name))
+
+        for root, name in roots.values():
             watcher = FilesWatcher(
                 FilesWatcher.Sets(
-                    root=p.Meta.root,
+                    root=root,
                     include=self.se.watch_files + ["env_*.py"],
                     exclude=self.se.ignore_files + [r"**/.*", r"**/*~", r"**/__pycache__"],
-                    name=p.__name__,
+                    name=name,
                 ),
                 calls=FilesWatcher.Callbacks(on_event=self.calls.on_env_edit),
             )
@@ -335,6 +865,383 @@ class EnvReloader:
             w.stop()
 
 
+class EnvVarsTracker:
+    """
+    Caches materialized env vars.
+
+    Every var is converted to string (and validated) only when it's dirty. Var gets dirty when it's assigned,
+    modified in place (lists) or when any var its computed value was calculated from gets dirty.
+    """
+
+    _tracked_classes: ClassVar[Dict[type, type]] = {}
+
+    def __init__(self, environ: envium.Environ) -> None:
+        self.flat: List[envium.environ.EnvVar] = environ._flat
+        self.names: Dict[FinalVar, str] = {v: v._get_env_name() for v in self.flat}
+        self.by_fullname: Dict[str, FinalVar] = {v._fullname: v for v in self.flat}
+
+        self.dirty: typing.Set[FinalVar] = set(self.flat)
+        self.dependants: Dict[FinalVar, typing.Set[FinalVar]] = {}
+        # values of mutable vars as they were materialized
+        self.snapshots: Dict[FinalVar, Any] = {}
+        self.env_vars: Dict[str, str] = {}
+        # computed vars being evaluated with vars they read
+        self._computing: List[Tuple[FinalVar, typing.Set[FinalVar]]] = []
+
+        for v in self.flat:
+            v.__class__ = self._get_tracked_class(v.__class__)
+            object.__setattr__(v, "_tracker", self)
+
+    @classmethod
+    def _get_tracked_class(cls, var_class: Type[FinalVar]) -> type:
+        """
+        Return subclass of var_class reporting reads and writes to the tracker.
+        """
+        if getattr(var_class, "_tracked", False):
+            return var_class
+
+        if var_class not in cls._tracked_classes:
+
+            def _get_value(self: Any) -> Any:
+                self._tracker.on_read(self)
+                return var_class._get_value(self)
+
+            def _set_value(self: Any, new_value: Any) -> None:
+                var_class._set_value(self, new_value)
+                self._tracker.on_write(self)
+
+            # single inheritance so instances can be switched to it
+            attrs = {"_tracked": True, "_get_value": _get_value, "_set_value": _set_value}
+            cls._tracked_classes[var_class] = type(var_class.__name__, (var_class,), attrs)
+
+        return cls._tracked_classes[var_class]
+
+    def on_read(self, var: FinalVar) -> None:
+        if not self._computing:
+            return
+
+        computed, reads = self._computing[-1]
+        if computed is not var:
+            self.dependants.setdefault(var, set()).add(computed)
+            reads.add(var)
+
+    @contextmanager
+    def computing(self, var: FinalVar) -> typing.Iterator[typing.Set[FinalVar]]:
+        """
+        Collect vars read by computed var.
+        """
+        reads: typing.Set[FinalVar] = set()
+        self._computing.append((var, reads))
+        try:
+            yield reads
+        finally:
+            self._computing.pop()
+
+    def on_write(self, var: FinalVar) -> None:
+        self.mark_dirty(var)
+
+    def mark_dirty(self, var: FinalVar) -> None:
+        to_mark = [var]
+        while to_mark:
+            v = to_mark.pop()
+            if v in self.dirty:
+                continue
+            self.dirty.add(v)
+            to_mark.extend(self.dependants.get(v, []))
+
+    @staticmethod
+    def _get_snapshot(value: List[Any]) -> Any:
+        # value of path list depends also on which paths exist
+        return value.to_env_value() if isinstance(value, PathList) else tuple(value)
+
+    def _check_snapshots(self) -> None:
+        for v, snapshot in self.snapshots.items():
+            if v not in self.dirty and self._get_snapshot(v._get_value()) != snapshot:
+                self.mark_dirty(v)
+
+    def _materialize(self, var: FinalVar) -> Tuple[List[EnviumError], Any]:
+        if not isinstance(var, ComputedMixin):
+            return var._get_errors(), var._get_value()
+
+        with self.computing(var):
+            return var._get_errors(), var._get_value()
+
+    def get_env_vars(self) -> Dict[str, str]:
+        self._check_snapshots()
+
+        if not self.dirty:
+            return self.env_vars.copy()
+
+        dirty = [v for v in self.flat if v in self.dirty]
+        values = {}
+        errors = []
+        for v in dirty:
+            var_errors, values[v] = self._materialize(v)
+            errors.extend(var_errors)
+
+        if errors:
+            raise ValidationErrors(errors)
+
+        for v, value in values.items():
+            if isinstance(value, list):
+                if not isinstance(v, ComputedMixin):
+                    self.snapshots[v] = self._get_snapshot(value)
+
+                if isinstance(value, PathList):
+                    value = value.to_env_value()
+                else:
+                    value = comp.list_delimiter.join([str(i) for i in value])
+            else:
+                self.snapshots.pop(v, None)
+                value = str(value)
+
+            self.env_vars[self.names[v]] = value
+
+        self.dirty.clear()
+        return self.env_vars.copy()
+
+
+class PathVar(envium.environ.EnvVar):
+    """
+    Env var holding PathList (PATH like variable).
+    """
+
+    def __init__(self, *, raw: Union[bool, str] = False, drop_missing: bool = True) -> None:
+        super().__init__(default_factory=lambda: PathList(drop_missing=drop_missing), raw=raw)
+        self._drop_missing = drop_missing
+
+    def _from_str(self, env_value: str) -> PathList:
+        return PathList(env_value.split(os.pathsep), drop_missing=self._drop_missing)
+
+    def _set_value(self, new_value: Any) -> None:
+        if isinstance(new_value, list) and not isinstance(new_value, PathList):
+            new_value = PathList(new_value, drop_missing=self._drop_missing)
+        super()._set_value(new_value)
+
+
+def path_var(raw: Union[bool, str] = False, drop_missing: bool = True) -> Any:
+    """
+    Env var holding ordered set of paths. See PathList.
+
+    :param drop_missing: skip paths that don't exist in the variable value
+    """
+    return PathVar(raw=raw, drop_missing=drop_missing)
+
+
+def _get_code_key(code: CodeType) -> Tuple[Any, ...]:
+    consts = tuple(_get_code_key(c) if isinstance(c, CodeType) else c for c in code.co_consts)
+    return code.co_code, consts, code.co_names
+
+
+class ComputedEnvVar(envium.environ.ComputedEnvVar):
+    """
+    Lazily computed env var.
+
+    Value is computed on the first use and memoized (also between env reloads). It's recomputed only when
+    the getter code or vars it read changed, or when ttl (seconds) passed.
+    """
+
+    @dataclass
+    class Memo:
+        code_key: Tuple[Any, ...]
+        # fullname -> repr of the value
+        deps: Dict[str, str]
+        value: Any
+        computed_at: float
+
+    memos: ClassVar[Dict[str, Memo]] = {}
+
+    def __init__(
+        self,
+        fget: Optional[Callable] = None,
+        fset: Optional[Callable] = None,
+        *,
+        raw: Union[bool, str] = False,
+        ttl: Optional[float] = None,
+    ) -> None:
+        super().__init__(fget, fset, raw=raw)
+        self._ttl = ttl
+
+    def _init_value(self) -> None:
+        # computed on the first use
+        pass
+
+    def _get_memo_key(self) -> str:
+        root_class = type(self._root)
+        return f"{root_class.__module__}.{root_class.__qualname__}:{self._fullname}"
+
+    def _get_code_key(self, fget: Callable) -> Tuple[Any, ...]:
+        fget = inspect.unwrap(fget)
+        if not hasattr(fget, "__code__"):
+            return (id(fget),)
+
+        globals_ = fget.__globals__
+        # module level constants used by the getter
+        constants = tuple(
+            (n, globals_[n])
+            for n in fget.__code__.co_names
+            if n in globals_ and isinstance(globals_[n], (str, int, float, bool, type(None)))
+        )
+        return _get_code_key(fget.__code__), constants
+
+    def _is_memo_valid(self, memo: Memo, tracker: EnvVarsTracker, code_key: Tuple[Any, ...]) -> bool:
+        if memo.code_key != code_key:
+            return False
+
+        if self._ttl is not None and monotonic() - memo.computed_at > self._ttl:
+            return False
+
+        for name, value in memo.deps.items():
+            var = tracker.by_fullname.get(name)
+            if var is None or repr(var._get_value()) != value:
+                return False
+
+        return True
+
+    def _get_value(self) -> Any:
+        tracker: Optional[EnvVarsTracker] = getattr(self._root, "_tracker", None)
+        if not self._fget or not tracker:
+            return super()._get_value()
+
+        key = self._get_memo_key()
+        code_key = self._get_code_key(self._fget)
+
+        with tracker.computing(self) as reads:
+            memo = self.memos.get(key)
+            if memo and self._is_memo_valid(memo, tracker, code_key):
+                return memo.value
+
+            reads.clear()
+            object.__setattr__(self, "_ready", False)
+            try:
+                value = self._fget(self._root)
+            finally:
+                object.__setattr__(self, "_ready", True)
+
+            deps = {v._fullname: repr(v._get_value()) for v in list(reads)}
+
+        self.memos[key] = self.Memo(code_key=code_key, deps=deps, value=value, computed_at=monotonic())
+        return value
+
+
+def computed_env_var(
+    fget: Optional[Callable] = None,
+    fset: Optional[Callable] = None,
+    raw: Union[bool, str] = False,
+    ttl: Optional[float] = None,
+) -> Any:
+    """
+    Env var computed by fget. See ComputedEnvVar.
+
+    :param ttl: seconds after which the value is recomputed, for values depending on external state
+    """
+    return ComputedEnvVar(fget, fset, raw=raw, ttl=ttl)
+
+
+class SecretVar(envium.secrets.SecretVar):
+    """
+    Secret stored in the env secrets cache (if enabled) for ttl seconds.
+    """
+
+    def __init__(
+        self,
+        default: Optional[Any] = None,
+        default_factory: Optional[Callable] = None,
+        value_from_input: bool = True,
+        ttl: Optional[float] = None,
+    ) -> None:
+        super().__init__(default=default, default_factory=default_factory, value_from_input=value_from_input)
+        self._ttl = ttl
+
+
+class ComputedSecretVar(envium.secrets.ComputedSecretVar):
+    """
+    Lazily computed secret.
+
+    Value is computed on the first access (not when the env is created) and stored in the env secrets
+    cache (if enabled) for ttl seconds.
+    """
+
+    def __init__(
+        self,
+        fget: Optional[Callable] = None,
+        fset: Optional[Callable] = None,
+        value_from_input: bool = True,
+        ttl: Optional[float] = None,
+    ) -> None:
+        super().__init__(fget=fget, fset=fset, value_from_input=value_from_input)
+        self._ttl = ttl
+        self._resolved = False
+
+    def _init_value(self) -> None:
+        # computed on the first access
+        pass
+
+    def _get_value(self) -> Any:
+        if not self._fget:
+            return super()._get_value()
+
+        if self._resolved:
+            return self._value
+
+        root = self._root
+        cache: Optional[SecretsCache] = getattr(root, "_cache", None)
+        found, value = cache.get(self._fullname) if cache else (False, None)
+        if not found:
+            value = super()._get_value()
+            if cache and isinstance(root, Env.Secrets):
+                cache.set(self._fullname, value, root._get_ttl(self))
+
+        object.__setattr__(self, "_value", value)
+        object.__setattr__(self, "_resolved", True)
+        return value
+
+    def _set_value(self, new_value: Any) -> None:
+        super()._set_value(new_value)
+        if not self._fget:
+            return
+
+        # fget might depend on the new value
+        object.__setattr__(self, "_resolved", False)
+        cache: Optional[SecretsCache] = getattr(self._root, "_cache", None)
+        if cache:
+            cache.delete(self._fullname)
+
+    def _get_errors(self) -> List[EnviumError]:
+        # not validated until used
+        if self._fget and not self._resolved:
+            return []
+        return super()._get_errors()
+
+
+def secret(
+    default: Optional[Any] = None,
+    default_factory: Optional[Callable] = None,
+    value_from_input: bool = True,
+    ttl: Optional[float] = None,
+) -> Any:
+    """
+    :param ttl: seconds the value is kept in the secrets cache, Meta.secrets_ttl if None
+    """
+    if default:
+        value_from_input = False
+    return SecretVar(default=default, default_factory=default_factory, value_from_input=value_from_input, ttl=ttl)
+
+
+def computed_secret(
+    fget: Optional[Callable] = None,
+    fset: Optional[Callable] = None,
+    value_from_input: bool = True,
+    ttl: Optional[float] = None,
+) -> Any:
+    """
+    Secret computed by fget. See ComputedSecretVar.
+
+    :param ttl: seconds the value is kept in the secrets cache, Meta.secrets_ttl if None
+    """
+    return ComputedSecretVar(fget=fget, fset=fset, value_from_input=value_from_input, ttl=ttl)
+
+
 class BaseEnv(ABC):
     class Meta:
         pass
@@ -366,20 +1273,76 @@ class Env(BaseEnv):
         ignore_files: List[str] = []
         verbose_run: bool = True
         load_env_vars: bool = False
+        # default resources of commands run with run(), run_get() etc.
+        run_resources: Optional[devops.Resources] = None
+        # keep secrets in an encrypted cache so they're not asked for (or computed) in every envo process
+        secrets_cache: bool = False
+        # seconds secrets are kept in the cache (unless set per secret), forever if None
+        secrets_ttl: Optional[float] = 8 * 3600
 
     class Environ(envium.Environ):
-        pythonpath: Optional[List[PathLike]] = env_var(raw=True, default_factory=list)
-        path: Optional[List[PathLike]] = env_var(raw=True, default_factory=list)
+        pythonpath: Optional[List[PathLike]] = path_var(raw=True)
+        path: Optional[List[PathLike]] = path_var(raw=True)
         root: Optional[Path] = env_var()
         stage: Optional[str] = env_var()
         envo_stage: Optional[str] = env_var(raw=True)
         envo_name: Optional[str] = env_var(raw=True)
 
+        _tracker: EnvVarsTracker
+
+        def _process(self) -> None:
+            super()._process()
+            object.__setattr__(self, "_tracker", EnvVarsTracker(self))
+
+        def _get_env_vars(self) -> Dict[str, str]:
+            return self._tracker.get_env_vars()
+
+        @property
+        def errors(self) -> List[EnviumError]:
+            ret: List[EnviumError] = []
+            env_names = set()
+            for v in self._tracker.flat:
+                env_name = self._tracker.names[v]
+                if env_name in env_names:
+                    ret.append(RedefinedVarError(env_name))
+                env_names.add(env_name)
+
+                ret.extend(v._get_errors())
+
+            return ret
+
     class Ctx(envium.Ctx):
         pass
 
     class Secrets(envium.Secrets):
-        pass
+        _cache: Optional[SecretsCache]
+        _ttl: Optional[float]
+
+        def __init__(self, name: str = "", cache: Optional[SecretsCache] = None, ttl: Optional[float] = None):
+            object.__setattr__(self, "_cache", cache)
+            object.__setattr__(self, "_ttl", ttl)
+            super().__init__(name)
+
+        def _get_ttl(self, var: FinalVar) -> Optional[float]:
+            ttl = getattr(var, "_ttl", None)
+            return ttl if ttl is not None else self._ttl
+
+        def _get_secrets_from_input(self) -> None:
+            for s in self._flat:
+                if not s._value_from_input:
+                    continue
+
+                # computed on the first access
+                if isinstance(s, ComputedMixin) and s._fget:
+                    continue
+
+                found, value = self._cache.get(s._fullname) if self._cache else (False, None)
+                if not found:
+                    value = s._from_str(getpass(f"{s._fullname}: "))
+                    if self._cache:
+                        self._cache.set(s._fullname, value, self._get_ttl(s))
+
+                setattr(s._parent, s._name, value)
 
     ctx: Ctx
     secrets: Secrets
@@ -389,6 +1352,21 @@ class Env(BaseEnv):
 
     env_id_to_secrets: ClassVar[Dict[str, Secrets]] = {}
 
+    @dataclass
+    class _CachedEnv:
+        # (path, mtime) of the env file and files of its parents
+        files: Tuple[Tuple[str, int], ...]
+        env: "Env"
+
+        def is_valid(self) -> bool:
+            try:
+                return all(os.stat(p).st_mtime_ns == mtime for p, mtime in self.files)
+            except OSError:
+                return False
+
+    # (env file, stage) -> env
+    _env_cache: ClassVar[Dict[Tuple[str, str], _CachedEnv]] = {}
+
     _shell: "Shell"
 
     def __init__(self):
@@ -411,7 +1389,7 @@ class Env(BaseEnv):
 
         self.ctx = self.Ctx(self.meta.name)
 
-        secrets = Env.env_id_to_secrets.get(self.id, self.Secrets(self.meta.name))
+        secrets = Env.env_id_to_secrets.get(self.id) or self._create_secrets()
         self.secrets = Env.env_id_to_secrets[self.id] = secrets
 
         self.init()
@@ -425,6 +1403,10 @@ class Env(BaseEnv):
 
             getattr(c, "post_init")(self)
 
+    def _create_secrets(self) -> Secrets:
+        cache = SecretsCache(self.get_cache_dir() / "secrets") if self.meta.secrets_cache else None
+        return self.Secrets(self.meta.name, cache=cache, ttl=self.meta.secrets_ttl)
+
     def _get_path_delimiter(self) -> str:
         if misc.is_linux() or misc.is_darwin():
             return ":"
@@ -470,7 +1452,7 @@ class Env(BaseEnv):
             msgs.append("Environ errors:\n" + f"\n".join([str(e) for e in self.e.errors]))
 
         if self.secrets.errors:
-            msgs.append("Secrets errors:\n" + f"\n".join([str(e) for e in self.e.errors]))
+            msgs.append("Secrets errors:\n" + f"\n".join([str(e) for e in self.secrets.errors]))
 
         msg = "\n".join(msgs)
 
@@ -499,7 +1481,14 @@ class Env(BaseEnv):
 
         return ret
 
-    def get_env(self, directory: Union[Path, str], stage: Optional[str] = None) -> "Env":
+    def get_env(self, directory: Union[Path, str], stage: Optional[str] = None, use_cache: bool = True) -> "Env":
+        """
+        Return env from another directory.
+
+        Envs are cached until their env file or any of their parents' files changes.
+
+        :param use_cache: import and create the env again even if it's cached
+        """
         stage = stage or self.meta.stage
         directory = Path(directory)
         env_file = directory / f"env_{stage}.py"
@@ -508,13 +1497,59 @@ class Env(BaseEnv):
             logger.traceback()
             raise EnvoError(f"{env_file} does not exit")
 
-        env = import_env_from_file(env_file).ThisEnv()
+        key = (str(env_file.resolve()), stage)
+        cached = Env._env_cache.get(key)
+        if use_cache and cached and cached.is_valid():
+            cached.env.activate()
+            return cached.env
+
+        # only env modules from the same directory could shadow the ones imported by the env file
+        misc.unload_env_modules(p.stem for p in directory.glob("env_*.py"))
+        env = import_from_file(env_file).ThisEnv()
+
+        files = [env_file.resolve()] + env._get_parent_files()
+        index = get_env_index(env_file.parent)
+        if index:
+            files += [Path(n.path) for n in index.get_chain(env_file.resolve())]
+        files = list(OrderedDict.fromkeys(files))
+        Env._env_cache[key] = Env._CachedEnv(files=tuple((str(f), f.stat().st_mtime_ns) for f in files), env=env)
         return env
 
+    @classmethod
+    def invalidate_env_cache(cls, directory: Optional[Union[Path, str]] = None) -> None:
+        """
+        Drop cached envs from directory (all if not given). See get_env.
+        """
+        if directory is None:
+            Env._env_cache.clear()
+            return
+
+        directory = Path(directory).resolve()
+        for key in [k for k in Env._env_cache if Path(k[0]).parent == directory]:
+            Env._env_cache.pop(key)
+
+    def _get_parent_files(self) -> List[Path]:
+        ret = []
+        for c in self.get_user_envs():
+            module = sys.modules.get(c.__module__)
+            module_file = getattr(module, "__file__", None)
+            if module_file:
+                ret.append(Path(module_file).resolve())
+
+        return ret
+
     @classmethod
     def get_env_path(cls) -> Path:
         return cls.Meta.root / f"env_{cls.Meta.stage}.py"
 
+    @classmethod
+    def get_cache_dir(cls) -> Path:
+        """
+        Return local cache directory of this env.
+        """
+        env_hash = hashlib.md5(str(cls.get_env_path()).encode("utf-8")).hexdigest()
+        return Path.home() / f".envo/cache/{env_hash}"
+
     def dump_dot_env(self) -> Path:
         """
         Dump .env file for the current environment.
@@ -530,11 +1565,12 @@ class Env(BaseEnv):
         if not self._environ_before:
             self._environ_before = os.environ.copy()
 
-        os.environ.update(**self.get_env_vars())
+        misc.update_environ(os.environ, self.get_env_vars())
 
     def deactivate(self) -> None:
         if self._environ_before:
-            os.environ = self._environ_before.copy()
+            # update in place so os.environ stays in sync with the process environment
+            misc.update_environ(os.environ, self._environ_before, remove_missing=True)
 
 
 class ShellEnv:
@@ -572,25 +1608,13 @@ class ShellEnv:
 
         self.env._shell = self._li.shell
 
-        self.magic_functions = {
-            "shell_context": {},
-            "precmd": {},
-            "onstdout": {},
-            "onstderr": {},
-            "postcmd": {},
-            "onload": {},
-            "oncreate": {},
-            "ondestroy": {},
-            "onunload": {},
-            "boot_code": {},
-            "command": {},
-        }
-
         if self.env.meta.verbose_run:
             os.environ["ENVO_VERBOSE_RUN"] = "True"
         elif os.environ.get("ENVO_VERBOSE_RUN"):
             os.environ.pop("ENVO_VERBOSE_RUN")
 
+        devops.default_resources = self.env.meta.run_resources
+
         self._exiting = False
         self._executing_cmd = False
 
@@ -604,7 +1628,7 @@ class ShellEnv:
         self._shell_environ_before = None
         self._collect_magic_functions()
 
-        self.logger.debug("Starting env", metadata={"root": self.env.meta.root, "stage": self.env.meta.stage})
+        self.logger.debug("Starting env", metadata=lambda: {"root": self.env.meta.root, "stage": self.env.meta.stage})
 
         self._li.shell.calls.pre_cmd = Callback(self._on_precmd)
         self._li.shell.calls.on_stdout = Callback(self._on_stdout)
@@ -698,7 +1722,8 @@ class ShellEnv:
 
             # set context
             self._li.shell.set_context(self._get_shell_context())
-            while sw.value <= 0.5:
+            # keep the loading prompt visible for a moment, nothing to show in headless mode
+            while not self._se.blocking and sw.value <= 0.5:
                 sleep(0.1)
 
             logger.debug("Finished load context thread")
@@ -713,27 +1738,9 @@ class ShellEnv:
         """
         Go through fields and transform decorated functions to commands.
         """
-
-        def hasattr_static(obj: Any, field: str) -> bool:
-            try:
-                inspect.getattr_static(obj, field)
-            except AttributeError:
-                return False
-            else:
-                return True
-
-        for c in reversed(self.env.__class__.__mro__):
-            for f in dir(c):
-                if hasattr_static(self.__class__, f) and inspect.isdatadescriptor(
-                    inspect.getattr_static(self.__class__, f)
-                ):
-                    continue
-
-                attr = inspect.getattr_static(c, f)
-
-                if hasattr(attr, mfd_field):
-                    namespaced_name = f"{attr.mfd.namespace}.{f}" if attr.mfd.namespace else f
-                    self.magic_functions[attr.mfd.type][namespaced_name] = attr
+        self.magic_functions = magic_functions_registry.collect(self.env.__class__)
+        for name, c in builtin_commands.items():
+            self.magic_functions["command"].setdefault(name, c)
 
     def _get_shell_context(self) -> Dict[str, Any]:
         shell_context = {}
@@ -759,10 +1766,12 @@ class ShellEnv:
 
     def _on_destroy(self) -> None:
         functions = self.magic_functions["ondestroy"]
-        for h in functions.values():
-            h()
-
-        self._exit()
+        try:
+            for h in functions.values():
+                h()
+        finally:
+            devops.background_jobs.cleanup()
+            self._exit()
 
     def _on_env_edit(self, event: FileModifiedEvent) -> None:
         if not self._li.status.ready:
@@ -814,9 +1823,14 @@ class ShellEnv:
 
         :param owner_namespace:
         """
+        shell_environ = self._li.shell.environ
         if not self._shell_environ_before:
-            self._shell_environ_before = dict(self._li.shell.environ.items())
-        self._li.shell.environ.update(**self.env.get_env_vars())
+            self._shell_environ_before = dict(shell_environ.items())
+
+        # every change of the shell environ fires events and invalidates caches
+        to_set, _ = misc.get_environ_delta(shell_environ.detype(), self.env.get_env_vars())
+        if to_set:
+            shell_environ.update(to_set)
 
     def _deactivate(self) -> None:
         """
@@ -826,13 +1840,8 @@ class ShellEnv:
         """
         if self._shell_environ_before:
             if self._li.shell:
-                tmp_environ = copy(self._li.shell.environ)
-                for i, v in tmp_environ.items():
-                    self._li.shell.environ.pop(i)
-                for k, v in self._shell_environ_before.items():
-                    if v is None:
-                        continue
-                    self._li.shell.environ[k] = v
+                environ_before = {k: v for k, v in self._shell_environ_before.items() if v is not None}
+                misc.update_environ(self._li.shell.environ, environ_before, remove_missing=True)
 
         self.env.deactivate()
 
@@ -878,7 +1887,7 @@ class ShellEnv:
         for n in to_remove:
             __import__(n)
 
-        self.logger.debug(f"Full reload")
+        self.logger.debug("Full reload")
 
     def _run_boot_codes(self) -> None:
         self._li.status.source_ready = False
@@ -0,0 +1,165 @@
+import builtins
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from xonsh.commands_cache import CommandsCache
+from xonsh.platform import ON_WINDOWS
+from xonsh.tools import executables_in
+
+from envo import logger
+
+__all__ = ["ExecutableIndex", "IndexedCommandsCache"]
+
+
+class ExecutableIndex:
+    """
+    Executables of PATH directories keyed by directory mtime.
+
+    Directory mtime changes when an entry is added, removed or renamed so a directory is scanned again only
+    when it changed or wasn't seen before. The index is persisted in the shell data dir and shared between
+    activations and reloads.
+    """
+
+    file_name = "executables.json"
+    # mtimes this close to the scan time might not catch later changes on filesystems with coarse timestamps
+    mtime_margin_ns = 2 * 10 ** 9
+
+    def __init__(self, data_dir: Optional[Path] = None) -> None:
+        """
+        :param data_dir: directory of the index file, index is kept only in memory if not set
+        """
+        self.data_dir = data_dir
+        self._dirs: Dict[str, Tuple[Optional[int], List[str]]] = {}
+        self._loaded = False
+        self._dirty = False
+
+    @property
+    def path(self) -> Optional[Path]:
+        return self.data_dir / self.file_name if self.data_dir else None
+
+    def load(self) -> None:
+        self._loaded = True
+        if not self.path or not self.path.exists():
+            return
+
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self._dirs = {d: (e["mtime"], e["executables"]) for d, e in data.items()}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug("Can't load executable index", {"error": str(e)})
+            self._dirs = {}
+
+    def save(self) -> None:
+        if not self.path or not self._dirty:
+            return
+
+        data = {d: {"mtime": m, "executables": e} for d, (m, e) in self._dirs.items() if os.path.isdir(d)}
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.debug("Can't save executable index", {"error": str(e)})
+
+    def get(self, directory: str, mtime_ns: int) -> List[str]:
+        """
+        Return executables in directory, scanning it only if it changed since the last scan.
+        """
+        if not self._loaded:
+            self.load()
+
+        cached = self._dirs.get(directory)
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+
+        logger.debug("Scanning for executables", {"directory": directory})
+        executables = list(executables_in(directory))
+
+        recent = int(time.time() * 1e9) - mtime_ns < self.mtime_margin_ns
+        self._dirs[directory] = (None if recent else mtime_ns, executables)
+        self._dirty = True
+        return executables
+
+
+class IndexedCommandsCache(CommandsCache):  # type: ignore
+    """
+    Xonsh commands cache backed by ExecutableIndex.
+
+    Xonsh rescans every PATH directory whenever PATH changes, which happens on every activation and reload.
+    Here only directories that were added by the PATH delta (and not indexed before) or whose mtime changed
+    are scanned, the rest is reused from the index.
+    """
+
+    # set by CommandsCache
+    _cmds_cache: Dict[str, Tuple[Any, Any]]
+    _alias_checksum: Optional[int]
+
+    def __init__(self, index: ExecutableIndex) -> None:
+        super().__init__()
+        self.index = index
+        self._dirs_state: Tuple[Tuple[str, int], ...] = ()
+
+    def _get_dirs_state(self) -> Tuple[Tuple[str, int], ...]:
+        paths = builtins.__xonsh__.env.get("PATH", [])  # type: ignore
+        state = []
+        seen = set()
+        for p in map(os.path.realpath, paths):
+            if p in seen:
+                continue
+            seen.add(p)
+            try:
+                stat = os.stat(p)
+            except OSError:
+                continue
+            if os.path.isdir(p):
+                state.append((p, stat.st_mtime_ns))
+        return tuple(state)
+
+    @property
+    def all_commands(self) -> Dict[str, Tuple[Any, Any]]:
+        dirs_state = self._get_dirs_state()
+        aliases = getattr(builtins, "aliases", dict())
+        aliases_hash = hash(frozenset(aliases))
+
+        if dirs_state == self._dirs_state:
+            if aliases_hash != self._alias_checksum:
+                self._alias_checksum = aliases_hash
+                for cmd, alias in aliases.items():
+                    key = cmd.upper() if ON_WINDOWS else cmd
+                    if key in self._cmds_cache:
+                        self._cmds_cache[key] = (self._cmds_cache[key][0], alias)
+                    else:
+                        self._cmds_cache[key] = (cmd, True)
+            return self._cmds_cache
+
+        self._dirs_state = dirs_state
+        self._alias_checksum = aliases_hash
+
+        all_cmds = {}
+        # iterate backwards so that entries at the front of PATH overwrite entries at the back.
+        for directory, mtime_ns in reversed(dirs_state):
+            for cmd in self.index.get(directory, mtime_ns):
+                key = cmd.upper() if ON_WINDOWS else cmd
+                all_cmds[key] = (os.path.join(directory, cmd), aliases.get(key, None))
+
+        self.index.save()
+
+        warn_cnt = builtins.__xonsh__.env.get("COMMANDS_CACHE_SIZE_WARNING")  # type: ignore
+        if warn_cnt and len(all_cmds) > warn_cnt:
+            print(
+                f"Warning! Found {len(all_cmds):,} executable files in the PATH directories!",
+                file=sys.stderr,
+            )
+
+        for cmd in aliases:
+            if cmd not in all_cmds:
+                key = cmd.upper() if ON_WINDOWS else cmd
+                all_cmds[key] = (cmd, True)
+
+        self._cmds_cache = all_cmds
+        return all_cmds
@@ -0,0 +1,264 @@
+import ast
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from envo import console, const, logger
+from envo.misc import get_repo_root
+
+__all__ = ["EnvNode", "EnvIndex", "get_env_index"]
+
+
+@dataclass
+class EnvNode:
+    path: str
+    stage: str
+    priority: int
+    mtime_ns: int
+    # paths of env files imported by this one
+    parents: List[str] = field(default_factory=list)
+
+
+@dataclass
+class DirEntry:
+    mtime_ns: int
+    subdirs: List[str]
+    env_files: List[str]
+
+
+class EnvIndex:
+    """
+    Graph of envs (env_*.py files) under the repo root with their stages and parents.
+
+    Directory listings and parsed env files are persisted and reused as long as their mtimes don't change,
+    so lookups from deep subdirectories only stat the directories on the way up.
+    """
+
+    skip_dirs = {"__pycache__", "node_modules", "venv"}
+
+    def __init__(self, root: Path, path: Optional[Path] = None) -> None:
+        """
+        :param path: index file, index is kept only in memory if None
+        """
+        self.root = root
+        self.path = path
+        self.dirs: Dict[str, DirEntry] = {}
+        self.envs: Dict[str, EnvNode] = {}
+        self._dirty = False
+
+        self.load()
+
+    @classmethod
+    def get_default_path(cls, root: Path) -> Path:
+        root_hash = hashlib.md5(str(root).encode("utf-8")).hexdigest()
+        return Path.home() / f".envo/index/{root_hash}.json"
+
+    def load(self) -> None:
+        if not self.path or not self.path.exists():
+            return
+
+        try:
+            data = json.loads(self.path.read_text("utf-8"))
+            self.dirs = {d: DirEntry(**e) for d, e in data["dirs"].items()}
+            self.envs = {p: EnvNode(**n) for p, n in data["envs"].items()}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug("Can't load env index", {"error": str(e)})
+            self.dirs = {}
+            self.envs = {}
+
+    def save(self) -> None:
+        if not self.path or not self._dirty:
+            return
+
+        data = {
+            "dirs": {d: asdict(e) for d, e in self.dirs.items()},
+            "envs": {p: asdict(n) for p, n in self.envs.items()},
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(data), "utf-8")
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.debug("Can't save env index", {"error": str(e)})
+
+    def contains(self, directory: Path) -> bool:
+        return directory == self.root or self.root in directory.parents
+
+    def _get_dir(self, directory: Path) -> Optional[DirEntry]:
+        key = str(directory)
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except OSError:
+            if self.dirs.pop(key, None):
+                self._dirty = True
+            return None
+
+        entry = self.dirs.get(key)
+        if entry and entry.mtime_ns == mtime_ns:
+            return entry
+
+        subdirs = []
+        env_files = []
+        try:
+            with os.scandir(key) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        if not e.name.startswith(".") and e.name not in self.skip_dirs:
+                            subdirs.append(e.name)
+                    elif e.name.startswith("env_") and e.name.endswith(".py"):
+                        env_files.append(e.name)
+        except OSError:
+            return None
+
+        entry = DirEntry(mtime_ns=mtime_ns, subdirs=sorted(subdirs), env_files=sorted(env_files))
+        self.dirs[key] = entry
+        self._dirty = True
+        return entry
+
+    def _resolve_module(self, env_file: Path, module: str) -> Optional[Path]:
+        if "." in module:
+            candidates = [self.root / f"{module.replace('.', '/')}.py"]
+        else:
+            # env modules are imported from the env dir or source roots above it
+            candidates = [d / f"{module}.py" for d in [env_file.parent, *env_file.parent.parents] if self.contains(d)]
+
+        for c in candidates:
+            if c != env_file and c.exists():
+                return c
+        return None
+
+    def _parse_parents(self, env_file: Path) -> List[str]:
+        try:
+            tree = ast.parse(env_file.read_text("utf-8"))
+        except (OSError, SyntaxError, ValueError):
+            return []
+
+        modules = []
+        for node in tree.body:
+            if isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                modules.append(node.module)
+            elif isinstance(node, ast.Import):
+                modules.extend(a.name for a in node.names)
+
+        ret = []
+        for m in modules:
+            if not m.rpartition(".")[2].startswith("env_"):
+                continue
+            parent = self._resolve_module(env_file, m)
+            if parent:
+                ret.append(str(parent))
+        return ret
+
+    def get_env(self, env_file: Path) -> Optional[EnvNode]:
+        key = str(env_file)
+        try:
+            mtime_ns = os.stat(key).st_mtime_ns
+        except OSError:
+            if self.envs.pop(key, None):
+                self._dirty = True
+            return None
+
+        node = self.envs.get(key)
+        if node and node.mtime_ns == mtime_ns:
+            return node
+
+        stage = const.STAGES.filename_to_stage(env_file.name)
+        node = EnvNode(
+            path=key,
+            stage=stage.name,
+            priority=stage.priority,
+            mtime_ns=mtime_ns,
+            parents=self._parse_parents(env_file),
+        )
+        self.envs[key] = node
+        self._dirty = True
+        return node
+
+    def get_env_files(self, directory: Path) -> List[Path]:
+        entry = self._get_dir(directory)
+        self.save()
+        if not entry:
+            return []
+        return [directory / f for f in entry.env_files]
+
+    def get_chain(self, env_file: Path) -> List[EnvNode]:
+        """
+        Return env of env_file followed by all its parents.
+        """
+        ret: List[EnvNode] = []
+        to_visit = [env_file]
+        while to_visit:
+            node = self.get_env(to_visit.pop(0))
+            if not node or node in ret:
+                continue
+            ret.append(node)
+            to_visit.extend(Path(p) for p in node.parents)
+
+        self.save()
+        return ret
+
+    def update(self) -> None:
+        """
+        Refresh the whole graph.
+        """
+        seen_dirs = set()
+        seen_envs = set()
+        to_visit = [self.root]
+        while to_visit:
+            directory = to_visit.pop()
+            entry = self._get_dir(directory)
+            if not entry:
+                continue
+
+            seen_dirs.add(str(directory))
+            to_visit.extend(directory / d for d in entry.subdirs)
+            for f in entry.env_files:
+                if self.get_env(directory / f):
+                    seen_envs.add(str(directory / f))
+
+        for d in set(self.dirs) - seen_dirs:
+            self.dirs.pop(d)
+            self._dirty = True
+        for p in set(self.envs) - seen_envs:
+            self.envs.pop(p)
+            self._dirty = True
+
+        self.save()
+
+    def print(self) -> None:
+        from rich.tree import Tree
+
+        tree = Tree(str(self.root))
+        dirs: Dict[str, List[EnvNode]] = {}
+        for n in sorted(self.envs.values(), key=lambda n: (n.path, -n.priority)):
+            dirs.setdefault(str(Path(n.path).parent), []).append(n)
+
+        for d, nodes in sorted(dirs.items()):
+            branch = tree.add(os.path.relpath(d, self.root))
+            for n in sorted(nodes, key=lambda n: -n.priority):
+                parents = ", ".join(os.path.relpath(p, self.root) for p in n.parents)
+                branch.add(f"{n.stage}" + (f" [dim]→ {parents}[/dim]" if parents else ""))
+
+        console.print(tree)
+
+
+_indices: Dict[Path, EnvIndex] = {}
+
+
+def get_env_index(directory: Optional[Path] = None) -> Optional[EnvIndex]:
+    """
+    Return index of the repo directory belongs to (cwd if not given), None if it's not in a repo.
+    """
+    try:
+        root = get_repo_root(directory)
+    except RuntimeError:
+        return None
+
+    if root not in _indices:
+        _indices[root] = EnvIndex(root, path=EnvIndex.get_default_path(root))
+    return _indices[root]
@@ -1,10 +1,33 @@
+import atexit
+import bisect
+import gzip
+import heapq
+import itertools
+import json
+import os
+import queue
 import re
+import shutil
 import sys
 import traceback
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from threading import Thread
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
 
 import loguru
 from loguru._colorizer import Colorizer
@@ -20,24 +43,90 @@ class Level(int, Enum):
     ERROR = 3
 
 
-@dataclass
+# message or metadata, or a callable returning it that's called only if the level is enabled
+LazyMessage = Union[str, Callable[[], str]]
+LazyMetadata = Optional[Union[Dict[str, Any], Callable[[], Dict[str, Any]]]]
+
+
+@lru_cache(maxsize=None)
+def _get_ansi_parser() -> Any:
+    from loguru._colorizer import AnsiParser
+
+    return AnsiParser()
+
+
+@lru_cache(maxsize=None)
+def _get_highlighter() -> Tuple[XonshConsoleLexer, Any]:
+    """
+    Lexer and formatter are expensive to create (style and token lookups), share them between messages.
+    """
+    from pygments.formatters.terminal import TerminalFormatter
+
+    return XonshConsoleLexer(), TerminalFormatter(style=get_style_by_name("emacs"))
+
+
 class Msg:
+    __slots__ = ("level", "body", "time", "descriptor", "_metadata")
+
     level: Level
     body: str
     time: float  # s
-    descriptor: Optional[str] = None
-    metadata: Dict[str, Any] = field(default_factory=dict)
+    descriptor: Optional[str]
+
+    def __init__(
+        self,
+        level: Level,
+        body: str,
+        time: float,
+        descriptor: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.level = level
+        self.body = str(body).lstrip()
+        self.time = time
+        self.descriptor = descriptor
+        # most messages have no metadata, don't keep an empty dict for each of them
+        self._metadata = metadata or None
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self._metadata or {}
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Msg):
+            return NotImplemented
+        return (self.level, self.body, self.time, self.descriptor, self.metadata) == (
+            other.level,
+            other.body,
+            other.time,
+            other.descriptor,
+            other.metadata,
+        )
 
-    def __post_init__(self) -> None:
-        self.body = str(self.body).lstrip()
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "level": self.level.name,
+            "body": self.body,
+            "time": self.time,
+            "descriptor": self.descriptor,
+            "metadata": self.metadata,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Msg":
+        return cls(
+            level=Level[data["level"]],
+            body=data["body"],
+            time=data["time"],
+            descriptor=data.get("descriptor"),
+            metadata=data.get("metadata"),
+        )
 
     def print(self) -> None:
-        print(self.render_all(with_color=True))
+        print(self.render_all(with_color=sys.stdout.isatty()))
 
     def _fix_formatting(self, text: str) -> str:
-        from loguru._colorizer import AnsiParser
-
-        parser = AnsiParser()
+        parser = _get_ansi_parser()
 
         for match in parser._regex_tag.finditer(text):
             markup, tag = match.group(0), match.group(1)
@@ -56,12 +145,9 @@ class Msg:
             else:
                 return ""
 
-        from pygments import highlight
-        from pygments.formatters.terminal import TerminalFormatter
-
         metadata = ""
-        if self.metadata:
-            metadata = str(self.metadata)
+        if self._metadata:
+            metadata = str(self._metadata)
 
         descriptor = ""
         if self.descriptor:
@@ -69,13 +155,11 @@ class Msg:
         msg = f"@{self.time:.4f}]{descriptor}{self.body}; {metadata}"
 
         if with_color:
+            from pygments import highlight
+
             # fix escaping colors
             msg = self._fix_formatting(msg)
-            msg = highlight(
-                msg,
-                XonshConsoleLexer(),
-                TerminalFormatter(style=get_style_by_name("emacs")),
-            )
+            msg = highlight(msg, *_get_highlighter())
             msg = Colorizer.ansify(msg)
         return msg
 
@@ -94,29 +178,42 @@ class MsgFilter:
     time_before: Optional[float] = None
     metadata_re: Optional[Dict[str, Any]] = None
 
+    _body_pattern: Optional[Pattern] = field(default=None, init=False, repr=False, compare=False)
+    _metadata_patterns: Optional[Dict[str, Pattern]] = field(default=None, init=False, repr=False, compare=False)
+
+    def _get_body_pattern(self) -> Pattern:
+        if self._body_pattern is None:
+            self._body_pattern = re.compile(self.body_re, re.DOTALL)  # type: ignore
+        return self._body_pattern
+
+    def _get_metadata_patterns(self) -> Dict[str, Pattern]:
+        if self._metadata_patterns is None:
+            self._metadata_patterns = {k: re.compile(v, re.DOTALL) for k, v in (self.metadata_re or {}).items()}
+        return self._metadata_patterns
+
     # matchers
     def matches_level(self, msg: Msg) -> bool:
         return self.level is None or msg.level == self.level
 
     def matches_body(self, msg: Msg) -> bool:
-        return self.body_re is None or bool(re.match(self.body_re, msg.body, re.DOTALL))
+        return self.body_re is None or bool(self._get_body_pattern().match(msg.body))
 
     def matches_time_later(self, msg: Msg) -> bool:
-        return self.body_re is None or msg.time >= self.time_later
+        return self.time_later is None or msg.time >= self.time_later
 
     def matches_time_before(self, msg: Msg) -> bool:
-        return self.body_re is None or msg.time < self.time_before
+        return self.time_before is None or msg.time < self.time_before
 
     def matches_metadata(self, msg: Msg) -> bool:
         if not self.metadata_re:
             return True
 
-        for k, v in self.metadata_re.items():
+        for k, pattern in self._get_metadata_patterns().items():
             msg_value = msg.metadata.get(k)
             if msg_value is None:
                 return False
 
-            if not re.match(v, msg_value, re.DOTALL):
+            if not pattern.match(msg_value):
                 return False
 
         return True
@@ -131,38 +228,350 @@ class MsgFilter:
         )
 
 
+def print_msgs(msgs: Iterable[Msg]) -> None:
+    """
+    Print messages rendering them one by one, without colors if stdout is not a terminal.
+    """
+    if not sys.stdout.isatty():
+        sys.stdout.writelines(f"{m.render_all(with_color=False)}\n" for m in msgs)
+        return
+
+    for m in msgs:
+        print(m.render_all(with_color=True))
+
+
 class Messages(list):
     content = List[Msg]
 
+    @classmethod
+    def load(cls, file: Path) -> "Messages":
+        """
+        Load messages saved by JsonlSink, including its rotated segments (oldest first).
+        """
+        ret = cls()
+        for path in JsonlSink.get_segments(file):
+            opener = gzip.open if path.suffix == ".gz" else open
+            with opener(path, "rt", encoding="utf-8") as f:  # type: ignore
+                for line in f:
+                    try:
+                        ret.append(Msg.from_dict(json.loads(line)))
+                    except (ValueError, KeyError, TypeError):
+                        # torn line of a log that was being written
+                        continue
+        return ret
+
+    def get_msgs(self, filter: MsgFilter) -> "Messages":
+        return Messages(m for m in self if filter.matches_all(m))
+
+    def print(self) -> None:
+        print_msgs(self)
+
+
+class _MsgList:
+    """
+    Messages in time order with their times kept in a list for binary search.
+
+    Dropped messages are removed from the front in batches (when they make up half of the list) so dropping
+    stays O(1) amortized.
+    """
+
+    def __init__(self) -> None:
+        self.msgs: List[Msg] = []
+        self.times: List[float] = []
+        self.start = 0
+
+    def append(self, msg: Msg) -> None:
+        self.msgs.append(msg)
+        self.times.append(msg.time)
+
+    def popleft(self) -> Msg:
+        msg = self.msgs[self.start]
+        self.start += 1
+        if self.start * 2 >= len(self.msgs):
+            del self.msgs[: self.start]
+            del self.times[: self.start]
+            self.start = 0
+        return msg
+
+    def get_range(self, time_later: Optional[float], time_before: Optional[float]) -> List[Msg]:
+        """
+        Return messages with time_later <= time < time_before.
+        """
+        start = self.start if time_later is None else bisect.bisect_left(self.times, time_later, lo=self.start)
+        end = len(self.msgs) if time_before is None else bisect.bisect_left(self.times, time_before, lo=self.start)
+        return self.msgs[start:end]
+
+    def __len__(self) -> int:
+        return len(self.msgs) - self.start
+
+    def __iter__(self) -> Iterator[Msg]:
+        return itertools.islice(self.msgs, self.start, None)
+
+
+class MsgBuffer:
+    """
+    Ring buffer of messages for each level.
+
+    When a level's buffer is full its oldest messages are dropped, so noisy debug logs can't push out
+    errors. Iteration yields messages of all levels in time order.
+
+    Messages are also indexed by metadata key for each level, so get_msgs only looks at messages that
+    can match (e.g. the ones with "type" metadata) and finds the time range with binary search.
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        :param size: max number of messages kept per level
+        """
+        self.size = size
+        self._levels: Dict[Level, _MsgList] = {level: _MsgList() for level in Level}
+        self._keys: Dict[Level, Dict[str, _MsgList]] = {level: {} for level in Level}
+
+    def append(self, msg: Msg) -> None:
+        if not self.size:
+            return
+
+        msgs = self._levels[msg.level]
+        keys = self._keys[msg.level]
+
+        if len(msgs) == self.size:
+            # oldest message of the level is also the oldest one in each of its key indices
+            dropped = msgs.popleft()
+            for k in dropped.metadata:
+                keys[k].popleft()
+                if not keys[k]:
+                    del keys[k]
+
+        msgs.append(msg)
+        for k in msg.metadata:
+            keys.setdefault(k, _MsgList()).append(msg)
+
+    def resize(self, size: int) -> None:
+        levels = self._levels
+        self.size = size
+        self._levels = {level: _MsgList() for level in Level}
+        self._keys = {level: {} for level in Level}
+
+        for msgs in levels.values():
+            for m in msgs:
+                self.append(m)
+
+    def clear(self) -> None:
+        self._levels = {level: _MsgList() for level in Level}
+        self._keys = {level: {} for level in Level}
+
+    def get_level(self, level: Level) -> List[Msg]:
+        return list(self._levels[level])
+
+    def _get_candidates(self, level: Level, filter: MsgFilter) -> List[Msg]:
+        msgs = self._levels[level]
+        if filter.metadata_re:
+            keys = self._keys[level]
+            if any(k not in keys for k in filter.metadata_re):
+                return []
+            msgs = min((keys[k] for k in filter.metadata_re), key=len)
+
+        return msgs.get_range(filter.time_later, filter.time_before)
+
+    def get_msgs(self, filter: MsgFilter) -> "Messages":
+        levels = list(Level) if filter.level is None else [filter.level]
+
+        filtered = []
+        for level in levels:
+            filtered.append(
+                [
+                    m
+                    for m in self._get_candidates(level, filter)
+                    if filter.matches_body(m) and filter.matches_metadata(m)
+                ]
+            )
+
+        return Messages(heapq.merge(*filtered, key=lambda m: m.time))
+
     def print(self) -> None:
-        ret = []
+        print_msgs(self)
 
-        for m in self:
-            m.print()
+    def __len__(self) -> int:
+        return sum(len(msgs) for msgs in self._levels.values())
 
-        ret = "\n".join(ret)
+    def __iter__(self) -> Iterator[Msg]:
+        return heapq.merge(*self._levels.values(), key=lambda m: m.time)
 
-        print(ret)
+    def __getitem__(self, item: Union[int, slice]) -> Union[Msg, List[Msg]]:
+        return list(self)[item]
+
+
+class JsonlSink:
+    """
+    Writes messages as JSON lines from a background thread.
+
+    Messages are passed through a bounded queue and dropped (and counted) when it's full, so logging never
+    blocks the shell. When the file grows over max_bytes it's compressed to file.1.gz, older segments are
+    shifted (file.2.gz, ...) and only backup_count of them are kept. If the file can't be (re)opened the sink
+    gets closed and messages are dropped.
+    """
+
+    # messages written before flushing and checking the size even if more of them are queued
+    batch_size = 100
+
+    def __init__(
+        self,
+        file: Path,
+        level: Level = Level.DEBUG,
+        max_bytes: int = 10 * 1024 ** 2,
+        backup_count: int = 3,
+        queue_size: int = 10000,
+    ) -> None:
+        self.file = file
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self.closed = False
+
+        self._queue: "queue.Queue[Optional[Msg]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[Thread] = None
+        self._file: Optional[IO[str]] = None
+
+        try:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.file.open("a", encoding="utf-8")
+        except OSError as e:
+            self._on_error(e)
+            return
+
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get_segments(cls, file: Path) -> List[Path]:
+        """
+        Return existing log files, oldest first.
+        """
+        rotated = []
+        for p in file.parent.glob(f"{file.name}.*.gz"):
+            number = p.name[len(file.name) + 1 : -len(".gz")]
+            if number.isdigit():
+                rotated.append((int(number), p))
+
+        ret = [p for _, p in sorted(rotated, reverse=True)]
+        if file.exists():
+            ret.append(file)
+        return ret
+
+    def write(self, msg: Msg) -> None:
+        if self.closed:
+            return
+
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        """
+        Wait until all queued messages are written.
+        """
+        if self._thread:
+            self._queue.join()
+
+    def close(self) -> None:
+        self.closed = True
+        if not self._thread or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def _on_error(self, error: Exception) -> None:
+        # logging through the logger could loop
+        print(f"Can't write log to {self.file} ({error})", file=sys.stderr)
+        if not self._file:
+            self.closed = True
+
+    def _rotate(self) -> None:
+        for i in range(self.backup_count, 0, -1):
+            segment = self.file.with_name(f"{self.file.name}.{i}.gz")
+            if not segment.exists():
+                continue
+            if i == self.backup_count:
+                segment.unlink()
+            else:
+                os.replace(segment, self.file.with_name(f"{self.file.name}.{i + 1}.gz"))
+
+        if self.backup_count:
+            with self.file.open("rb") as src, gzip.open(self.file.with_name(f"{self.file.name}.1.gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        self.file.unlink()
+
+    def _write(self, msg: Msg, batch_end: bool) -> None:
+        if not self._file:
+            return
+
+        self._file.write(json.dumps(msg.to_dict(), default=str) + "\n")
+        if not batch_end:
+            return
+
+        self._file.flush()
+        if self._file.tell() > self.max_bytes:
+            self._file.close()
+            self._file = None
+            try:
+                self._rotate()
+            finally:
+                self._file = self.file.open("a", encoding="utf-8")
+
+    def _run(self) -> None:
+        written = 0
+        try:
+            while True:
+                msg = self._queue.get()
+                try:
+                    if msg is None:
+                        return
+
+                    written += 1
+                    # write everything that's queued (up to batch_size) before flushing
+                    batch_end = self._queue.empty() or written >= self.batch_size
+                    if batch_end:
+                        written = 0
+                    self._write(msg, batch_end)
+                except (OSError, ValueError) as e:
+                    self._on_error(e)
+                finally:
+                    self._queue.task_done()
+        finally:
+            if self._file:
+                self._file.close()
 
 
 class Logger:
-    messages: Messages
+    messages: MsgBuffer
     level: Level
     parent: Optional["Logger"]
     descriptor: Optional[str]
     name: str
 
+    # store messages below the logger level too (same as envo.e2e.enabled, which can't be imported here)
+    capture: bool = "ENVO_E2E_TEST" in os.environ
+    # level of loguru sinks, they are global so it's shared by all loggers
+    output_level: Level = Level.INFO
+
     def __init__(
         self,
         name: str,
         parent: Optional["Logger"] = None,
         descriptor: Optional[str] = None,
+        buffer_size: int = 5000,
     ) -> None:
+        """
+        :param buffer_size: max number of messages kept per level
+        """
         self.name = name
         self.parent = parent
         self.descriptor = descriptor
 
-        self.messages = Messages()
+        self.messages = MsgBuffer(buffer_size)
+        self.sinks: List[JsonlSink] = []
         self.level = Level.INFO
 
         self.set_level(Level.INFO)
@@ -171,15 +580,22 @@ class Logger:
         self.sw.start()
 
     def create_child(self, name: str, descriptor: str) -> "Logger":
-        logger = Logger(parent=self, name=name, descriptor=descriptor)
+        logger = Logger(parent=self, name=name, descriptor=descriptor, buffer_size=0)
+        # children store messages in the root buffer
+        logger.messages = self.messages
+        logger.sinks = self.sinks
         logger.sw = self.sw
         return logger
 
     def clean(self) -> None:
-        self.messages = Messages()
+        self.messages.clear()
+
+    def set_buffer_size(self, size: int) -> None:
+        self.messages.resize(size)
 
     def set_level(self, level: Level) -> None:
         self.level = level
+        Logger.output_level = level
         loguru.logger.remove()
 
         if self.level <= Level.DEBUG:
@@ -211,35 +627,50 @@ class Logger:
                 filter=lambda x: x["level"].name == "ERROR",
             )
 
-    def _log(self, msg: Msg) -> None:
-        self.messages.append(msg)
+    def is_enabled_for(self, level: Level) -> bool:
+        if self.capture or level >= self.level or level >= Logger.output_level:
+            return True
+        return any(level >= s.level for s in self.sinks)
+
+    def log(self, message: LazyMessage, level: Level, metadata: LazyMetadata = None, loguru_disable=False) -> None:
+        """
+        :param message: message or a callable building it, called only if the level is enabled
+        :param metadata: metadata or a callable building it, called only if the level is enabled
+        """
+        if not self.is_enabled_for(level):
+            return
+
+        if callable(message):
+            message = message()
+        if callable(metadata):
+            metadata = metadata()
 
-    def log(self, message: str, level: Level, metadata: Optional[Dict[str, Any]] = None, loguru_disable=False) -> None:
         msg = Msg(
             level,
             message,
             self.sw.value,
-            metadata=metadata or {},
+            metadata=metadata,
             descriptor=self.descriptor,
         )
         if not loguru_disable:
             loguru.logger.log(level.name, message)
 
-        self._log(msg)
+        self.messages.append(msg)
 
-        if self.parent:
-            self.parent._log(msg)
+        for s in self.sinks:
+            if level >= s.level:
+                s.write(msg)
 
-    def debug(self, message: str, metadata: Optional[Dict[str, Any]] = None, loguru_disable=False) -> None:
+    def debug(self, message: LazyMessage, metadata: LazyMetadata = None, loguru_disable=False) -> None:
         self.log(message, Level.DEBUG, metadata, loguru_disable)
 
-    def info(self, message: str, metadata: Optional[Dict[str, Any]] = None, loguru_disable=False) -> None:
+    def info(self, message: LazyMessage, metadata: LazyMetadata = None, loguru_disable=False) -> None:
         self.log(message, Level.INFO, metadata, loguru_disable)
 
-    def warning(self, message: str, metadata: Optional[Dict[str, Any]] = None, loguru_disable=False) -> None:
+    def warning(self, message: LazyMessage, metadata: LazyMetadata = None, loguru_disable=False) -> None:
         self.log(message, Level.WARNING, metadata, loguru_disable)
 
-    def error(self, message: str, metadata: Optional[Dict[str, Any]] = None, loguru_disable=False) -> None:
+    def error(self, message: LazyMessage, metadata: LazyMetadata = None, loguru_disable=False) -> None:
         self.log(message, Level.ERROR, metadata, loguru_disable)
 
     #
@@ -266,23 +697,38 @@ class Logger:
         self.log(text, level=Level.ERROR)
 
     def get_msgs(self, filter: MsgFilter) -> List[Msg]:
-        filtered: List[Msg] = []
-        for m in self.messages:
-            if filter.matches_all(m):
-                filtered.append(m)
-
-        return filtered
+        return self.messages.get_msgs(filter)
 
     def print_all(self) -> None:
-        for m in self.messages:
-            m.print()
+        self.messages.print()
 
     def tail(self, messages_n: int) -> None:
-        for m in self.messages[-messages_n:]:
-            m.print()
+        print_msgs(list(self.messages)[-messages_n:])
+
+    def add_sink(self, sink: JsonlSink) -> None:
+        self.sinks.append(sink)
+        atexit.register(sink.close)
 
-    def save(self, file: Path) -> None:
-        pass
+    def remove_sink(self, sink: JsonlSink) -> None:
+        self.sinks.remove(sink)
+        atexit.unregister(sink.close)
+        sink.close()
+
+    def save(self, file: Path, level: Level = Level.DEBUG, **kwargs: Any) -> JsonlSink:
+        """
+        Save messages logged so far to file and keep appending new ones in the background.
+
+        :param kwargs: JsonlSink arguments (rotation, queue size)
+        """
+        sink = JsonlSink(file, level=level, **kwargs)
+        for m in self.messages:
+            if m.level >= level:
+                sink.write(m)
+        self.add_sink(sink)
+        return sink
 
 
 logger = Logger(name="root")
+
+if os.environ.get("ENVO_LOG_FILE"):
+    logger.save(Path(os.environ["ENVO_LOG_FILE"]), level=Level[os.environ.get("ENVO_LOG_LEVEL", "DEBUG").upper()])
@@ -1,16 +1,31 @@
 import errno
+import importlib.abc
 import importlib.machinery
 import importlib.util
 import os
 import re
 import sys
+import threading
 import traceback
 from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
 from textwrap import dedent
-from types import FrameType
-from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
+from types import FrameType, FunctionType, ModuleType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from globmatch import glob_match
 from watchdog.events import FileSystemEvent, FileSystemEventHandler
@@ -25,6 +40,7 @@ __all__ = [
     "Callback",
     "FilesWatcher",
     "colored",
+    "PathList",
 ]
 
 from envo import const
@@ -212,20 +228,163 @@ def import_from_file(path: Union[Path, str]) -> Any:
     return module
 
 
-def import_env_from_file(path: Union[Path, str]) -> Any:
-    # Ensure all env modules are reloaded
-    for n, m in sys.modules.copy().items():
-        if not hasattr(m, "__file__"):
-            continue
-        if not m.__file__:
-            continue
-        # Check if it's env file
-        if not Path(m.__file__).name.startswith("env_"):
-            continue
+class EnvModuleLoader(importlib.machinery.SourceFileLoader):
+    """
+    Source loader that lets the registry see what a module imports while it's executed.
+    """
+
+    def __init__(self, fullname: str, path: str, registry: "EnvModulesRegistry") -> None:
+        super().__init__(fullname, path)
+        self.registry = registry
+
+    def exec_module(self, module: ModuleType) -> None:
+        self.registry._exec_module(module, super().exec_module)
+
+
+class EnvModulesRegistry(importlib.abc.MetaPathFinder):
+    """
+    Env modules (imported env_*.py files) and modules depending on them.
+
+    Env files and modules from env directories imported by them are loaded through the registry so
+    dependents are recorded per module at import time. Unloading only follows recorded dependents.
+    """
+
+    def __init__(self) -> None:
+        # env module names
+        self.names: Set[str] = set()
+        # names of all modules loaded by the registry (env modules and modules from env dirs)
+        self.modules: Set[str] = set()
+        # module name -> names of modules that imported it
+        self.dependents: Dict[str, Set[str]] = {}
+        self.dirs: Set[str] = set()
+        # modules being executed by the registry, innermost last
+        self._importers = threading.local()
+
+    def install(self) -> None:
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def _get_importers(self) -> List[str]:
+        if not hasattr(self._importers, "stack"):
+            self._importers.stack = []
+        stack: List[str] = self._importers.stack
+        return stack
+
+    def find_spec(
+        self, fullname: str, path: Optional[Any], target: Optional[Any] = None
+    ) -> Optional[importlib.machinery.ModuleSpec]:
+        importers = self._get_importers()
+
+        if fullname.rpartition(".")[2].startswith("env_"):
+            spec = importlib.machinery.PathFinder.find_spec(fullname, path)
+            if not spec or not spec.origin or not os.path.basename(spec.origin).startswith("env_"):
+                return None
+            is_env_module = True
+        elif importers and path is None and self.dirs:
+            # modules from env dirs imported by env modules (helpers etc.), other dirs aren't searched
+            spec = importlib.machinery.PathFinder.find_spec(fullname, list(self.dirs))
+            is_env_module = False
+        else:
+            return None
+
+        if not spec or not spec.origin or not isinstance(spec.loader, importlib.machinery.SourceFileLoader):
+            return None
+
+        if is_env_module:
+            self.names.add(fullname)
+            self.dirs.add(os.path.dirname(spec.origin))
+        self.modules.add(fullname)
+
+        if importers and importers[-1] in sys.modules:
+            self.dependents.setdefault(fullname, set()).add(importers[-1])
+
+        # the spec is returned so the module isn't looked up again by the path finder
+        spec.loader = EnvModuleLoader(fullname, spec.origin, self)
+        return spec
+
+    def import_file(self, path: Union[Path, str]) -> ModuleType:
+        path = Path(path)
+        self.dirs.add(str(path.absolute().parent))
+
+        loader = EnvModuleLoader(str(path), str(path), self)
+        spec = importlib.machinery.ModuleSpec(loader.name, loader, origin=loader.path)
+        spec.has_location = True
+        module = importlib.util.module_from_spec(spec)
+        loader.exec_module(module)
+
+        return module
+
+    def _exec_module(self, module: ModuleType, exec_module: Callable[[ModuleType], None]) -> None:
+        importers = self._get_importers()
+        importers.append(module.__name__)
+        try:
+            exec_module(module)
+        finally:
+            importers.pop()
+
+        if module.__name__ not in sys.modules:
+            return
+
+        # imports of already loaded modules don't go through find_spec
+        for n in self._get_references(module):
+            if n != module.__name__:
+                self.dependents.setdefault(n, set()).add(module.__name__)
+
+    def _get_references(self, module: ModuleType) -> Set[str]:
+        ret = set()
+        for v in list(vars(module).values()):
+            if isinstance(v, ModuleType):
+                name = v.__name__
+            elif isinstance(v, (type, FunctionType)):
+                name = v.__module__
+            else:
+                continue
+
+            if name in self.modules:
+                ret.add(name)
+        return ret
+
+    def unload(self, names: Optional[Iterable[str]] = None) -> None:
+        """
+        :param names: unload only these env modules (and their dependents) instead of all env modules
+        """
+        to_check = list(self.names if names is None else names)
+        unloaded: Set[str] = set()
+        while to_check:
+            n = to_check.pop()
+            if n in unloaded:
+                continue
+            unloaded.add(n)
+            to_check.extend(self.dependents.pop(n, ()))
+
+        for n in unloaded:
+            sys.modules.pop(n, None)
+
+        self.names -= unloaded
+        self.modules -= unloaded
+        for d in self.dependents.values():
+            d -= unloaded
+
+
+env_modules_registry = EnvModulesRegistry()
+env_modules_registry.install()
+
 
-        del sys.modules[n]
+def unload_env_modules(names: Optional[Iterable[str]] = None) -> None:
+    """
+    :param names: unload only modules with these names instead of all env modules
+    """
+    env_modules_registry.unload(names)
 
-    ret = import_from_file(path)
+
+def import_env_from_file(path: Union[Path, str], reuse_modules: bool = False) -> Any:
+    """
+    :param reuse_modules: reuse already imported env modules (parents) instead of reloading them
+    """
+    if not reuse_modules:
+        unload_env_modules()
+
+    ret = env_modules_registry.import_file(path)
 
     return ret
 
@@ -382,8 +541,136 @@ def add_source_roots(paths: List[Union[Path, str]]) -> None:
         sys.path.insert(0, str(p))
 
 
-def get_repo_root() -> Path:
-    path = Path(".").absolute()
+class PathList(List[Path]):
+    """
+    Ordered set of paths (for PATH like variables).
+
+    Paths are normalized and kept unique, membership checks are O(1). append() and extend() skip paths that
+    are already there, insert() moves them to the new position.
+    """
+
+    def __init__(self, paths: Iterable[Union[Path, str]] = (), drop_missing: bool = True) -> None:
+        """
+        :param drop_missing: skip paths that don't exist in the variable value
+        """
+        super().__init__()
+        self.drop_missing = drop_missing
+        self._keys: Set[str] = set()
+        self.extend(paths)
+
+    @staticmethod
+    def _normalize(path: Union[Path, str]) -> Path:
+        return Path(os.path.normpath(os.path.expanduser(str(path))))
+
+    @staticmethod
+    def _get_key(path: Path) -> str:
+        return os.path.normcase(str(path))
+
+    def __contains__(self, path: Any) -> bool:
+        if not isinstance(path, (Path, str)):
+            return False
+        return self._get_key(self._normalize(path)) in self._keys
+
+    def append(self, path: Union[Path, str]) -> None:
+        path = self._normalize(path)
+        key = self._get_key(path)
+        if key in self._keys:
+            return
+
+        self._keys.add(key)
+        super().append(path)
+
+    def extend(self, paths: Iterable[Union[Path, str]]) -> None:
+        for p in paths:
+            self.append(p)
+
+    def __iadd__(self, paths: Iterable[Union[Path, str]]) -> "PathList":  # type: ignore
+        self.extend(paths)
+        return self
+
+    def insert(self, index: int, path: Union[Path, str]) -> None:  # type: ignore
+        path = self._normalize(path)
+        if path in self:
+            self.remove(path)
+
+        self._keys.add(self._get_key(path))
+        super().insert(index, path)
+
+    def index(self, path: Union[Path, str], *args: Any) -> int:
+        return super().index(self._normalize(path), *args)
+
+    def count(self, path: Union[Path, str]) -> int:
+        return 1 if path in self else 0
+
+    def remove(self, path: Union[Path, str]) -> None:
+        key = self._get_key(self._normalize(path))
+        if key not in self._keys:
+            raise ValueError(f"{path} is not in list")
+
+        for i, p in enumerate(self):
+            if self._get_key(p) == key:
+                del self[i]
+                return
+
+    def pop(self, index: int = -1) -> Path:  # type: ignore
+        path = super().pop(index)
+        self._keys.discard(self._get_key(path))
+        return path
+
+    def clear(self) -> None:
+        super().clear()
+        self._keys.clear()
+
+    def __setitem__(self, index: Any, value: Any) -> None:
+        paths = list(self)
+        paths[index] = [self._normalize(p) for p in value] if isinstance(index, slice) else self._normalize(value)
+        self.clear()
+        self.extend(paths)
+
+    def __delitem__(self, index: Any) -> None:
+        super().__delitem__(index)
+        self._keys = {self._get_key(p) for p in self}
+
+    def copy(self) -> "PathList":
+        return PathList(self, drop_missing=self.drop_missing)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # default list reduce would set state before appending items
+        return PathList, (list(self), self.drop_missing)
+
+    def to_env_value(self) -> str:
+        paths = [p for p in self if p.exists()] if self.drop_missing else self
+        return os.pathsep.join(str(p) for p in paths)
+
+
+def get_environ_delta(
+    current: Mapping[str, Any], target: Mapping[str, Any], remove_missing: bool = False
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Return variables that have to be set and removed to turn current environ into target.
+
+    :param remove_missing: remove variables that are not in target
+    """
+    to_set = {k: v for k, v in target.items() if k not in current or current[k] != v}
+    to_remove = [k for k in current.keys() if k not in target] if remove_missing else []
+    return to_set, to_remove
+
+
+def update_environ(environ: MutableMapping[str, Any], target: Mapping[str, Any], remove_missing: bool = False) -> None:
+    """
+    Update environ in place touching only changed variables.
+    """
+    to_set, to_remove = get_environ_delta(environ, target, remove_missing=remove_missing)
+
+    if to_set:
+        environ.update(to_set)
+
+    for k in to_remove:
+        del environ[k]
+
+
+def get_repo_root(path: Optional[Path] = None) -> Path:
+    path = (path or Path(".")).absolute()
 
     while not list(path.glob("*.git")):
         if path == path.parent:
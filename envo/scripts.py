@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 import hashlib
 import os
+import subprocess
 import sys
 from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, ClassVar, Dict, List, Optional, Type
+from typing import Any, Callable, ClassVar, Dict, List, Optional, Tuple, Type
 
 import envo.e2e
 from envo import const, logger, logs, misc, shell
 from envo.env import Env, ShellEnv
-from envo.misc import Callback, EnvoError, FilesWatcher, import_env_from_file
+from envo.index import get_env_index
+from envo.misc import Callback, EnvoError, FilesWatcher, import_env_from_file, unload_env_modules
 from envo.shell import FancyShell, PromptBase, PromptState, Shell
+from envo.stats import CommandStats
 from envo.status import Status
 
 package_root = Path(os.path.realpath(__file__)).parent
@@ -68,6 +71,7 @@ class HeadlessMode:
     shell_env: ShellEnv
     reloader_enabled: bool = False
     blocking: bool = True
+    reuse_env_modules: bool = False
 
     def __init__(self, se: Sets, li: Links, calls: Callbacks) -> None:
         self.se = se
@@ -128,7 +132,7 @@ class HeadlessMode:
         return self.se.env_path
 
     def _create_env_object(self, file: Path) -> ShellEnv:
-        env = import_env_from_file(file).ThisEnv()
+        env = import_env_from_file(file, reuse_modules=self.reuse_env_modules).ThisEnv()
 
         shell_env = ShellEnv(
             li=ShellEnv._Links(shell=self.li.shell, status=self.status, env=env),
@@ -148,10 +152,9 @@ class HeadlessMode:
         env_file = self.get_env_file()
         logger.debug(f'Creating Env from file "{env_file}"')
 
-        # unload modules
-        for m in list(sys.modules.keys())[:]:
-            if m.startswith("env_"):
-                sys.modules.pop(m)
+        if not self.reuse_env_modules:
+            unload_env_modules()
+
         try:
             self.shell_env = self._create_env_object(env_file)
         except ImportError as exc:
@@ -159,6 +162,16 @@ class HeadlessMode:
             raise EnvoError(f"""Couldn't import "{env_file}" ({exc}).""")
 
 
+class StagesMode(HeadlessMode):
+    """
+    Headless mode evaluating one of many stages in a single process.
+
+    Parent env modules (like env_comm) are imported once and shared between stages.
+    """
+
+    reuse_env_modules: bool = True
+
+
 class NormalMode(HeadlessMode):
     @dataclass
     class Links(HeadlessMode.Links):
@@ -258,10 +271,16 @@ class EnvoBase:
         logger.set_level(logs.Level.INFO)
         self.mode = None
 
+        self.index = get_env_index()
         self.env_dirs = self._get_env_dirs()
 
         self.restart_count = -1
 
+    def _get_env_files(self, directory: Path) -> List[Path]:
+        if self.index and self.index.contains(directory):
+            return self.index.get_env_files(directory)
+        return list(directory.glob("env_*.py"))
+
     def _get_env_dirs(self) -> List[Path]:
         ret = []
         path = Path(".").absolute()
@@ -269,9 +288,8 @@ class EnvoBase:
             if path.parent == path:
                 break
 
-            for p in path.glob("env_*.py"):
-                if p.parent not in ret:
-                    ret.append(p.parent)
+            if self._get_env_files(path):
+                ret.append(path)
 
             path = path.parent
 
@@ -282,7 +300,7 @@ class EnvoBase:
         if self.se.stage != DEFAULT_STAGE:
             matches: Dict[Path, const.Stage] = OrderedDict()
             for d in self.env_dirs:
-                for p in d.glob("env_*.py"):
+                for p in self._get_env_files(d):
                     stage = const.STAGES.filename_to_stage(p.name)
                     if stage:
                         matches[p] = stage
@@ -292,8 +310,8 @@ class EnvoBase:
                 return results[0]
         else:
             for d in self.env_dirs:
-                matches: Dict[Path, const.Stage] = OrderedDict()
-                for p in d.glob("env_*.py"):
+                matches = OrderedDict()
+                for p in self._get_env_files(d):
                     stage = const.STAGES.filename_to_stage(p.name)
                     if stage:
                         matches[p] = stage
@@ -325,6 +343,9 @@ class EnvoBase:
     def dump(self) -> None:
         raise NotImplementedError()
 
+    def stats(self) -> None:
+        CommandStats(data_dir=Shell.get_data_dir(self.data_dir_name)).print()
+
 
 class EnvoHeadless(EnvoBase):
     @dataclass
@@ -348,18 +369,21 @@ class EnvoHeadless(EnvoBase):
         pass
 
     def init(self, *args: Any, **kwargs: Any) -> None:
+        self._init_mode(HeadlessMode, self.find_env())
+
+    def _init_mode(self, mode_class: Type[HeadlessMode], env_path: Path) -> None:
         self.restart_count += 1
         self.shell.reset()
 
-        self.mode = HeadlessMode(
-            se=HeadlessMode.Sets(
+        self.mode = mode_class(
+            se=mode_class.Sets(
                 stage=self.se.stage,
                 restart_nr=self.restart_count,
                 msg="",
-                env_path=self.find_env(),
+                env_path=env_path,
             ),
-            calls=HeadlessMode.Callbacks(restart=Callback(self.restart), on_error=Callback(self.on_error)),
-            li=HeadlessMode.Links(shell=self.shell),
+            calls=mode_class.Callbacks(restart=Callback(self.restart), on_error=Callback(self.on_error)),
+            li=mode_class.Links(shell=self.shell),
         )
         self.mode.init()
 
@@ -374,17 +398,107 @@ class EnvoHeadless(EnvoBase):
         else:
             sys.exit(self.shell.last_return_code)
 
+    def _get_dry_run(self, env: Env) -> str:
+        return "\n".join([f'export {k}="{v}"' for k, v in env.get_env_vars().items()])
+
+    def _dump(self, env: Env) -> str:
+        path = env.dump_dot_env()
+        return f"Saved envs to {str(path)} 💾"
+
     def dry_run(self) -> None:
         self.shell = Shell.create(Shell.Callbacks(), data_dir_name=self.data_dir_name)
         self.init()
-        content = "\n".join([f'export {k}="{v}"' for k, v in self.mode.shell_env.env.get_env_vars().items()])
-        print(content)
+        print(self._get_dry_run(self.mode.shell_env.env))
 
     def dump(self) -> None:
         self.shell = Shell.create(Shell.Callbacks(), data_dir_name=self.data_dir_name)
         self.init()
-        path = self.mode.shell_env.env.dump_dot_env()
-        logger.info(f"Saved envs to {str(path)} 💾")
+        logger.info(self._dump(self.mode.shell_env.env))
+
+    def get_stage_files(self, stages: Optional[List[str]] = None) -> List[Tuple[const.Stage, Path]]:
+        """
+        Return env files of the given stages (all if not given) from the directory of the current env.
+        """
+        env_dir = self.find_env().parent
+        ret = []
+        for p in self._get_env_files(env_dir):
+            stage = const.STAGES.filename_to_stage(p.name)
+            if stage and (stages is None or stage.name in stages):
+                ret.append((stage, p))
+
+        missing = set(stages or []) - {s.name for s, _ in ret}
+        if missing:
+            raise EnvoError(f"Couldn't find env files for stages: {', '.join(sorted(missing))}")
+
+        return sorted(ret, key=lambda x: x[0].priority, reverse=True)
+
+    def _get_global_state(self) -> Tuple[Dict[str, str], str]:
+        environ = {k: v for k, v in os.environ.items() if k != "ENVO_VERBOSE_RUN"}
+        return environ, os.getcwd()
+
+    def _run_stage_isolated(self, stage: const.Stage, option_name: str) -> Tuple[int, str]:
+        logger.debug(f'Running stage "{stage.name}" in a separate process')
+        ret = subprocess.run(
+            [sys.executable, "-m", "envo", stage.name, option_name], stdout=subprocess.PIPE, universal_newlines=True
+        )
+        return ret.returncode, ret.stdout
+
+    def _run_stages(
+        self, stages: Optional[List[str]], fun: Callable[[Env], str], option_name: str, headers: bool = False
+    ) -> None:
+        """
+        Evaluate stages one after another in this process and print what fun returns for each of them.
+
+        Stages that fail or leave global state (os.environ, cwd) changed after unloading are evaluated again
+        in a separate process.
+        """
+        stage_files = self.get_stage_files(stages)
+
+        self.shell = Shell.create(Shell.Callbacks(), data_dir_name=self.data_dir_name)
+        unload_env_modules()
+
+        failed = False
+        for stage, path in stage_files:
+            state_before = self._get_global_state()
+            self.se.stage = stage.name
+
+            result: Optional[str]
+            try:
+                self._init_mode(StagesMode, path)
+                result = fun(self.mode.shell_env.env)
+            except (Exception, SystemExit) as e:
+                logger.debug(f'Stage "{stage.name}" failed in shared process ({e!r})')
+                result = None
+            finally:
+                if self.mode:
+                    self.mode.unload()
+                    self.mode = None  # type: ignore
+
+            environ_before, cwd_before = state_before
+            if self._get_global_state() != state_before:
+                logger.debug(f'Stage "{stage.name}" changed global state')
+                misc.update_environ(os.environ, environ_before, remove_missing=True)
+                os.chdir(cwd_before)
+                result = None
+
+            if result is None:
+                # modules of a misbehaving stage can't be trusted anymore
+                unload_env_modules()
+                return_code, result = self._run_stage_isolated(stage, option_name)
+                failed = failed or return_code != 0
+
+            if headers:
+                print(f"# {stage.name}")
+            print(result.rstrip("\n"))
+
+        if failed:
+            sys.exit(1)
+
+    def dry_run_stages(self, stages: Optional[List[str]] = None) -> None:
+        self._run_stages(stages, self._get_dry_run, "dry-run", headers=True)
+
+    def dump_stages(self, stages: Optional[List[str]] = None) -> None:
+        self._run_stages(stages, self._dump, "dump")
 
 
 class Envo(EnvoBase):
@@ -546,18 +660,69 @@ class Command(BaseOption):
         env_headless.single_command(self.flesh)
 
 
+def parse_stages(flesh: str) -> Tuple[bool, Optional[List[str]]]:
+    """
+    Parse "--stages=all" or "--stages=local,test" argument.
+
+    :return: (whether stages were given, stage names or None for all)
+    """
+    args = flesh.split()
+    if not args:
+        return False, None
+
+    if len(args) == 2 and args[0] == "--stages":
+        value = args[1]
+    elif len(args) == 1 and args[0].startswith("--stages="):
+        value = args[0][len("--stages=") :]
+    else:
+        raise EnvoError(f'Unknown arguments "{flesh}" (expected --stages=all or --stages=stage1,stage2)')
+
+    if value == "all":
+        return True, None
+
+    stages = [s.strip() for s in value.split(",") if s.strip()]
+    if not stages:
+        raise EnvoError("No stages given")
+    return True, stages
+
+
 @dataclass
 class DryRun(BaseOption):
     def run(self) -> None:
+        multiple, stages = parse_stages(self.flesh)
         envo.e2e.envo = env_headless = EnvoHeadless(EnvoHeadless.Sets(stage=self.stage))
-        env_headless.dry_run()
+        if multiple:
+            env_headless.dry_run_stages(stages)
+        else:
+            env_headless.dry_run()
 
 
 @dataclass
 class Dump(BaseOption):
     def run(self) -> None:
+        multiple, stages = parse_stages(self.flesh)
         envo.e2e.envo = env_headless = EnvoHeadless(EnvoHeadless.Sets(stage=self.stage))
-        env_headless.dump()
+        if multiple:
+            env_headless.dump_stages(stages)
+        else:
+            env_headless.dump()
+
+
+@dataclass
+class Stats(BaseOption):
+    def run(self) -> None:
+        EnvoHeadless(EnvoHeadless.Sets(stage=self.stage)).stats()
+
+
+@dataclass
+class Index(BaseOption):
+    def run(self) -> None:
+        index = get_env_index()
+        if not index:
+            raise EnvoError("Can't find repo root (missing .git directory?)")
+
+        index.update()
+        index.print()
 
 
 @dataclass
@@ -588,6 +753,8 @@ option_name_to_option: Dict[str, Type[BaseOption]] = {
     "run": Command,
     "dry-run": DryRun,
     "dump": Dump,
+    "stats": Stats,
+    "index": Index,
     "": Start,
     "init": Init,
     "version": Version,
@@ -598,7 +765,7 @@ def _main() -> None:
     logger.debug("Starting")
 
     argv = sys.argv[1:]
-    keywords = ["init", "dry-run", "version", "dump", "run"]
+    keywords = ["init", "dry-run", "version", "dump", "run", "stats", "index"]
 
     stage = os.environ.get("ENVO_STAGE", DEFAULT_STAGE)
 
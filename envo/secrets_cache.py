@@ -0,0 +1,183 @@
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from envo import logger
+
+__all__ = ["SecretsCache"]
+
+
+class DecryptionError(Exception):
+    pass
+
+
+class Cipher:
+    """
+    Authenticated encryption with the standard library only.
+
+    Keystream is HMAC-SHA256 in counter mode (keyed PRF), ciphertext is authenticated with a separate
+    HMAC-SHA256 key (encrypt-then-MAC). Keys are derived with scrypt from a passphrase or directly from
+    a random key.
+    """
+
+    magic = b"ENVOSEC1"
+    salt_size = 16
+    nonce_size = 16
+    tag_size = 32
+
+    def __init__(self, secret: bytes, stretch: bool) -> None:
+        """
+        :param secret: passphrase or random key
+        :param stretch: derive keys with scrypt (for low entropy passphrases)
+        """
+        self.secret = secret
+        self.stretch = stretch
+
+    def _get_keys(self, salt: bytes) -> Tuple[bytes, bytes]:
+        if self.stretch:
+            key = hashlib.scrypt(self.secret, salt=salt, n=2 ** 14, r=8, p=1, dklen=64)
+        else:
+            key = hmac.new(self.secret, salt, hashlib.sha512).digest()
+        return key[:32], key[32:]
+
+    def _xor_keystream(self, key: bytes, nonce: bytes, data: bytes) -> bytes:
+        keystream = b"".join(
+            hmac.new(key, nonce + i.to_bytes(8, "big"), hashlib.sha256).digest() for i in range(len(data) // 32 + 1)
+        )
+        return bytes(a ^ b for a, b in zip(data, keystream))
+
+    def encrypt(self, data: bytes) -> bytes:
+        salt = os.urandom(self.salt_size)
+        nonce = os.urandom(self.nonce_size)
+        enc_key, mac_key = self._get_keys(salt)
+
+        header = self.magic + salt + nonce
+        ciphertext = self._xor_keystream(enc_key, nonce, data)
+        tag = hmac.new(mac_key, header + ciphertext, hashlib.sha256).digest()
+        return header + ciphertext + tag
+
+    def decrypt(self, blob: bytes) -> bytes:
+        header_size = len(self.magic) + self.salt_size + self.nonce_size
+        if len(blob) < header_size + self.tag_size or not blob.startswith(self.magic):
+            raise DecryptionError("Unknown format")
+
+        salt = blob[len(self.magic) : len(self.magic) + self.salt_size]
+        nonce = blob[len(self.magic) + self.salt_size : header_size]
+        ciphertext, tag = blob[header_size : -self.tag_size], blob[-self.tag_size :]
+        enc_key, mac_key = self._get_keys(salt)
+
+        if not hmac.compare_digest(hmac.new(mac_key, blob[: -self.tag_size], hashlib.sha256).digest(), tag):
+            raise DecryptionError("Wrong key or corrupted data")
+
+        return self._xor_keystream(enc_key, nonce, ciphertext)
+
+
+class SecretsCache:
+    """
+    Encrypted on-disk cache of secret values with a ttl per secret.
+
+    Key comes from the ENVO_SECRETS_PASSPHRASE environment variable or, if it's not set, from a random key
+    file readable only by the user (stand-in for an OS keyring). Undecryptable cache (wrong passphrase,
+    tampered file) is treated as empty.
+    """
+
+    passphrase_env_var = "ENVO_SECRETS_PASSPHRASE"
+
+    def __init__(self, path: Path, passphrase: Optional[str] = None, key_file: Optional[Path] = None) -> None:
+        self.path = path
+        self.key_file = key_file or Path.home() / ".envo/secrets.key"
+
+        passphrase = passphrase or os.environ.get(self.passphrase_env_var)
+        self._passphrase = passphrase.encode("utf-8") if passphrase else None
+        self._cipher: Optional[Cipher] = None
+        # fullname -> (value, expiration timestamp)
+        self._entries: Optional[Dict[str, Tuple[Any, Optional[float]]]] = None
+
+    def _get_cipher(self) -> Cipher:
+        if self._cipher:
+            return self._cipher
+
+        if self._passphrase:
+            self._cipher = Cipher(self._passphrase, stretch=True)
+            return self._cipher
+
+        if not self.key_file.exists():
+            self.key_file.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.key_file), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_bytes(32))
+
+        self._cipher = Cipher(self.key_file.read_bytes(), stretch=False)
+        return self._cipher
+
+    def _load(self) -> Dict[str, Tuple[Any, Optional[float]]]:
+        if self._entries is not None:
+            return self._entries
+
+        self._entries = {}
+        if not self.path.exists():
+            return self._entries
+
+        try:
+            data = json.loads(self._get_cipher().decrypt(self.path.read_bytes()).decode("utf-8"))
+            self._entries = {k: (v, e) for k, (v, e) in data.items()}
+        except (OSError, ValueError, TypeError, DecryptionError) as e:
+            logger.debug("Can't read secrets cache", {"error": str(e)})
+
+        return self._entries
+
+    def _save(self) -> None:
+        entries = self._load()
+        now = time.time()
+        data = {k: [v, e] for k, (v, e) in entries.items() if e is None or e > now}
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            fd = os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._get_cipher().encrypt(json.dumps(data).encode("utf-8")))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.debug("Can't save secrets cache", {"error": str(e)})
+
+    def get(self, name: str) -> Tuple[bool, Any]:
+        """
+        :return: (found, value)
+        """
+        entry = self._load().get(name)
+        if entry is None:
+            return False, None
+
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            return False, None
+
+        return True, value
+
+    def set(self, name: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        :param ttl: seconds after which the value expires, never expires if None
+        """
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            logger.debug(f'Secret "{name}" is not serializable, not caching')
+            return
+
+        self._load()[name] = (value, time.time() + ttl if ttl is not None else None)
+        self._save()
+
+    def delete(self, name: str) -> None:
+        if self._load().pop(name, None) is not None:
+            self._save()
+
+    def clear(self) -> None:
+        self._entries = {}
+        if self.path.exists():
+            self.path.unlink()
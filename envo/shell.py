@@ -20,7 +20,9 @@ from xonsh.readline_shell import ReadlineShell
 
 import envo
 from envo import logger
+from envo.executables import ExecutableIndex, IndexedCommandsCache
 from envo.misc import Callback, is_windows
+from envo.stats import Record, command_stats, get_args_hash
 
 
 class PromptState(Enum):
@@ -133,21 +135,26 @@ class Shell(BaseShell):  # type: ignore
             namespace = name.split(".")[0]
             self.add_namespace_if_not_exists(namespace)
 
-        max_lenght = 50
-        try:
-            log_value = str(value) if len(str(value)) < max_lenght else f"{str(value)[0:max_lenght]}(...)"
-            log_value = log_value.replace("{", "{{")
-            log_value = log_value.replace("}", "}}")
-        except Exception as e:
-            log_value = repr(e)
-
-        logger.debug(f'Setting "{name} = {log_value}" variable')
+        logger.debug(lambda: f'Setting "{name} = {self._get_log_value(value)}" variable')
 
         built_in_name = f"__envo_{name}__"
         built_in_name = built_in_name.replace(".", "_")
         setattr(builtins, built_in_name, value)
         exec(f"{name} = {built_in_name}", builtins.__dict__)
 
+    @staticmethod
+    def _get_log_value(value: Any) -> str:
+        max_lenght = 50
+        try:
+            value_str = str(value)
+        except Exception as e:
+            return repr(e)
+
+        log_value = value_str if len(value_str) < max_lenght else f"{value_str[0:max_lenght]}(...)"
+        log_value = log_value.replace("{", "{{")
+        log_value = log_value.replace("}", "}}")
+        return log_value
+
     def _execute_with_fire(self, fun: Callable, command: str) -> Any:
         argv_before = sys.argv.copy()
         sys.argv = shlex.split(command)
@@ -180,7 +187,7 @@ class Shell(BaseShell):  # type: ignore
         run_compiled_code(c, self.ctx, None, "single")
 
     def run_code(self, code: str) -> None:
-        logger.debug(f'Running code """{code}"""')
+        logger.debug(lambda: f'Running code """{code}"""')
         self._run_code(code)
 
     def start(self) -> None:
@@ -198,6 +205,10 @@ class Shell(BaseShell):  # type: ignore
 
         return str(ansi_partial_color_format(super().prompt))
 
+    @classmethod
+    def get_data_dir(cls, data_dir_name: str) -> Path:
+        return Path.home() / f".envo/xonsh_data/{data_dir_name}"
+
     @classmethod
     def create(cls, calls: Callbacks, data_dir_name: str) -> "Shell":
         import signal
@@ -209,14 +220,16 @@ class Shell(BaseShell):  # type: ignore
 
         ctx: Dict[str, Any] = {}
 
-        data_dir = Path.home() / f".envo/xonsh_data/{data_dir_name}"
+        data_dir = cls.get_data_dir(data_dir_name)
         os.makedirs(data_dir, exist_ok=True)
+        command_stats.set_data_dir(data_dir)
 
         execer = Execer(xonsh_ctx=ctx)
 
         builtins.__xonsh__ = XonshSession(ctx=ctx, execer=execer)  # type: ignore
 
         load_builtins(ctx=ctx, execer=execer)
+        builtins.__xonsh__.commands_cache = IndexedCommandsCache(ExecutableIndex(data_dir))  # type: ignore
         env = builtins.__xonsh__.env  # type: ignore
         env.update(
             {
@@ -266,6 +279,11 @@ class Shell(BaseShell):  # type: ignore
         std_out_content = []
         std_err_content = []
 
+        typed_line = line
+        start = time.perf_counter()
+        # commands that don't set it (e.g. python code) mustn't report the previous command's return code
+        self.last_return_code = 0
+
         try:
             # W want to catch all exceptions just in case the command fails so we can handle std_err and post_cmd
             self.append_history = BaseShell._append_history
@@ -324,8 +342,30 @@ class Shell(BaseShell):  # type: ignore
                 self.last_return_code = self.history.last_cmd_rtn
                 self.history.flush()
 
+            if typed_line.strip():
+                # output is only seen when it's intercepted
+                output = std_out_content + std_err_content if self.calls.on_stdout else None
+                self._record_stats(typed_line, time.perf_counter() - start, output)
+
         return ret
 
+    def _record_stats(self, line: str, duration: float, output: Optional[List[Union[bytes, str]]]) -> None:
+        output_bytes = None
+        if output is not None:
+            output_bytes = sum(len(o if isinstance(o, bytes) else o.encode("utf-8", errors="replace")) for o in output)
+
+        command_stats.append(
+            Record(
+                time=time.time() - duration,
+                kind="shell",
+                name=line.split()[0],
+                args_hash=get_args_hash(line),
+                duration=duration,
+                status=self.last_return_code or 0,
+                output_bytes=output_bytes,
+            )
+        )
+
 
 class FancyShell(Shell, PromptToolkitShell):  # type: ignore
     @dataclass
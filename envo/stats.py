@@ -0,0 +1,248 @@
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from envo import console, logger
+
+__all__ = ["Record", "Summary", "CommandStats", "command_stats"]
+
+
+def get_args_hash(args: Any) -> str:
+    return hashlib.md5(repr(args).encode("utf-8")).hexdigest()[:8]
+
+
+def _get_percentile(sorted_values: List[float], percent: float) -> float:
+    # nearest-rank
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def _format_duration(duration: float) -> str:
+    if duration < 1:
+        return f"{duration * 1000:.0f}ms"
+    return f"{duration:.2f}s"
+
+
+@dataclass
+class Record:
+    """
+    Single invocation of a command (or a hook, or a shell line).
+    """
+
+    time: float
+    kind: str
+    name: str
+    args_hash: str
+    duration: float
+    status: int
+    output_bytes: Optional[int] = None
+
+    def to_line(self) -> str:
+        name = " ".join(self.name.split())
+        output_bytes = "" if self.output_bytes is None else str(self.output_bytes)
+        return (
+            f"{self.time:.3f}\t{self.kind}\t{name}\t{self.args_hash}\t{self.duration:.6f}\t{self.status}"
+            f"\t{output_bytes}\n"
+        )
+
+    @classmethod
+    def from_line(cls, line: str) -> Optional["Record"]:
+        parts = line.rstrip("\n").split("\t")
+        if len(parts) != 7:
+            return None
+
+        try:
+            return cls(
+                time=float(parts[0]),
+                kind=parts[1],
+                name=parts[2],
+                args_hash=parts[3],
+                duration=float(parts[4]),
+                status=int(parts[5]),
+                output_bytes=int(parts[6]) if parts[6] else None,
+            )
+        except ValueError:
+            return None
+
+
+@dataclass
+class Summary:
+    kind: str
+    name: str
+    runs: int
+    failures: int
+    p50: float
+    p95: float
+    last: float
+    # median of the recent runs when they are significantly slower than the earlier ones
+    regression: Optional[float] = None
+
+
+class CommandStats:
+    """
+    Timing history of commands.
+
+    Records are appended to a tab separated file in the shell data dir. When the file grows over max_bytes
+    it's rewritten with only the last keep records of each command.
+    """
+
+    file_name = "stats.tsv"
+
+    def __init__(
+        self,
+        data_dir: Optional[Path] = None,
+        max_bytes: int = 256 * 1024,
+        keep: int = 200,
+        recent: int = 5,
+        regression_ratio: float = 1.5,
+    ) -> None:
+        """
+        :param data_dir: directory of the stats file, nothing is recorded if not set
+        :param recent: number of the last runs compared with the earlier ones to detect regressions
+        :param regression_ratio: recent runs slower by this ratio are reported as a regression
+        """
+        self.data_dir = data_dir
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.recent = recent
+        self.regression_ratio = regression_ratio
+
+    @property
+    def path(self) -> Optional[Path]:
+        return self.data_dir / self.file_name if self.data_dir else None
+
+    def set_data_dir(self, data_dir: Optional[Path]) -> None:
+        self.data_dir = data_dir
+
+    def append(self, record: Record) -> None:
+        if not self.path:
+            return
+
+        try:
+            # single write of a short line to a file opened in append mode doesn't interleave with other processes
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(record.to_line())
+
+            if self.path.stat().st_size > self.max_bytes:
+                self.compact()
+        except OSError as e:
+            logger.debug("Can't save command stats", {"error": str(e)})
+
+    @contextmanager
+    def measure(self, kind: str, name: str, args: Any = None) -> Iterator[Record]:
+        """
+        Record duration and exit status of the code run in the context.
+        """
+        args_hash = get_args_hash(args) if self.path else ""
+        record = Record(time=time.time(), kind=kind, name=name, args_hash=args_hash, duration=0, status=0)
+        start = time.perf_counter()
+        try:
+            yield record
+        except SystemExit as e:
+            if e.code is None:
+                # sys.exit() without a code means success
+                record.status = 0
+            else:
+                record.status = e.code if isinstance(e.code, int) else 1
+            raise
+        except BaseException:
+            record.status = 1
+            raise
+        finally:
+            record.duration = time.perf_counter() - start
+            self.append(record)
+
+    def get_records(self) -> List[Record]:
+        if not self.path or not self.path.exists():
+            return []
+
+        records = []
+        with self.path.open("r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                record = Record.from_line(line)
+                # skip torn lines
+                if record:
+                    records.append(record)
+        return records
+
+    def compact(self) -> None:
+        if not self.path:
+            return
+
+        kept: Dict[Tuple[str, str], Deque[Record]] = OrderedDict()
+        for r in self.get_records():
+            kept.setdefault((r.kind, r.name), deque(maxlen=self.keep)).append(r)
+
+        records = sorted((r for rs in kept.values() for r in rs), key=lambda r: r.time)
+
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text("".join(r.to_line() for r in records), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+    def get_summaries(self) -> List[Summary]:
+        grouped: Dict[Tuple[str, str], List[Record]] = OrderedDict()
+        for r in sorted(self.get_records(), key=lambda r: r.time):
+            grouped.setdefault((r.kind, r.name), []).append(r)
+
+        summaries = []
+        for (kind, name), records in grouped.items():
+            durations = sorted(r.duration for r in records)
+            summary = Summary(
+                kind=kind,
+                name=name,
+                runs=len(records),
+                failures=len([r for r in records if r.status != 0]),
+                p50=_get_percentile(durations, 50),
+                p95=_get_percentile(durations, 95),
+                last=records[-1].duration,
+            )
+
+            if len(records) >= 2 * self.recent:
+                baseline = _get_percentile(sorted(r.duration for r in records[: -self.recent]), 50)
+                recent = _get_percentile(sorted(r.duration for r in records[-self.recent :]), 50)
+                if recent > baseline * self.regression_ratio:
+                    summary.regression = recent
+
+            summaries.append(summary)
+
+        return summaries
+
+    def print(self) -> None:
+        from rich.table import Table
+
+        summaries = self.get_summaries()
+        if not summaries:
+            console.print("No command stats recorded yet")
+            return
+
+        table = Table()
+        for c in ["Kind", "Name", "Runs", "Failed", "p50", "p95", "Last", "Regression"]:
+            table.add_column(c, justify="left" if c in ["Kind", "Name", "Regression"] else "right")
+
+        for s in sorted(summaries, key=lambda s: (s.kind, -s.p50)):
+            regression = ""
+            if s.regression is not None:
+                regression = f"[red]recent p50 {_format_duration(s.regression)}[/red]"
+
+            table.add_row(
+                s.kind,
+                s.name,
+                str(s.runs),
+                str(s.failures),
+                _format_duration(s.p50),
+                _format_duration(s.p95),
+                _format_duration(s.last),
+                regression,
+            )
+
+        console.print(table)
+
+
+# set up by the shell to its data dir
+command_stats = CommandStats()
@@ -65,5 +65,5 @@ class Status:
             logger.debug("Everything ready")
             self.calls.on_ready()
         else:
-            logger.debug(f"Not ready {repr(self)}")
+            logger.debug(lambda: f"Not ready {repr(self)}")
             self.calls.on_not_ready()
@@ -7,9 +7,9 @@ from pathlib import Path
 from typing import List, Optional, Union
 
 import envium
-from envium import env_var
 
 from envo import Env, Namespace, logger
+from envo.env import path_var
 from envo.misc import is_windows
 
 
@@ -66,7 +66,7 @@ class BaseVenv:
     venv_path: VenvPath = field(init=False)
 
     class Environ(envium.Environ):
-        path: List[Path] = env_var(raw=True, default_factory=list)
+        path: List[Path] = path_var(raw=True)
 
     def __post_init__(self) -> None:
         self.e = self.Environ(name="envo", load=True)
@@ -115,15 +115,16 @@ class PredictedVenv(BaseVenv):
 
     def activate(self, e: Optional[Env.Environ] = None) -> None:
         super().activate(e)
+        in_sys_path = set(sys.path)
         for d in self.venv_path.possible_site_packages:
-            if str(d) not in sys.path:
+            if str(d) not in in_sys_path:
                 sys.path.insert(0, str(d))
+                in_sys_path.add(str(d))
 
     def deactivate(self, e: Optional[Env.Environ] = None) -> None:
         super().deactivate(e)
-        for d in self.venv_path.possible_site_packages:
-            if str(d) in sys.path:
-                sys.path.remove(str(d))
+        site_packages = {str(d) for d in self.venv_path.possible_site_packages}
+        sys.path[:] = [p for p in sys.path if p not in site_packages]
 
 
 @dataclass
@@ -65,6 +65,20 @@ class TestMisc(utils.TestBase):
             content,
         )
 
+    def test_dump_all_stages(self):
+        ret = utils.run("envo dump --stages=all")
+        assert "Saved envs to .env_test" in ret
+        assert "Saved envs to .env_comm" in ret
+
+        assert 'SANDBOX_STAGE="test"' in Path(".env_test").read_text()
+        assert 'SANDBOX_STAGE="comm"' in Path(".env_comm").read_text()
+
+    def test_dry_run_stages(self):
+        ret = utils.run("envo dry-run --stages=test,comm")
+        # ordered by stage priority
+        assert re.match(r'# comm\n(export .*\n)*export SANDBOX_STAGE="comm"\n# test\n', ret)
+        assert 'export SANDBOX_STAGE="test"' in ret
+
     @pytest.mark.parametrize("dir_name", ["my-sand-box", "my sandbox", ".sandbox", ".san.d- b  ox"])
     def test_init_weird_dir_name(self, shell, dir_name):
         env_dir = Path(dir_name)
@@ -74,6 +74,35 @@ class TestCommands(utils.TestBase):
         shell.exit()
         e.exit().eval()
 
+    def test_background_jobs(self, shell):
+        utils.add_command(
+            """
+        @command(in_root=False)
+        def cmd(self) -> str:
+            run(f"sleep 10", background=True)
+        """
+        )
+
+        e = shell.start()
+        e.prompt().eval()
+
+        shell.sendline("cmd")
+        e.prompt().eval()
+
+        shell.sendline("bg_jobs")
+        e.output(r"\[1\] \d+ +running +sleep 10 .*job_1\.log\)\n")
+        e.prompt().eval()
+
+        shell.sendline("bg_kill 1")
+        e.prompt().eval()
+
+        shell.sendline("bg_wait")
+        e.output(r"\[1\] exited \(-15\)\n")
+        e.prompt().eval()
+
+        shell.exit()
+        e.exit().eval()
+
     def test_multiple_cmds(self, shell):
         utils.add_command(
             """
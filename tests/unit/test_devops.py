@@ -1,10 +1,21 @@
 import os
+import subprocess
+import time
+from pathlib import Path
 
 import pytest
 from pytest import raises
 
 from envo.misc import is_linux, is_windows
-from tests.facade import run, run_get
+from tests.facade import (
+    CommandError,
+    JobRegistry,
+    Resources,
+    run,
+    run_capture,
+    run_get,
+    run_get_stream,
+)
 
 
 @pytest.mark.skipif(not is_linux(), reason="Platform specific")
@@ -19,6 +30,24 @@ class TestLinuxRun:
         assert read.out == ""
         assert read.err == ""
 
+    def test_print_output_false_big_output(self, capfd):
+        ret = run("head -c 1000000 /dev/zero; head -c 1000000 /dev/zero 1>&2", print_output=False, print_errors=False)
+        assert ret == 0
+        assert capfd.readouterr().out == ""
+
+    def test_run_capture(self, capfd):
+        output = run_capture(
+            "head -c 1000000 /dev/zero | tr '\\0' a; echo; echo err 1>&2; exit 3", raise_on_error=False
+        )
+        assert output.return_code == 3
+        assert output.stdout == "a" * 1000000 + "\n"
+        assert output.stderr == "err\n"
+
+        output = run_capture('echo "test1"; echo "test2"; echo "err" 1>&2', print_output=True, max_bytes=6)
+        assert output.return_code == 0
+        assert output.stdout == "test2\n"
+        assert capfd.readouterr().out == "test1\ntest2\n"
+
     def test_run_simple_echo_print(self, capfd):
         run('echo "test"', print_output=True, verbose=False)
         read = capfd.readouterr()
@@ -84,6 +113,160 @@ class TestLinuxRun:
 
         assert e.value.code == 1
 
+    def test_run_get_stream(self):
+        stream = run_get_stream('echo "out1"; sleep 0.1; echo "err1" 1>&2; sleep 0.1; printf "out2"')
+        assert list(stream) == [("stdout", "out1\n"), ("stderr", "err1\n"), ("stdout", "out2")]
+        assert stream.return_code == 0
+
+    def test_run_get_stream_big_output(self):
+        stream = run_get_stream("head -c 1000000 /dev/zero; head -c 1000000 /dev/zero 1>&2", lines=False)
+        sizes = {"stdout": 0, "stderr": 0}
+        for name, text in stream:
+            sizes[name] += len(text)
+
+        assert sizes == {"stdout": 1000000, "stderr": 1000000}
+
+    def test_run_get_stream_timeout(self):
+        stream = run_get_stream("echo before; sleep 10 & sleep 10; echo after", timeout=0.5, tail=1)
+        start = time.monotonic()
+
+        with pytest.raises(CommandError, match=r"timed out after 0\.5s\nbefore\n"):
+            list(stream)
+
+        assert time.monotonic() - start < 2
+
+    def test_run_get_process_group(self):
+        # stays in the foreground process group so it can read from the terminal
+        pid, pgid = map(int, run_get("echo $$ $(ps -o pgid= -p $$)").stdout.split())
+        assert pgid == os.getpgid(0)
+
+        # own process group so it can be killed as a whole on timeout
+        pid, pgid = map(int, run_get("echo $$ $(ps -o pgid= -p $$)", timeout=5).stdout.split())
+        assert pgid == pid
+
+    def test_run_get_stream_error(self):
+        with pytest.raises(CommandError, match=r"failed with return code 3\nline2\nline3\n"):
+            list(run_get_stream("echo line1; echo line2; echo line3; exit 3", tail=2, raise_on_error=True))
+
+    def test_pooled(self, capfd, env_sandbox):
+        run('echo "test"; printf "no newline" 1>&2', pooled=True, verbose=False)
+        out, err = capfd.readouterr()
+        assert out == "test\n"
+        assert err == "no newline"
+
+        os.environ["ENVO_POOLED_VAR"] = "some 'value'"
+        Path("child").mkdir()
+        os.chdir("child")
+        run(
+            "export OTHER_VAR=1; echo $ENVO_POOLED_VAR; pwd; mkdir -p a/b; touch a/b/f; ls **/f",
+            pooled=True,
+            verbose=False,
+        )
+        assert capfd.readouterr().out == f"some 'value'\n{Path('.').absolute()}\na/b/f\n"
+
+        # subshell isolation
+        run('echo "${OTHER_VAR:-unset}"', pooled=True, verbose=False)
+        assert capfd.readouterr().out == "unset\n"
+
+    def test_pooled_errors(self, capfd):
+        with pytest.raises(SystemExit) as e:
+            run("echo test1; missing_command; echo test2", pooled=True, verbose=False)
+
+        assert e.value.code == 127
+        assert capfd.readouterr().out == "test1\n"
+
+        assert run("exit 3", pooled=True, raise_on_error=False, verbose=False) == 3
+        assert run("echo test", pooled=True, print_output=False, verbose=False) == 0
+        assert capfd.readouterr().out == ""
+
+    def test_background_jobs(self, capfd, sandbox):
+        registry = JobRegistry(logs_dir=sandbox / "jobs", max_log_bytes=10, log_backups=1)
+
+        job = registry.start("echo 1234567; sleep 0.1; echo abc 1>&2", print_output=False, print_errors=False)
+        assert registry.wait(job.id) == {job.id: 0}
+        time.sleep(0.1)
+
+        assert capfd.readouterr().out == ""
+        assert Path(f"{job.log_file}.1").read_text() == "1234567\n"
+        assert job.log_file.read_text() == "abc\n"
+
+        job = registry.start("sleep 10 & sleep 10")
+        assert registry.wait(job.id, timeout=0.1) == {job.id: None}
+        registry.cleanup()
+        assert not (sandbox / "jobs").exists()
+
+        assert not job.running
+        assert registry.get() == []
+
+    def test_background_jobs_stale_logs(self, sandbox, mocker):
+        mocker.patch.object(Path, "home", return_value=sandbox)
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        (sandbox / f".envo/jobs/{dead.pid}").mkdir(parents=True)
+        (sandbox / f".envo/jobs/{os.getppid()}").mkdir()
+
+        registry = JobRegistry()
+        registry.wait(registry.start("true", print_output=False).id)
+
+        logs_dirs = {p.name for p in (sandbox / ".envo/jobs").iterdir()}
+        assert logs_dirs == {str(os.getpid()), str(os.getppid())}
+        registry.cleanup()
+
+    def test_resources(self, capfd):
+        resources = Resources(nice=5, max_cpu_time=10, max_memory=2 ** 30, cpu_affinity=[0], io_class="idle")
+        result = run_get("nice; ulimit -t; ulimit -v; grep Cpus_allowed_list /proc/self/status", resources=resources)
+        assert result.stdout == f"{os.nice(0) + 5}\n10\n1048576\nCpus_allowed_list:\t0\n"
+
+        with pytest.raises(CommandError, match=r'Unknown I/O class "lowest"'):
+            run("echo test", resources=Resources(io_class="lowest"))
+
+        with pytest.raises(CommandError, match=r"I/O level has to be between 0 and 7 \(got 8\)"):
+            Resources(io_class="best-effort", io_level=8)
+
+    def test_resources_parallel(self, capfd):
+        # applied without preexec_fn so it's safe in worker threads
+        run(["nice", "ulimit -t"], parallel=2, verbose=False, resources=Resources(nice=2, max_cpu_time=5))
+
+        assert sorted(capfd.readouterr().out.splitlines()) == [f"[1/2] {os.nice(0) + 2}", "[2/2] 5"]
+
+    def test_default_resources(self, capfd, mocker):
+        mocker.patch("envo.devops.default_resources", Resources(nice=3))
+        base_nice = os.nice(0)
+
+        run("nice", verbose=False, pooled=True)
+        assert capfd.readouterr().out == f"{base_nice + 3}\n"
+
+        assert run_capture("nice").stdout == f"{base_nice + 3}\n"
+        assert run_get("nice", resources=Resources(nice=1)).stdout == f"{base_nice + 1}\n"
+
+    def test_parallel(self, capfd):
+        ret = run(['sleep 0.2; echo "test1"', 'echo "test2"; echo "test2" 1>&2'], parallel=2, verbose=False)
+        out, err = capfd.readouterr()
+
+        assert ret == 0
+        assert out.splitlines() == ["[2/2] test2", "[1/2] test1"]
+        assert err == "[2/2] test2\n"
+
+    def test_parallel_streams_output(self, capfd):
+        # buffered output of the first command would be printed after the second one
+        ret = run(['echo "test1"; sleep 1; printf "end1"', 'sleep 0.3; echo "test2"'], parallel=2, verbose=False)
+
+        assert ret == 0
+        assert capfd.readouterr().out.splitlines() == ["[1/2] test1", "[2/2] test2", "[1/2] end1"]
+
+    def test_parallel_fail_fast(self, capfd):
+        with pytest.raises(SystemExit) as e:
+            run(["sleep 5; echo test1", "exit 3", "echo test3"], parallel=2, verbose=False)
+
+        assert e.value.code == 3
+        assert "test1" not in capfd.readouterr().out
+
+    def test_parallel_collect_all(self, capfd):
+        ret = run(["exit 3", "exit 4", "echo test3"], parallel=3, verbose=False, fail_fast=False, raise_on_error=False)
+
+        assert ret == 3
+        assert capfd.readouterr().out == "[3/3] test3\n"
+
 
 @pytest.mark.skipif(not is_windows(), reason="Platform specific")
 class TestWindowsRun:
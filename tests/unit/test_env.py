@@ -0,0 +1,445 @@
+import inspect
+import os
+import re
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import envium
+import pytest
+
+from envo.env import EnvVarsTracker
+from envo.misc import import_env_from_file
+from envo.secrets_cache import SecretsCache
+from tests.facade import (
+    ComputedEnvVar,
+    Env,
+    EnvoError,
+    Namespace,
+    command,
+    computed_env_var,
+    computed_secret,
+    env_var,
+    import_from_file,
+    magic_functions_registry,
+    secret,
+)
+from tests.unit import utils
+
+
+class TestMagicFunctionsRegistry(utils.TestBase):
+    @pytest.fixture(autouse=True)
+    def setup_registry(self):
+        magic_functions_registry.invalidate()
+        yield
+        magic_functions_registry.invalidate()
+
+    def get_env_class(self, name: str = "env_registry.py") -> type:
+        file = Path(name)
+        file.write_text(
+            "from pathlib import Path\n"
+            "from envo import Env, Namespace, command, onload\n"
+            'p = Namespace("p")\n'
+            "class RegistryEnv(Env):\n"
+            "    class Meta(Env.Meta):\n"
+            "        root = Path(__file__).parent\n"
+            "    @command\n"
+            "    def flake(self) -> None: ...\n"
+            "    @p.command\n"
+            "    def mypy(self) -> None: ...\n"
+            "    @onload\n"
+            "    def _on_load(self) -> None: ...\n"
+        )
+        return import_from_file(file).RegistryEnv
+
+    def test_collect(self):
+        env_class = self.get_env_class()
+        table = magic_functions_registry.get(env_class)
+
+        assert set(table["command"].keys()) == {"flake", "p.mypy"}
+        assert set(table["onload"].keys()) == {"_on_load"}
+        assert table["command"]["flake"] is env_class.__dict__["flake"]
+
+        with pytest.raises(TypeError):
+            table["command"]["other"] = None
+
+    def test_cached(self, mocker):
+        env_class = self.get_env_class()
+        scan = mocker.spy(magic_functions_registry, "_scan")
+
+        magic_functions_registry.get(env_class)
+        scanned_n = scan.call_count
+        magic_functions_registry.get(env_class)
+
+        assert scan.call_count == scanned_n
+
+    def test_invalidated_on_source_change(self, mocker):
+        env_class = self.get_env_class()
+        magic_functions_registry.get(env_class)
+
+        file = Path("env_registry.py")
+        file.write_text(file.read_text().replace("def flake", "def flake2") + "\n")
+        env_class = import_from_file(file).RegistryEnv
+
+        table = magic_functions_registry.get(env_class)
+        assert set(table["command"].keys()) == {"flake2", "p.mypy"}
+
+
+class TestCommandCache(utils.TestBase):
+    @pytest.fixture(autouse=True)
+    def setup_cache(self, mocker, sandbox):
+        mocker.patch("envo.env.Env.get_cache_dir", return_value=sandbox / ".cache")
+
+    def get_env(self) -> Env:
+        env_class = import_env_from_file("env_test.py").ThisEnv
+
+        class CachedEnv(env_class):
+            runs = []
+
+            @command(inputs=["src/*.txt"], outputs=["out.txt"], cache=True)
+            def build(self, suffix: str = "") -> None:
+                self.runs.append(suffix)
+                Path("out.txt").write_text("".join(p.read_text() for p in Path("src").glob("*.txt")) + suffix)
+
+        return CachedEnv()
+
+    def test_skips_when_up_to_date(self):
+        Path("src").mkdir()
+        Path("src/a.txt").write_text("a")
+        env = self.get_env()
+
+        env.build()
+        env.build()
+        assert env.runs == [""]
+
+        env.build(suffix="b")
+        assert env.runs == ["", "b"]
+
+        env.build("b")
+        assert env.runs == ["", "b"]
+
+    def test_reruns_on_changes(self):
+        Path("src").mkdir()
+        Path("src/a.txt").write_text("a")
+        env = self.get_env()
+
+        env.build()
+        Path("src/a.txt").write_text("aa")
+        env.build()
+        assert len(env.runs) == 2
+
+        Path("out.txt").unlink()
+        env.build()
+        assert len(env.runs) == 3
+
+    def test_force(self):
+        Path("src").mkdir()
+        Path("src/a.txt").write_text("a")
+        env = self.get_env()
+
+        env.build()
+        env.build(force=True)
+        assert len(env.runs) == 2
+
+        assert "force" in inspect.signature(env.build).parameters
+
+    def test_force_defined(self):
+        with pytest.raises(EnvoError):
+
+            class CachedEnv(Env):
+                @command(cache=True)
+                def build(self, force: bool = False) -> None:
+                    pass
+
+
+class TestTaskGraph:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox, env_sandbox, init, mock_shell):
+        # tasks are run in threads so threading can't be mocked (as in utils.TestBase)
+        self.env_class = import_env_from_file("env_test.py").ThisEnv
+
+    def get_env(self) -> Env:
+        p = Namespace("p")
+
+        class GraphEnv(self.env_class):
+            runs = []
+
+            def _task(self, name: str, duration: float = 0.0) -> None:
+                self.runs.append(f"{name}_start")
+                time.sleep(duration)
+                self.runs.append(f"{name}_end")
+
+            @p.command
+            def flake(self) -> None:
+                self._task("flake", 0.3)
+
+            @command
+            def mypy(self) -> None:
+                self._task("mypy", 0.3)
+
+            @command(depends=["p.flake"])
+            def test(self) -> None:
+                self._task("test")
+
+            @command(depends=["p.flake", "mypy", "test"])
+            def ci(self) -> None:
+                self._task("ci")
+
+            @command(depends=["cycle2"])
+            def cycle1(self) -> None:
+                pass
+
+            @command(depends=["cycle1"])
+            def cycle2(self) -> None:
+                pass
+
+        return GraphEnv()
+
+    def test_run(self, capsys):
+        env = self.get_env()
+        env.ci()
+
+        assert env.runs.count("flake_start") == 1
+        # flake and mypy are independent
+        assert set(env.runs[0:2]) == {"flake_start", "mypy_start"}
+        assert env.runs.index("test_start") > env.runs.index("flake_end")
+        assert env.runs[-2:] == ["ci_start", "ci_end"]
+
+        out = capsys.readouterr().out
+        assert re.search(r"p\.flake +0\.\d\ds\n", out)
+        assert re.search(r"Critical path: (p\.flake -> test|mypy) -> ci \(0\.\d\ds\)\n", out)
+
+    def test_cycle(self):
+        env = self.get_env()
+
+        with pytest.raises(EnvoError, match=r"Circular command dependency \(cycle1 -> cycle2 -> cycle1\)"):
+            env.cycle1()
+
+
+class TestActivation(utils.TestBase):
+    def test_os_environ_updated_in_place(self):
+        environ = os.environ
+        env = import_env_from_file("env_test.py").ThisEnv()
+        assert os.environ["ENVO_STAGE"] == "test"
+
+        env.deactivate()
+        assert os.environ is environ
+        assert "ENVO_STAGE" not in os.environ
+
+    def test_path(self, sandbox):
+        env = import_env_from_file("env_test.py").ThisEnv()
+        env.e.path = ["/bin", "/bin/", str(sandbox / "bin")]
+        env.e.path.insert(0, "/usr/bin")
+
+        assert env.e.path == [Path("/usr/bin"), Path("/bin"), sandbox / "bin"]
+        assert env.get_env_vars()["PATH"] == os.pathsep.join(["/usr/bin", "/bin"])
+
+        (sandbox / "bin").mkdir()
+        assert env.get_env_vars()["PATH"] == os.pathsep.join(["/usr/bin", "/bin", str(sandbox / "bin")])
+
+
+class TestGetEnv(utils.TestBase):
+    @pytest.fixture(autouse=True)
+    def setup_cache(self, sandbox):
+        Path("child").mkdir()
+        os.chdir("child")
+        utils.command("test init")
+        os.chdir(sandbox)
+
+        Env.invalidate_env_cache()
+        yield
+        Env.invalidate_env_cache()
+
+    def test_cached(self, mocker):
+        env = import_env_from_file("env_test.py").ThisEnv()
+        unrelated = mocker.patch.dict("sys.modules", {"env_unrelated": mocker.Mock(__file__="env_unrelated.py")})
+
+        child = env.get_env("child")
+        assert child.meta.root == Path("child").absolute()
+        assert env.get_env("child") is child
+        assert "env_unrelated" in unrelated
+
+        # parent file changed
+        st = os.stat("child/env_comm.py")
+        os.utime("child/env_comm.py", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        assert env.get_env("child") is not child
+
+        child = env.get_env("child")
+        Env.invalidate_env_cache("child")
+        assert env.get_env("child") is not child
+
+        child = env.get_env("child")
+        assert env.get_env("child", use_cache=False) is not child
+
+
+class TestEnvVarsCache:
+    def test_invalidation(self):
+        calls = []
+
+        def get_url(e) -> str:
+            calls.append(e.host)
+            return f"http://{e.host}"
+
+        class Environ(Env.Environ):
+            host: Optional[str] = env_var(default="localhost")
+            url: Optional[str] = computed_env_var(get_url)
+            dirs: Optional[List[str]] = env_var(default_factory=list)
+
+        e = Environ(name="sandbox")
+        assert e.get_env_vars()["SANDBOX_URL"] == "http://localhost"
+        calls.clear()
+
+        assert e.get_env_vars()["SANDBOX_URL"] == "http://localhost"
+        assert calls == []
+
+        e.host = "remote"
+        assert e.get_env_vars()["SANDBOX_URL"] == "http://remote"
+        assert set(calls) == {"remote"}
+
+        # modified in place
+        e.dirs.append("a")
+        e.dirs.append("b")
+        assert e.get_env_vars()["SANDBOX_DIRS"] == "a:b"
+
+    def test_validation(self):
+        class Environ(Env.Environ):
+            value: int = env_var(default=1)
+
+        e = Environ(name="sandbox")
+        e.get_env_vars()
+
+        e.value = None
+        with pytest.raises(envium.exceptions.ValidationErrors):
+            e.get_env_vars()
+
+        e.value = 2
+        assert e.get_env_vars()["SANDBOX_VALUE"] == "2"
+
+    def test_10k_vars(self, mocker):
+        n = 10000
+        attrs = {f"var_{i}": env_var(default=str(i)) for i in range(n)}
+        attrs["__annotations__"] = {f"var_{i}": Optional[str] for i in range(n)}
+        e = type("BigEnviron", (Env.Environ,), attrs)(name="big")
+        materialize = mocker.spy(EnvVarsTracker, "_materialize")
+
+        assert len(e.get_env_vars()) == n + 6
+        assert materialize.call_count == n + 6
+        materialize.reset_mock()
+
+        # nothing is materialized again when nothing changed
+        e.get_env_vars()
+        assert materialize.call_count == 0
+
+        # only the changed var is
+        e.var_0 = "changed"
+        assert e.get_env_vars()["BIG_VAR0"] == "changed"
+        assert materialize.call_count == 1
+
+
+class TestComputedEnvVar:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        ComputedEnvVar.memos.clear()
+        yield
+        ComputedEnvVar.memos.clear()
+
+    def get_environ_class(self, calls: List[str], ttl: Optional[float] = None) -> type:
+        def get_branch(e) -> str:
+            calls.append("branch")
+            return "master"
+
+        def get_url(e) -> str:
+            calls.append("url")
+            return f"http://{e.host}"
+
+        class Environ(Env.Environ):
+            host: Optional[str] = env_var(default="localhost")
+            branch: Optional[str] = computed_env_var(get_branch, ttl=ttl)
+            url: Optional[str] = computed_env_var(get_url)
+
+        return Environ
+
+    def test_lazy(self):
+        calls = []
+        e = self.get_environ_class(calls)(name="sandbox")
+        assert calls == []
+
+        assert e.url == "http://localhost"
+        assert e.url == "http://localhost"
+        assert calls == ["url"]
+
+    def test_memoized_between_instances(self):
+        calls = []
+        environ_class = self.get_environ_class(calls)
+
+        environ_class(name="sandbox").get_env_vars()
+        assert sorted(calls) == ["branch", "url"]
+        calls.clear()
+
+        e = environ_class(name="sandbox")
+        assert e.get_env_vars()["SANDBOX_URL"] == "http://localhost"
+        assert calls == []
+
+        e.host = "remote"
+        assert e.get_env_vars()["SANDBOX_URL"] == "http://remote"
+        assert calls == ["url"]
+
+    def test_ttl(self):
+        calls = []
+        environ_class = self.get_environ_class(calls, ttl=0.1)
+
+        environ_class(name="sandbox").get_env_vars()
+        calls.clear()
+        assert environ_class(name="sandbox").branch == "master"
+        assert calls == []
+
+        time.sleep(0.15)
+        assert environ_class(name="sandbox").branch == "master"
+        assert calls == ["branch"]
+
+
+class TestSecrets:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox, mocker):
+        self.getpass = mocker.patch("envo.env.getpass", return_value="caramel")
+
+    def get_secrets_class(self, calls: List[str]) -> type:
+        def get_token(s) -> str:
+            calls.append("token")
+            return f"token-{s.password}"
+
+        class Secrets(Env.Secrets):
+            password: str = secret()
+            token: str = computed_secret(get_token, ttl=60)
+
+        return Secrets
+
+    def get_cache(self, sandbox: Path) -> SecretsCache:
+        return SecretsCache(sandbox / "secrets", key_file=sandbox / "secrets.key")
+
+    def test_computed_lazy(self):
+        calls = []
+        s = self.get_secrets_class(calls)("sandbox")
+        assert s.errors == []
+        assert calls == []
+
+        assert s.token == "token-caramel"
+        assert s.token == "token-caramel"
+        assert calls == ["token"]
+
+    def test_cached(self, sandbox):
+        calls = []
+        secrets_class = self.get_secrets_class(calls)
+
+        assert secrets_class("sandbox", cache=self.get_cache(sandbox)).token == "token-caramel"
+        assert self.getpass.call_count == 1
+        assert calls == ["token"]
+
+        # next process
+        assert secrets_class("sandbox", cache=self.get_cache(sandbox)).token == "token-caramel"
+        assert self.getpass.call_count == 1
+        assert calls == ["token"]
+
+        # not cached without the cache
+        assert secrets_class("sandbox").password == "caramel"
+        assert self.getpass.call_count == 2
@@ -0,0 +1,72 @@
+import builtins
+import os
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from envo import executables
+from envo.executables import ExecutableIndex, IndexedCommandsCache
+
+
+class TestIndexedCommandsCache:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox, mocker):
+        self.environ = {"PATH": []}
+        mocker.patch.object(builtins, "__xonsh__", SimpleNamespace(env=self.environ), create=True)
+        mocker.patch.object(builtins, "aliases", {"ll": "ls -alF"}, create=True)
+        self.scan = mocker.patch("envo.executables.executables_in", wraps=executables.executables_in)
+
+    def add_executable(self, directory: Path, name: str) -> None:
+        directory.mkdir(exist_ok=True)
+        path = directory / name
+        path.write_text("")
+        path.chmod(0o755)
+        # directories modified just now are always rescanned
+        os.utime(directory, (1, 1))
+
+    def get_scanned(self) -> list:
+        scanned = [Path(c.args[0]).name for c in self.scan.call_args_list]
+        self.scan.reset_mock()
+        return scanned
+
+    def test_incremental(self, sandbox):
+        self.add_executable(sandbox / "bin", "tool")
+        self.add_executable(sandbox / "venv_bin", "tool")
+        self.add_executable(sandbox / "venv_bin", "python")
+
+        cache = IndexedCommandsCache(ExecutableIndex(sandbox))
+        self.environ["PATH"] = [str(sandbox / "bin")]
+        assert cache.all_commands == {"tool": (str(sandbox / "bin/tool"), None), "ll": ("ll", True)}
+        assert self.get_scanned() == ["bin"]
+
+        # venv activated, only the added directory is scanned
+        self.environ["PATH"] = [str(sandbox / "venv_bin"), str(sandbox / "bin")]
+        assert cache["tool"] == (str(sandbox / "venv_bin/tool"), None)
+        assert "python" in cache
+        assert self.get_scanned() == ["venv_bin"]
+
+        # and deactivated
+        self.environ["PATH"] = [str(sandbox / "bin")]
+        assert "python" not in cache
+        assert self.get_scanned() == []
+
+        # directory contents changed
+        self.add_executable(sandbox / "bin", "other")
+        os.utime(sandbox / "bin", (2, 2))
+        assert "other" in cache
+        assert self.get_scanned() == ["bin"]
+
+    def test_persisted(self, sandbox):
+        self.add_executable(sandbox / "bin", "tool")
+        self.environ["PATH"] = [str(sandbox / "bin")]
+
+        assert "tool" in IndexedCommandsCache(ExecutableIndex(sandbox))
+        assert self.get_scanned() == ["bin"]
+
+        assert "tool" in IndexedCommandsCache(ExecutableIndex(sandbox))
+        assert self.get_scanned() == []
+
+        (sandbox / ExecutableIndex.file_name).write_text("{corrupted")
+        assert "tool" in IndexedCommandsCache(ExecutableIndex(sandbox))
+        assert self.get_scanned() == ["bin"]
@@ -0,0 +1,50 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from envo.index import EnvIndex, get_env_index
+
+
+class TestEnvIndex:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox):
+        (sandbox / ".git").mkdir()
+        (sandbox / "env_comm.py").write_text("import envo\n")
+
+        service = sandbox / "services/api"
+        service.mkdir(parents=True)
+        (service / "env_comm.py").write_text("from env_comm import ThisEnv as RootEnv\n")
+        (service / "env_local.py").write_text("from env_comm import ThisEnv as ParentEnv\n")
+        (service / "env_test.py").write_text("from services.api.env_comm import ThisEnv as ParentEnv\n")
+        (sandbox / "services/node_modules/env_fake").mkdir(parents=True)
+
+    def test_graph(self, sandbox):
+        index = EnvIndex(sandbox)
+        index.update()
+
+        service = sandbox / "services/api"
+        env_files = [sandbox / "env_comm.py"] + [service / f for f in ["env_comm.py", "env_local.py", "env_test.py"]]
+        assert sorted(index.envs) == sorted(str(p) for p in env_files)
+        assert index.envs[str(service / "env_local.py")].stage == "local"
+        assert index.envs[str(service / "env_test.py")].parents == [str(service / "env_comm.py")]
+
+        chain = index.get_chain(service / "env_local.py")
+        assert [Path(n.path) for n in chain] == env_files[2:0:-1] + [sandbox / "env_comm.py"]
+
+    def test_persisted_and_fresh(self, sandbox, mocker):
+        service = sandbox / "services/api"
+        EnvIndex(sandbox, path=sandbox / "index.json").update()
+
+        scandir = mocker.spy(os, "scandir")
+        index = EnvIndex(sandbox, path=sandbox / "index.json")
+        env_files = [service / "env_comm.py", service / "env_local.py", service / "env_test.py"]
+        assert index.get_env_files(service) == env_files
+        assert scandir.call_count == 0
+
+        (service / "env_ci.py").write_text("")
+        assert service / "env_ci.py" in index.get_env_files(service)
+        assert scandir.call_count == 1
+
+    def test_get_env_index(self, sandbox):
+        assert get_env_index(sandbox / "services/api").root == sandbox
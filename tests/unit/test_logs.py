@@ -0,0 +1,229 @@
+import json
+
+import pytest
+
+from envo.logs import JsonlSink, Level, Logger, Messages, Msg, MsgFilter
+
+
+class TestLogger:
+    @pytest.fixture(autouse=True)
+    def setup(self, mocker):
+        mocker.patch.object(Logger, "output_level", Level.INFO)
+        mocker.patch.object(Logger, "capture", False)
+
+    def test_ring_buffer(self):
+        logger = Logger(name="test", buffer_size=3)
+
+        for i in range(5):
+            logger.info(f"info {i}", loguru_disable=True)
+        logger.error("error", loguru_disable=True)
+
+        assert [m.body for m in logger.messages] == ["info 2", "info 3", "info 4", "error"]
+
+        logger.set_buffer_size(1)
+        assert [m.body for m in logger.messages] == ["info 4", "error"]
+
+        logger.clean()
+        assert len(logger.messages) == 0
+
+    def test_children_share_buffer(self):
+        logger = Logger(name="test")
+        child = logger.create_child("child", descriptor="Child")
+
+        logger.info("root", loguru_disable=True)
+        child.info("child", {"type": "test"}, loguru_disable=True)
+
+        assert [(m.body, m.descriptor) for m in logger.messages] == [("root", None), ("child", "Child")]
+        assert child.messages is logger.messages
+        assert len(logger.get_msgs(MsgFilter(metadata_re={"type": "test"}))) == 1
+
+    def test_level_filtering(self, mocker):
+        logger = Logger(name="test")
+        logger.set_level(Level.ERROR)
+        logger.warning("warning", loguru_disable=True)
+        logger.error("error", loguru_disable=True)
+
+        assert [m.body for m in logger.messages] == ["error"]
+
+        mocker.patch.object(Logger, "capture", True)
+        logger.debug("debug", loguru_disable=True)
+        assert [m.body for m in logger.messages] == ["error", "debug"]
+
+    def test_msg(self):
+        msg = Msg(Level.INFO, "  body", 1.0)
+
+        assert msg.body == "body"
+        assert msg.metadata == {}
+        assert not hasattr(msg, "__dict__")
+        assert msg == Msg(Level.INFO, "body", 1.0, metadata={})
+
+    def test_lazy(self, mocker):
+        logger = Logger(name="test")
+        loguru_log = mocker.patch("loguru.logger.log")
+        message = mocker.Mock(return_value="message")
+        metadata = mocker.Mock(return_value={"type": "test"})
+
+        logger.debug(message, metadata)
+        assert not message.called
+        assert not metadata.called
+        assert not loguru_log.called
+
+        logger.info(message, metadata)
+        assert [(m.body, m.metadata) for m in logger.messages] == [("message", {"type": "test"})]
+        loguru_log.assert_called_once_with("INFO", "message")
+
+    def test_print_not_tty(self, capsys, mocker):
+        logger = Logger(name="test")
+        logger.sw = mocker.Mock(value=1.0)
+        logger.info("message", {"type": "test"}, loguru_disable=True)
+        logger.error("error", loguru_disable=True)
+        highlight = mocker.patch("pygments.highlight")
+
+        logger.print_all()
+
+        assert capsys.readouterr().out == "[INFO @1.0000]message; {'type': 'test'}\n[ERROR@1.0000]error; \n"
+        assert not highlight.called
+
+
+class TestJsonlSink:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox, mocker):
+        mocker.patch.object(Logger, "output_level", Level.INFO)
+        mocker.patch.object(Logger, "capture", False)
+
+    def test_save_and_load(self, sandbox):
+        logger = Logger(name="test")
+        logger.info("before save", loguru_disable=True)
+
+        sink = logger.save(sandbox / "logs/envo.jsonl", level=Level.DEBUG)
+        # messages for the sink are created even below the logger level
+        logger.debug("reloading", {"type": "reload", "path": sandbox}, loguru_disable=True)
+        logger.error("error", loguru_disable=True)
+        logger.remove_sink(sink)
+        logger.debug("after remove", loguru_disable=True)
+
+        messages = Messages.load(sandbox / "logs/envo.jsonl")
+        assert [(m.level, m.body) for m in messages] == [
+            (Level.INFO, "before save"),
+            (Level.DEBUG, "reloading"),
+            (Level.ERROR, "error"),
+        ]
+        assert messages.get_msgs(MsgFilter(metadata_re={"type": "reload"}))[0].metadata["path"] == str(sandbox)
+
+    def test_level(self, sandbox):
+        logger = Logger(name="test")
+        sink = logger.save(sandbox / "envo.jsonl", level=Level.WARNING)
+        logger.info("info", loguru_disable=True)
+        logger.warning("warning", loguru_disable=True)
+        sink.flush()
+
+        assert [m.body for m in Messages.load(sandbox / "envo.jsonl")] == ["warning"]
+        logger.remove_sink(sink)
+
+    def test_rotation(self, sandbox):
+        sink = JsonlSink(sandbox / "envo.jsonl", max_bytes=200, backup_count=2)
+        for i in range(20):
+            sink.write(Msg(Level.DEBUG, f"message {i}", float(i)))
+            sink.flush()
+        sink.close()
+
+        assert [p.name for p in JsonlSink.get_segments(sandbox / "envo.jsonl")] == [
+            "envo.jsonl.2.gz",
+            "envo.jsonl.1.gz",
+            "envo.jsonl",
+        ]
+        bodies = [m.body for m in Messages.load(sandbox / "envo.jsonl")]
+        assert bodies == [f"message {i}" for i in range(20 - len(bodies), 20)]
+        assert len(bodies) < 20
+
+    def test_rotation_while_busy(self, sandbox, mocker):
+        mocker.patch.object(JsonlSink, "batch_size", 5)
+        sink = JsonlSink(sandbox / "envo.jsonl", max_bytes=500, backup_count=1)
+        for i in range(200):
+            sink.write(Msg(Level.DEBUG, f"message {i}", float(i)))
+        sink.flush()
+
+        line_size = len(json.dumps(Msg(Level.DEBUG, "message 199", 199.0).to_dict())) + 1
+        assert (sandbox / "envo.jsonl").stat().st_size <= 500 + JsonlSink.batch_size * line_size
+        sink.close()
+
+    def test_cant_open(self, sandbox, capsys):
+        (sandbox / "envo.jsonl").mkdir()
+        sink = JsonlSink(sandbox / "envo.jsonl")
+        sink.write(Msg(Level.DEBUG, "message", 1.0))
+        sink.flush()
+        sink.close()
+
+        assert sink.closed
+        assert "Can't write log to" in capsys.readouterr().err
+
+
+class TestGetMsgs:
+    @pytest.fixture(autouse=True)
+    def setup(self, mocker):
+        mocker.patch.object(Logger, "output_level", Level.INFO)
+        mocker.patch.object(Logger, "capture", True)
+
+        self.logger = Logger(name="test", buffer_size=4)
+        self.time = 0.0
+
+        def get_time():
+            self.time += 1.0
+            return self.time
+
+        type(mocker.patch.object(self.logger, "sw")).value = mocker.PropertyMock(side_effect=get_time)
+
+    def get_msgs(self, **kwargs) -> list:
+        return [(m.time, m.body) for m in self.logger.get_msgs(MsgFilter(**kwargs))]
+
+    def test_filters(self):
+        self.logger.debug("Reloading", {"type": "reload", "path": "env_comm.py"}, loguru_disable=True)
+        self.logger.info("command", {"command": "ls"}, loguru_disable=True)
+        self.logger.debug("Reloading", {"type": "reload", "path": "env_test.py"}, loguru_disable=True)
+        self.logger.debug("Partial", {"type": "partial_reload"}, loguru_disable=True)
+        self.logger.error("error", loguru_disable=True)
+
+        assert self.get_msgs(metadata_re={"type": "reload"}) == [(1.0, "Reloading"), (3.0, "Reloading")]
+        assert self.get_msgs(metadata_re={"type": "reload", "path": ".*test"}) == [(3.0, "Reloading")]
+        assert self.get_msgs(metadata_re={"missing": ".*"}) == []
+        assert self.get_msgs(level=Level.ERROR) == [(5.0, "error")]
+        assert self.get_msgs(body_re="Re") == [(1.0, "Reloading"), (3.0, "Reloading")]
+        assert self.get_msgs(time_later=2.0, time_before=5.0) == [
+            (2.0, "command"),
+            (3.0, "Reloading"),
+            (4.0, "Partial"),
+        ]
+        assert self.get_msgs(time_later=3.0, metadata_re={"type": ".*"}) == [(3.0, "Reloading"), (4.0, "Partial")]
+
+        # indices follow the ring buffer
+        for i in range(3):
+            self.logger.debug(f"debug {i}", loguru_disable=True)
+
+        assert self.get_msgs(metadata_re={"type": ".*"}) == [(4.0, "Partial")]
+        assert self.get_msgs(level=Level.DEBUG) == [
+            (4.0, "Partial"),
+            (6.0, "debug 0"),
+            (7.0, "debug 1"),
+            (8.0, "debug 2"),
+        ]
+
+        self.logger.set_buffer_size(1)
+        assert self.get_msgs(metadata_re={"type": ".*"}) == []
+        assert self.get_msgs(metadata_re={"command": "ls"}) == [(2.0, "command")]
+
+    def test_matches_all(self):
+        msg = Msg(Level.INFO, "body", 2.0, metadata={"type": "reload"})
+
+        assert MsgFilter(time_later=1.0, time_before=3.0).matches_all(msg)
+        assert not MsgFilter(time_later=3.0).matches_all(msg)
+        assert not MsgFilter(time_before=2.0).matches_all(msg)
+        assert MsgFilter(level=Level.INFO, body_re="b", metadata_re={"type": "re"}).matches_all(msg)
+        assert not MsgFilter(metadata_re={"type": "partial"}).matches_all(msg)
+
+    def test_time_index_bounded(self):
+        for i in range(100):
+            self.logger.debug(f"debug {i}", loguru_disable=True)
+
+        debug = self.logger.messages._levels[Level.DEBUG]
+        assert len(debug.times) <= 2 * self.logger.messages.size
+        assert self.get_msgs(time_later=98.0) == [(98.0, "debug 97"), (99.0, "debug 98"), (100.0, "debug 99")]
@@ -1,8 +1,10 @@
 import os
+import sys
 from pathlib import Path
 
 import pytest
 
+from envo.misc import PathList, env_modules_registry, import_env_from_file, update_environ
 from tests.facade import get_repo_root
 from tests.unit import utils
 
@@ -40,6 +42,72 @@ class TestMisc(utils.TestBase):
         Path("sandbox/__init__.py").touch()
         utils.command("test")
 
+    def test_update_environ(self):
+        class Environ(dict):
+            updates = []
+
+            def update(self, other) -> None:
+                self.updates.append(other)
+                super().update(other)
+
+        environ = Environ({"A": "1", "B": "2", "C": "3"})
+
+        update_environ(environ, {"A": "1", "B": "4", "D": "5"})
+        assert environ == {"A": "1", "B": "4", "C": "3", "D": "5"}
+        assert environ.updates == [{"B": "4", "D": "5"}]
+
+        update_environ(environ, {"A": "1"}, remove_missing=True)
+        assert environ == {"A": "1"}
+
+    def test_path_list(self, sandbox):
+        Path("a").mkdir()
+        Path("b").mkdir()
+        a = str(sandbox / "a")
+        b = str(sandbox / "b")
+
+        paths = PathList([a, f"{a}/", f"{b}//", sandbox / "missing"])
+        assert paths == [Path(a), Path(b), sandbox / "missing"]
+        assert f"{b}/." in paths
+
+        paths.append(a)
+        paths.insert(0, b)
+        assert paths == [Path(b), Path(a), sandbox / "missing"]
+        assert paths.to_env_value() == f"{b}{os.pathsep}{a}"
+
+        paths.remove(f"{a}/")
+        assert a not in paths
+        assert PathList(paths, drop_missing=False).to_env_value() == f"{b}{os.pathsep}{sandbox / 'missing'}"
+
+    def test_env_modules_registry(self, sandbox):
+        Path("helpers.py").write_text("from env_comm import ThisEnv\n")
+        Path("env_other.py").write_text("import helpers\n")
+
+        import_env_from_file("env_other.py")
+        assert {"env_comm"} <= env_modules_registry.names
+        assert env_modules_registry.dependents["env_comm"] == {"helpers"}
+        env_comm = sys.modules["env_comm"]
+
+        import_env_from_file("env_other.py")
+        assert sys.modules["env_comm"] is not env_comm
+        assert "helpers" in sys.modules
+
+        # unloading other env doesn't unload helpers of env_comm
+        helpers = sys.modules["helpers"]
+        env_modules_registry.unload(["env_test"])
+        assert sys.modules["helpers"] is helpers
+
+        # env_comm is already loaded so helpers2 is recorded from its references
+        Path("helpers2.py").write_text("import helpers\nfrom env_comm import ThisEnv\n")
+        Path("env_other2.py").write_text("import helpers2\n")
+        import_env_from_file("env_other2.py", reuse_modules=True)
+        assert env_modules_registry.dependents["env_comm"] == {"helpers", "helpers2"}
+        assert env_modules_registry.dependents["helpers"] == {"helpers2"}
+
+        env_modules_registry.unload(["env_comm"])
+        assert "helpers" not in sys.modules
+        assert "helpers2" not in sys.modules
+        assert "env_comm" not in env_modules_registry.dependents
+
     def test_get_repo_root(self):
         assert str(get_repo_root()).endswith("/envo")
         assert get_repo_root().glob(".git")
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from envo.secrets_cache import SecretsCache
+
+
+class TestSecretsCache:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox, monkeypatch):
+        monkeypatch.delenv(SecretsCache.passphrase_env_var, raising=False)
+
+    def test_key_file(self, sandbox):
+        key_file = sandbox / "secrets.key"
+        cache = SecretsCache(sandbox / "secrets", key_file=key_file)
+        cache.set("sandbox.token", "caramel")
+
+        assert key_file.stat().st_mode & 0o777 == 0o600
+        assert (sandbox / "secrets").stat().st_mode & 0o777 == 0o600
+        assert b"caramel" not in (sandbox / "secrets").read_bytes()
+
+        assert SecretsCache(sandbox / "secrets", key_file=key_file).get("sandbox.token") == (True, "caramel")
+        assert SecretsCache(sandbox / "secrets", key_file=sandbox / "other.key").get("sandbox.token") == (False, None)
+
+    def test_passphrase(self, sandbox, monkeypatch):
+        monkeypatch.setenv(SecretsCache.passphrase_env_var, "cake")
+        SecretsCache(sandbox / "secrets").set("sandbox.token", "caramel")
+
+        assert SecretsCache(sandbox / "secrets").get("sandbox.token") == (True, "caramel")
+        assert SecretsCache(sandbox / "secrets", passphrase="pie").get("sandbox.token") == (False, None)
+
+    def test_tampered(self, sandbox):
+        key_file = sandbox / "secrets.key"
+        SecretsCache(sandbox / "secrets", key_file=key_file).set("sandbox.token", "caramel")
+
+        data = bytearray((sandbox / "secrets").read_bytes())
+        data[-40] ^= 1
+        (sandbox / "secrets").write_bytes(bytes(data))
+
+        assert SecretsCache(sandbox / "secrets", key_file=key_file).get("sandbox.token") == (False, None)
+
+    def test_ttl(self, sandbox):
+        cache = SecretsCache(sandbox / "secrets", key_file=sandbox / "secrets.key")
+        cache.set("sandbox.token", "caramel", ttl=0.1)
+        cache.set("sandbox.other", "cake")
+
+        time.sleep(0.15)
+        assert cache.get("sandbox.token") == (False, None)
+        assert cache.get("sandbox.other") == (True, "cake")
@@ -0,0 +1,68 @@
+import pytest
+
+from envo.stats import CommandStats, Record
+
+
+class TestCommandStats:
+    @pytest.fixture(autouse=True)
+    def setup(self, sandbox):
+        pass
+
+    def get_record(self, name: str, duration: float, time: float = 0, status: int = 0) -> Record:
+        return Record(time=time, kind="command", name=name, args_hash="", duration=duration, status=status)
+
+    def test_measure(self, sandbox):
+        stats = CommandStats(data_dir=sandbox)
+
+        with stats.measure("command", "flake", ((1,), {})):
+            pass
+
+        with pytest.raises(SystemExit):
+            with stats.measure("command", "flake", ((2,), {})):
+                raise SystemExit(3)
+
+        with pytest.raises(SystemExit):
+            with stats.measure("command", "flake", ((3,), {})):
+                raise SystemExit()
+
+        records = stats.get_records()
+        assert [(r.kind, r.name, r.status) for r in records] == [
+            ("command", "flake", 0),
+            ("command", "flake", 3),
+            ("command", "flake", 0),
+        ]
+        assert records[0].args_hash != records[1].args_hash
+
+        # torn line is skipped
+        with stats.path.open("a") as f:
+            f.write("1.0\tcommand\tfla")
+        assert len(stats.get_records()) == 3
+
+    def test_not_recording_without_data_dir(self):
+        stats = CommandStats()
+        stats.append(self.get_record("flake", 1))
+        assert stats.get_records() == []
+
+    def test_compaction(self, sandbox):
+        stats = CommandStats(data_dir=sandbox, max_bytes=2000, keep=3)
+
+        for i in range(40):
+            stats.append(self.get_record("flake", duration=i, time=i))
+        stats.append(self.get_record("mypy", duration=1, time=40))
+
+        assert stats.path.stat().st_size <= 2000
+        assert [r.name for r in stats.get_records()][-1] == "mypy"
+        assert len([r for r in stats.get_records() if r.name == "flake"]) <= 3 + 2000 // 40
+
+    def test_summaries(self, sandbox):
+        stats = CommandStats(data_dir=sandbox, recent=2)
+
+        for i, d in enumerate([1, 1, 1, 2, 3, 3]):
+            stats.append(self.get_record("flake", duration=d, time=i))
+        stats.append(self.get_record("mypy", duration=5, time=10, status=1))
+
+        flake, mypy = stats.get_summaries()
+
+        assert (flake.name, flake.runs, flake.failures, flake.p50, flake.p95, flake.last) == ("flake", 6, 0, 1, 3, 3)
+        assert flake.regression == 3
+        assert (mypy.runs, mypy.failures, mypy.p50, mypy.regression) == (1, 1, 5, None)